@@ -51,6 +51,7 @@ setuptools.setup(
     install_requires=[
         'attrs',
         'click',
+        'importlib_metadata; python_version < "3.8"',
         'importlib_resources',
         'marshmallow',
         'marshmallow_polyfield',
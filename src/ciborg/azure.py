@@ -1,4 +1,6 @@
 import collections
+import fnmatch
+import functools
 import typing
 
 import attr
@@ -12,6 +14,11 @@ from pyrsistent import pvector, pmap, pset
 
 import ciborg.configuration
 import ciborg.data
+import ciborg.intermediate
+import ciborg.profiling
+import ciborg.pyz
+import ciborg.serialization
+import ciborg.sharding
 
 
 def load_template():
@@ -25,7 +32,7 @@ def create_use_python_version_task_step(version_spec, architecture):
     return TaskStep(
         task='UsePythonVersion@0',
         inputs=UsePythonVersionTaskStepInputs(
-            version_spec=version_spec.joined_by('.'),
+            version_spec=version_spec,
             architecture=architecture,
         ),
     )
@@ -55,7 +62,36 @@ def create_download_build_artifacts_task_step(download_path, artifact_name):
     )
 
 
-def create_set_dist_file_path_task(distribution_name, distribution_type):
+def create_delay_task_step():
+    # Agentless jobs need a step and can't run scripts.
+    return TaskStep(
+        task='Delay@1',
+        display_name='Join',
+        inputs=DelayTaskStepInputs(delay_for_minutes='0'),
+    )
+
+
+pip_cache_directory = '$(Pipeline.Workspace)/.pip'
+zipapp_directory = '$(Pipeline.Workspace)/.ciborg'
+
+
+def create_cache_task_step(display_name, key, path, restore_keys=()):
+    return TaskStep(
+        task='Cache@2',
+        display_name=display_name,
+        inputs=CacheTaskStepInputs(
+            key=key,
+            restore_keys='\n'.join(restore_keys) or None,
+            path=path,
+        ),
+    )
+
+
+def create_set_dist_file_path_task(
+        distribution_name,
+        distribution_type,
+        directory='dist',
+):
     if distribution_type == ciborg.configuration.sdist_install_source:
         # only_or_no_binary = '--no-binary :all:'
         extension = '.tar.gz'
@@ -79,13 +115,13 @@ def create_set_dist_file_path_task(distribution_name, distribution_type):
     set_variable_command = (
         'echo "##vso[task.setvariable variable=DIST_FILE_PATH]'
         # + '$(ls ${PWD}/dist-selected/*)"'
-        + '$(ls ${{PWD}}/dist/*{})"'.format(extension)
+        + '$(ls ${{PWD}}/{}/*{})"'.format(directory, extension)
     )
 
     return BashStep(
         display_name='Select distribution file',
         script='\n'.join([
-            'ls ${PWD}/dist/*',
+            'ls ${{PWD}}/{}/*'.format(directory),
             # download_command,
             set_variable_command,
         ]),
@@ -93,158 +129,6 @@ def create_set_dist_file_path_task(distribution_name, distribution_type):
     )
 
 
-def create_verify_up_to_date_job(
-        environment,
-        configuration_path,
-        output_path,
-        ciborg_requirement,
-):
-    use_python_version_step = create_use_python_version_task_step(
-        version_spec=environment.version,
-        architecture='x64',
-    )
-
-    installation_step = BashStep(
-        display_name='Install ciborg',
-        script='\n'.join([
-            'python -m pip install --upgrade pip setuptools',
-            'python -m pip install "{}"'.format(ciborg_requirement),
-        ]),
-    )
-
-    generation_command_format = (
-        'python -m ciborg azure --configuration {configuration}'
-        + ' --output {output}'
-    )
-    generation_command = generation_command_format.format(
-        configuration=configuration_path,
-        output=configuration_path.parent / output_path,
-    )
-
-    generation_step = BashStep(
-        display_name='Generate',
-        script='\n'.join([
-            generation_command,
-        ]),
-    )
-
-    verification_step = BashStep(
-        display_name='Verify',
-        script='\n'.join([
-            '[ -z "$(git status --porcelain)" ]',
-        ]),
-    )
-
-    job = Job(
-        id_name='verify_up_to_date',
-        display_name='Verify up to date',
-        steps=[
-            use_python_version_step,
-            installation_step,
-            generation_step,
-            verification_step,
-        ],
-        pool=Pool(vm_image=environment.vm_image),
-    )
-
-    return job
-
-
-def create_sdist_job(environment):
-    use_python_version_step = create_use_python_version_task_step(
-        version_spec=environment.version,
-        architecture='x64',
-    )
-
-    bash_step = BashStep(
-        display_name='Build',
-        script='\n'.join([
-            'python -m pip install --quiet --upgrade pip',
-            'python -m pip install --quiet --upgrade pep517',
-            'python -m pep517.build --source --out-dir dist/ .',
-        ]),
-    )
-
-    publish_task_step = create_publish_build_artifacts_task_step(
-        path_to_publish='$(System.DefaultWorkingDirectory)/dist/',
-        artifact_name='dist',
-    )
-
-    sdist_job = Job(
-        id_name='sdist',
-        display_name='Build sdist',
-        steps=[
-            use_python_version_step,
-            bash_step,
-            publish_task_step,
-        ],
-        pool=Pool(vm_image=environment.vm_image),
-    )
-
-    return sdist_job
-
-
-def create_bdist_wheel_pure_job(environment):
-    use_python_version_step = create_use_python_version_task_step(
-        version_spec=environment.version,
-        architecture='x64',
-    )
-
-    bash_step = BashStep(
-        display_name='Build',
-        script='\n'.join([
-            'python -m pip install --quiet --upgrade pip',
-            'python -m pip install --quiet --upgrade pep517',
-            'python -m pep517.build --binary --out-dir dist/ .',
-        ]),
-    )
-
-    publish_task_step = create_publish_build_artifacts_task_step(
-        path_to_publish='$(System.DefaultWorkingDirectory)/dist/',
-        artifact_name='dist',
-    )
-
-    job = Job(
-        id_name='bdist',
-        display_name='Build pure wheel',
-        steps=[
-            use_python_version_step,
-            bash_step,
-            publish_task_step,
-        ],
-        pool=Pool(vm_image=environment.vm_image),
-    )
-
-    return job
-
-
-def create_all_job(environment, other_jobs):
-    use_python_version_step = create_use_python_version_task_step(
-        version_spec=environment.version,
-        architecture='x64',
-    )
-
-    this_step = BashStep(
-        display_name='This',
-        script='\n'.join([
-            'python -m this',
-        ]),
-    )
-
-    job = Job(
-        id_name='all',
-        display_name='All',
-        steps=[
-            use_python_version_step,
-            this_step,
-        ],
-        depends_on=other_jobs,
-        pool=Pool(vm_image=environment.vm_image),
-    )
-
-    return job
-
-
 class PlatformSchema(marshmallow.Schema):
     class Meta:
         ordered = True
@@ -252,19 +136,8 @@ class PlatformSchema(marshmallow.Schema):
     display_name = marshmallow.fields.String()
 
 
-@attr.s(frozen=True)
-class Platform:
-    display_name = attr.ib()
-
-    def identifier(self):
-        return self.display_name.casefold()
-
-
-platforms = {
-    'linux': Platform(display_name='Linux'),
-    'macos': Platform(display_name='macOS'),
-    'windows': Platform(display_name='Windows'),
-}
+Platform = ciborg.intermediate.Platform
+platforms = ciborg.intermediate.platforms
 
 
 class VmImageSchema(marshmallow.Schema):
@@ -276,30 +149,8 @@ class VmImageSchema(marshmallow.Schema):
     platform = marshmallow.fields.Nested(PlatformSchema)
 
 
-@attr.s(frozen=True)
-class VmImage:
-    id_name = attr.ib()
-    display_name = attr.ib()
-    platform = attr.ib()
-
-
-vm_images = {
-    ciborg.configuration.linux_platform: VmImage(
-        platform=platforms['linux'],
-        display_name=platforms['linux'].display_name,
-        id_name='ubuntu-latest',
-    ),
-    ciborg.configuration.macos_platform: VmImage(
-        platform=platforms['macos'],
-        display_name=platforms['macos'].display_name,
-        id_name='macOS-latest',
-    ),
-    ciborg.configuration.windows_platform: VmImage(
-        platform=platforms['windows'],
-        display_name=platforms['windows'].display_name,
-        id_name='windows-latest',
-    ),
-}
+VmImage = ciborg.intermediate.VmImage
+vm_images = ciborg.intermediate.vm_images
 
 # @attr.s(frozen=True)
 # class Platform:
@@ -351,203 +202,397 @@ vm_images = {
 # })
 
 
-@attr.s(frozen=True)
-class Environment:
-    platform = attr.ib()
-    vm_image = attr.ib()
-    interpreter = attr.ib()
-    version = attr.ib()
-    architecture = attr.ib()
-    display_string = attr.ib()
-    identifier_string = attr.ib()
-    tox_environment = attr.ib()
-
-    @classmethod
-    def build(
-            cls,
-            platform,
-            interpreter,
-            version,
-            architecture,
-            display_string,
-            identifier_string,
-            tox_environment=None,
-    ):
-        return cls(
-            platform=platform,
-            vm_image=vm_images[platform],
-            interpreter=interpreter,
-            version=version,
-            architecture=architecture,
-            display_string=display_string,
-            identifier_string=identifier_string,
-            tox_environment=tox_environment,
-        )
+Environment = ciborg.intermediate.Environment
 
-    def tox_env(self):
-        if self.tox_environment is not None:
-            return self.tox_environment
 
-        env = 'py'
-        if self.interpreter == 'PyPy':
-            env += 'py'
-            if self.version[0] == '3':
-                env += '3'
-        else:
-            env += self.version.joined_by('')
+def create_tox_step(
+        tox_environment,
+        install_distribution,
+        shard_index=None,
+        shard_count=None,
+):
+    tox_command = 'python -m tox'
+    environment = {
+        'TOXENV': tox_environment,
+    }
 
-        return env
+    if install_distribution:
+        tox_command += ' --installpkg="${DIST_FILE_PATH}"'
+        environment['DIST_FILE_PATH'] = '$(DIST_FILE_PATH)'
 
-    def matrix_version(self):
-        if self.interpreter == 'CPython':
-            return self.version
+    shard_commands = []
+    if shard_index is not None:
+        shard_commands = ciborg.sharding.commands(
+            index=shard_index,
+            count=shard_count,
+        )
+        tox_command += ciborg.sharding.posargs
 
-        return 'pypy{}'.format(self.version[0])
+    return BashStep(
+        display_name='Tox',
+        script='\n'.join([
+            *shard_commands,
+            'python -m pip install --quiet --upgrade pip setuptools wheel',
+            'python -m pip install tox',
+            tox_command,
+        ]),
+        environment=environment,
+    )
 
 
-def create_tox_test_job(
-        build_job,
-        environment,
-        distribution_name,
-        distribution_type,
+def create_generation_step(
+        configuration_path,
+        output_path,
+        ciborg_command='python -m ciborg',
+        check=False,
 ):
-    steps = pvector()
+    generation_command_format = (
+        '{ciborg} azure --configuration {configuration}'
+        + ' --output {output}'
+    )
+    if check:
+        generation_command_format += ' --check'
 
-    use_python_version_step = create_use_python_version_task_step(
-        version_spec=environment.version,
-        architecture='x64',
+    generation_command = generation_command_format.format(
+        ciborg=ciborg_command,
+        configuration=configuration_path,
+        output=configuration_path.parent / output_path,
     )
-    steps = steps.append(use_python_version_step)
 
-    if distribution_type is not None:
-        download_task_step = create_download_build_artifacts_task_step(
-            download_path='$(System.DefaultWorkingDirectory)/',
-            artifact_name='dist',
-        )
-        steps = steps.append(download_task_step)
+    return BashStep(
+        display_name='Generate',
+        script='\n'.join([
+            generation_command,
+        ]),
+    )
+
+
+def matrix_reference(variable):
+    return '$({})'.format(variable.name)
+
+
+def matrix_value(value, convert=str):
+    if isinstance(value, ciborg.intermediate.MatrixVariable):
+        return matrix_reference(value)
+
+    return convert(value)
+
+
+def version_spec(version):
+    return matrix_value(version, lambda version: version.joined_by('.'))
+
 
-        select_dist_step = create_set_dist_file_path_task(
-            distribution_name=distribution_name,
-            distribution_type=distribution_type,
+def lower_setup_python_step(step, output_path):
+    return create_use_python_version_task_step(
+        version_spec=version_spec(step.version),
+        architecture=step.architecture,
+    )
+
+
+def lower_checkout_step(step, output_path):
+    if step.fetch_depth is None:
+        # Azure checks out the repository without an explicit step.
+        return None
+
+    return CheckoutStep(fetch_depth=step.fetch_depth)
+
+
+def lower_run_step(step, output_path):
+    return BashStep(
+        display_name=step.name,
+        script='\n'.join(step.commands),
+        environment=step.environment,
+    )
+
+
+def lower_generate_step(step, output_path):
+    if step.zipapp is None:
+        return create_generation_step(
+            configuration_path=step.configuration_path,
+            output_path=output_path,
+            check=step.check,
         )
-        steps = steps.append(select_dist_step)
 
-    tox_command = 'python -m tox'
-    tox_environment = {
-        'TOXENV': environment.tox_env(),
-    }
+    return create_generation_step(
+        configuration_path=step.configuration_path,
+        output_path=output_path,
+        ciborg_command='python {}'.format(zipapp_path(step.zipapp)),
+        check=step.check,
+    )
 
-    if distribution_type is not None:
-        tox_command += ' --installpkg="${DIST_FILE_PATH}"'
-        tox_environment['DIST_FILE_PATH'] = '$(DIST_FILE_PATH)'
 
-    tox_step = BashStep(
-        display_name='Tox',
+def zipapp_path(zipapp):
+    if zipapp.is_url():
+        return zipapp_directory + '/ciborg.pyz'
+
+    return zipapp.location
+
+
+# Azure doesn't provide the commit before a push, so only pull request
+# builds compare to a base, the target branch, and pushes always count as
+# changed.
+changes_base = '$([ "${BUILD_REASON}" = PullRequest ] && echo HEAD^1)'
+
+
+def lower_changes_step(step, output_path):
+    return BashStep(
+        display_name='Check for changes',
         script='\n'.join([
-            'python -m pip install --quiet --upgrade pip setuptools wheel',
-            'python -m pip install tox',
-            tox_command,
+            *ciborg.intermediate.changes_commands(
+                paths=step.all_paths(output_path),
+                base=changes_base,
+            ),
+            'echo "##vso[task.setvariable variable={variable}]${{{variable}}}"'
+            .format(variable=ciborg.intermediate.changed_variable),
         ]),
-        environment=tox_environment,
     )
-    steps = steps.append(tox_step)
 
-    id_pieces = [
-        'tox',
-        *(
-            []
-            if environment.tox_environment is None
-            else [environment.tox_environment]
-        ),
-        environment.identifier_string,
-    ]
-
-    display_pieces = [
-        'Tox',
-        *(
-            []
-            if environment.tox_environment is None
-            else [environment.tox_environment]
-        ),
-    ]
 
-    job = Job(
-        id_name='_'.join(id_pieces),
-        display_name='{} - {}'.format(
-            ' '.join(display_pieces),
-            environment.display_string,
+changed_condition = "and(succeeded(), eq(variables.{}, 'true'))".format(
+    ciborg.intermediate.changed_variable,
+)
+
+
+def lower_publish_artifact_step(step, output_path):
+    return create_publish_build_artifacts_task_step(
+        path_to_publish='$(System.DefaultWorkingDirectory)/' + step.path,
+        artifact_name=step.artifact_name,
+    )
+
+
+def lower_download_artifact_step(step, output_path):
+    # The artifact is downloaded into a directory named after itself.
+    return create_download_build_artifacts_task_step(
+        download_path='$(System.DefaultWorkingDirectory)/',
+        artifact_name=step.artifact_name,
+    )
+
+
+def lower_select_distribution_step(step, output_path):
+    return create_set_dist_file_path_task(
+        distribution_name=step.distribution_name,
+        distribution_type=step.distribution_type,
+        directory=step.artifact_name,
+    )
+
+
+def cache_key_string(value):
+    # Unquoted segments with a dot or slash are taken as files to hash.
+    return '"{}"'.format(value)
+
+
+def lower_pip_cache_step(step, output_path):
+    prefix = 'pip | "$(Agent.OS)" | {}'.format(
+        cache_key_string(version_spec(step.python_version)),
+    )
+
+    return create_cache_task_step(
+        display_name='Cache pip',
+        key=' | '.join([prefix, matrix_value(step.lock_file), 'tox.ini']),
+        restore_keys=[prefix],
+        path=pip_cache_directory,
+    )
+
+
+def lower_tox_environment_cache_step(step, output_path):
+    tox_environment = matrix_value(step.tox_environment)
+
+    # File segments must exist so the optional key files are left out.
+    return create_cache_task_step(
+        display_name='Cache tox environment',
+        key=' | '.join([
+            'tox',
+            '"$(Agent.OS)"',
+            cache_key_string(version_spec(step.python_version)),
+            cache_key_string(tox_environment),
+            *(matrix_value(key_file) for key_file in step.key_files),
+        ]),
+        path='$(System.DefaultWorkingDirectory)/.tox/{}'.format(
+            tox_environment,
         ),
-        steps=steps,
-        depends_on=[] if build_job is None else [build_job],
-        pool=Pool(vm_image=environment.vm_image),
     )
 
-    return job
 
+def lower_zipapp_cache_step(step, output_path):
+    return create_cache_task_step(
+        display_name='Cache ciborg zipapp',
+        key='ciborg | "{}"'.format(step.zipapp.location),
+        path=zipapp_directory,
+    )
 
-def create_pipeline(configuration, configuration_path, output_path):
-    jobs = pvector()
 
-    tooling_environment = Environment.build(
-        platform=configuration.tooling_environment.platform,
-        interpreter=configuration.tooling_environment.interpreter,
-        version=configuration.tooling_environment.version,
-        architecture='x64',
-        display_string=configuration.tooling_environment.display_name(),
-        identifier_string=configuration.tooling_environment.identifier(),
+def lower_fetch_zipapp_step(step, output_path):
+    return BashStep(
+        display_name='Fetch ciborg zipapp',
+        script='\n'.join(
+            ciborg.pyz.fetch_commands(
+                url=step.zipapp.location,
+                path=zipapp_path(step.zipapp),
+            ),
+        ),
     )
 
-    verify_job = create_verify_up_to_date_job(
-        environment=tooling_environment,
-        configuration_path=configuration_path,
-        output_path=output_path,
-        ciborg_requirement=configuration.ciborg_requirement,
+
+def lower_tox_step(step, output_path):
+    return create_tox_step(
+        tox_environment=matrix_value(step.tox_environment),
+        install_distribution=step.install_distribution,
+        shard_index=(
+            None
+            if step.shard_index is None
+            else matrix_value(step.shard_index)
+        ),
+        shard_count=(
+            None
+            if step.shard_count is None
+            else matrix_value(step.shard_count)
+        ),
     )
-    jobs = jobs.append(verify_job)
 
-    if configuration.build_sdist:
-        sdist_job = create_sdist_job(environment=tooling_environment)
-        jobs = jobs.append(sdist_job)
 
-    if configuration.build_wheel == 'universal':
-        bdist_job = create_bdist_wheel_pure_job(
-            environment=tooling_environment,
-        )
-        jobs = jobs.append(bdist_job)
-    # elif configuration.build_wheel == 'specific':
+step_lowerings = pmap({
+    ciborg.intermediate.SetupPythonStep: lower_setup_python_step,
+    ciborg.intermediate.CheckoutStep: lower_checkout_step,
+    ciborg.intermediate.RunStep: lower_run_step,
+    ciborg.intermediate.ChangesStep: lower_changes_step,
+    ciborg.intermediate.GenerateStep: lower_generate_step,
+    ciborg.intermediate.ZipappCacheStep: lower_zipapp_cache_step,
+    ciborg.intermediate.FetchZipappStep: lower_fetch_zipapp_step,
+    ciborg.intermediate.PublishArtifactStep: lower_publish_artifact_step,
+    ciborg.intermediate.DownloadArtifactStep: lower_download_artifact_step,
+    ciborg.intermediate.SelectDistributionStep: lower_select_distribution_step,
+    ciborg.intermediate.PipCacheStep: lower_pip_cache_step,
+    ciborg.intermediate.ToxEnvironmentCacheStep: (
+        lower_tox_environment_cache_step
+    ),
+    ciborg.intermediate.ToxStep: lower_tox_step,
+})
 
-    build_jobs = {
-        ciborg.configuration.sdist_install_source: sdist_job,
-        ciborg.configuration.bdist_install_source: bdist_job,
-    }
 
-    for environment in configuration.test_environments:
-        test_job_environment = Environment.build(
-            platform=environment.platform,
-            interpreter=environment.interpreter,
-            version=environment.version,
-            architecture=None,
-            display_string=environment.display_name(),
-            identifier_string=environment.identifier(),
-            tox_environment=environment.tox_environment,
-        )
+# Steps are interned frozen values so the jobs of a pipeline mostly hit this
+# cache and share the lowered steps rather than building copies.
+@functools.lru_cache(maxsize=1024)
+def lower_step(step, output_path):
+    return step_lowerings[type(step)](step, output_path=output_path)
+
+
+@functools.lru_cache(maxsize=None)
+def create_pool(vm_image):
+    # One shared pool per image lets the serialization memo reuse its output.
+    return Pool(vm_image=vm_image)
+
+
+matrix_vm_image = VmImage(
+    id_name=matrix_reference(ciborg.intermediate.vm_image_variable),
+    display_name=None,
+    platform=None,
+)
 
-        build_job = build_jobs.get(environment.install_source)
 
-        jobs = jobs.append(
-            create_tox_test_job(
-                build_job=build_job,
-                environment=test_job_environment,
-                distribution_name=configuration.name,
-                distribution_type=environment.install_source,
+def create_cancel_run_step():
+    # Azure has no fail fast for jobs or matrices so the build cancels
+    # itself through the REST API.  The build service needs the stop builds
+    # permission.
+    return BashStep(
+        display_name='Cancel build',
+        script=(
+            'curl --fail --silent --show-error --request PATCH'
+            ' --header "Authorization: Bearer ${SYSTEM_ACCESSTOKEN}"'
+            ' --header "Content-Type: application/json"'
+            ' --data \'{"status": "cancelling"}\''
+            ' "$(System.CollectionUri)$(System.TeamProjectId)'
+            '/_apis/build/builds/$(Build.BuildId)?api-version=6.0"'
+        ),
+        environment={'SYSTEM_ACCESSTOKEN': '$(System.AccessToken)'},
+        condition='failed()',
+    )
+
+
+def lower_job(job, output_path):
+    steps = pvector()
+    condition = None
+
+    for step in job.steps:
+        lowered = lower_step(step, output_path=output_path)
+        if lowered is not None:
+            if condition is not None:
+                lowered = attr.evolve(lowered, condition=condition)
+
+            steps = steps.append(lowered)
+
+        if isinstance(step, ciborg.intermediate.ChangesStep):
+            condition = changed_condition
+
+    if job.aggregate:
+        return Job(
+            id_name=job.id_name,
+            display_name=job.display_name,
+            pool=server_pool,
+            depends_on=job.needs,
+            steps=[create_delay_task_step()],
+        )
+
+    if job.matrix is None:
+        vm_image = job.environment.vm_image
+        strategy = None
+    else:
+        vm_image = matrix_vm_image
+        strategy = Strategy(
+            matrix=collections.OrderedDict(
+                (leg.id_name, leg.variables())
+                for leg in job.matrix
             ),
         )
 
-    all_job = create_all_job(
-        environment=tooling_environment,
-        other_jobs=jobs,
+    variables = None
+    if any(
+            isinstance(step, ciborg.intermediate.PipCacheStep)
+            for step in job.steps
+    ):
+        # Pointed at the cached directory for every step, tox included.
+        variables = {'PIP_CACHE_DIR': pip_cache_directory}
+
+    if job.fail_fast:
+        steps = steps.append(create_cancel_run_step())
+
+    return Job(
+        id_name=job.id_name,
+        display_name=job.display_name,
+        strategy=strategy,
+        variables=variables,
+        steps=steps,
+        depends_on=job.needs,
+        pool=create_pool(vm_image=vm_image),
     )
-    jobs = jobs.append(all_job)
+
+
+def create_path_filters(paths, paths_ignore, required_paths):
+    # Excluding wins over including so patterns that would exclude a
+    # required path are left out.
+    return IncludeExcludePVectors(
+        include=pvector([
+            *(paths if len(paths) > 0 else ['*']),
+            *required_paths,
+        ]),
+        exclude=pvector(
+            pattern
+            for pattern in paths_ignore
+            if not any(
+                fnmatch.fnmatchcase(path, pattern)
+                for path in required_paths
+            )
+        ),
+    )
+
+
+def lower_pipeline(pipeline, output_path, lazy=False):
+    jobs = (
+        lower_job(job=job, output_path=output_path)
+        for job in pipeline.jobs
+    )
+
+    if not lazy:
+        jobs = pvector(jobs)
 
     stage = Stage(
         id_name='main',
@@ -555,12 +600,52 @@ def create_pipeline(configuration, configuration_path, output_path):
         jobs=jobs,
     )
 
-    pipeline = Pipeline(
-        name=configuration.name,
+    # Azure already cancels pull request runs superseded by newer commits,
+    # batching covers the pushes to branches.
+    batch = pipeline.cancel_superseded
+
+    if not pipeline.filtered():
+        trigger = Trigger(batch=batch)
+        pr = None
+    else:
+        paths = create_path_filters(
+            paths=pipeline.paths,
+            paths_ignore=pipeline.paths_ignore,
+            required_paths=pipeline.required_paths(output_path=output_path),
+        )
+        trigger = Trigger(batch=batch, paths=paths)
+        # Listing the pull request trigger at all limits it to the listed
+        # branches.
+        pr = PullRequestTrigger(
+            branches=IncludeExcludePVectors(include=pvector(['*'])),
+            paths=paths,
+        )
+
+    return Pipeline(
+        name=pipeline.name,
+        trigger=trigger,
+        pr=pr,
         stages=pvector([stage]),
     )
 
-    return pipeline
+
+def create_pipeline(
+        configuration,
+        configuration_path,
+        output_path,
+        lazy=False,
+):
+    pipeline = ciborg.intermediate.create_pipeline(
+        configuration=configuration,
+        configuration_path=configuration_path,
+        lazy=lazy,
+    )
+
+    return lower_pipeline(
+        pipeline=pipeline,
+        output_path=output_path,
+        lazy=lazy,
+    )
 
 
 def ordered_dict_representer(dumper, data):
@@ -574,7 +659,7 @@ def str_representer(dumper, data):
     return dumper.represent_scalar('tag:yaml.org,2002:str', data, style="")
 
 
-class TidyOrderedDictDumper(yaml.Dumper):
+class TidyOrderedDictRepresenterMixin:
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -588,14 +673,184 @@ class TidyOrderedDictDumper(yaml.Dumper):
             str_representer,
         )
 
+    def ignore_aliases(self, data):
+        # Memoized serialization shares identical subtrees, which should
+        # still be written out in full rather than as anchors and aliases.
+        return True
+
+
+class TidyOrderedDictDumper(TidyOrderedDictRepresenterMixin, yaml.Dumper):
+    pass
+
+
+if hasattr(yaml, 'CDumper'):
+    class TidyOrderedDictCDumper(
+        TidyOrderedDictRepresenterMixin,
+        yaml.CDumper,
+    ):
+        pass
+
+    default_dumper: typing.Type[typing.Any] = TidyOrderedDictCDumper
+else:
+    default_dumper = TidyOrderedDictDumper
+
+
+# Long expressions such as cache keys stay on one line rather than being
+# folded at the default 80 columns.
+dump_width = 2 ** 16
 
-def dump_pipeline(pipeline):
-    basic_types = PipelineSchema().dump(pipeline)
-    dumped = yaml.dump(basic_types, sort_keys=False, Dumper=TidyOrderedDictDumper)
+
+def marshal_pipeline(pipeline):
+    with ciborg.serialization.memoized():
+        return ciborg.serialization.serializer(PipelineSchema)(pipeline)
+
+
+def dump_pipeline(pipeline, dumper=None):
+    if dumper is None:
+        dumper = default_dumper
+
+    with ciborg.profiling.phase('marshal'):
+        basic_types = marshal_pipeline(pipeline)
+
+    with ciborg.profiling.phase('emit'):
+        dumped = yaml.dump(
+            basic_types,
+            sort_keys=False,
+            Dumper=dumper,
+            width=dump_width,
+        )
 
     return dumped
 
 
+def open_event_stream(stream, dumper=None):
+    if dumper is None:
+        dumper = default_dumper
+
+    emitter = dumper(
+        stream,
+        default_flow_style=False,
+        sort_keys=False,
+        width=dump_width,
+    )
+    emitter.emit(yaml.StreamStartEvent())
+    emitter.emit(yaml.DocumentStartEvent(explicit=False))
+
+    return emitter
+
+
+def close_event_stream(emitter):
+    emitter.emit(yaml.DocumentEndEvent(explicit=False))
+    emitter.emit(yaml.StreamEndEvent())
+    emitter.dispose()
+
+
+def emit_mapping_start(emitter):
+    emitter.emit(
+        yaml.MappingStartEvent(
+            anchor=None,
+            tag='tag:yaml.org,2002:map',
+            implicit=True,
+            flow_style=False,
+        ),
+    )
+
+
+def emit_mapping_end(emitter):
+    emitter.emit(yaml.MappingEndEvent())
+
+
+def emit_sequence_start(emitter):
+    emitter.emit(
+        yaml.SequenceStartEvent(
+            anchor=None,
+            tag='tag:yaml.org,2002:seq',
+            implicit=True,
+            flow_style=False,
+        ),
+    )
+
+
+def emit_sequence_end(emitter):
+    emitter.emit(yaml.SequenceEndEvent())
+
+
+def emit_scalar(emitter, value):
+    node = emitter.represent_data(value)
+    emitter.represented_objects = {}
+    emitter.object_keeper = []
+    emitter.alias_key = None
+
+    implicit = tuple(
+        node.tag == emitter.resolve(yaml.ScalarNode, node.value, flags)
+        for flags in [(True, False), (False, True)]
+    )
+    emitter.emit(
+        yaml.ScalarEvent(
+            anchor=None,
+            tag=node.tag,
+            implicit=implicit,
+            value=node.value,
+            style=node.style,
+        ),
+    )
+
+
+def emit_data(emitter, data):
+    if isinstance(data, typing.Mapping):
+        emit_mapping_start(emitter)
+        for key, value in data.items():
+            emit_scalar(emitter, key)
+            emit_data(emitter, value)
+        emit_mapping_end(emitter)
+    elif isinstance(data, (list, tuple)):
+        emit_sequence_start(emitter)
+        for value in data:
+            emit_data(emitter, value)
+        emit_sequence_end(emitter)
+    else:
+        emit_scalar(emitter, data)
+
+
+def stream_pipeline(pipeline, stream, dumper=None):
+    emitter = open_event_stream(stream=stream, dumper=dumper)
+    serialize_stage = ciborg.serialization.serializer(StageSchema)
+    serialize_job = ciborg.serialization.serializer(JobSchema)
+
+    with ciborg.serialization.memoized(
+            maxsize=ciborg.serialization.streaming_memo_size,
+    ):
+        # The stages of a pipeline and the jobs of a stage are the last
+        # fields of their schemas so they can be emitted after the rest of
+        # the mapping.
+        emit_mapping_start(emitter)
+        shell = marshal_pipeline(attr.evolve(pipeline, stages=pvector()))
+        for key, value in shell.items():
+            emit_scalar(emitter, key)
+            emit_data(emitter, value)
+
+        emit_scalar(emitter, 'stages')
+        emit_sequence_start(emitter)
+        for stage in pipeline.stages:
+            emit_mapping_start(emitter)
+            stage_shell = serialize_stage(attr.evolve(stage, jobs=pvector()))
+            for key, value in stage_shell.items():
+                emit_scalar(emitter, key)
+                emit_data(emitter, value)
+
+            emit_scalar(emitter, 'jobs')
+            emit_sequence_start(emitter)
+            for job in stage.jobs:
+                emit_data(emitter, serialize_job(job))
+            emit_sequence_end(emitter)
+
+            emit_mapping_end(emitter)
+        emit_sequence_end(emitter)
+        emit_mapping_end(emitter)
+
+    close_event_stream(emitter)
+
+
 def remove_skip_values(the_dict, skip_values=pset({None, pvector(), pmap()})):
     return type(the_dict)([
         [key, value]
@@ -609,19 +864,27 @@ def post_dump_remove_skip_values(self, data, many):
     return remove_skip_values(data)
 
 
+ciborg.serialization.post_dump_replacements[post_dump_remove_skip_values] = (
+    remove_skip_values
+)
+
+
 class IncludeExcludePVectorsSchema(marshmallow.Schema):
     class Meta:
         ordered = True
 
     include = marshmallow.fields.List(marshmallow.fields.String())
+    # Named to not shadow Schema.exclude.
     exclude_ = marshmallow.fields.List(
-        marshmallow.fields.String(data_key='exclude', attribute='exclude'),
+        marshmallow.fields.String(),
+        data_key='exclude',
+        attribute='exclude',
     )
 
     post_dump = post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class IncludeExcludePVectors:
     include = attr.ib(factory=pvector)
     exclude = attr.ib(factory=pvector)
@@ -639,7 +902,7 @@ class TriggerSchema(marshmallow.Schema):
     post_dump = post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Trigger:
     batch = attr.ib(default=False)
     branches = attr.ib(factory=IncludeExcludePVectors)
@@ -647,6 +910,22 @@ class Trigger:
     paths = attr.ib(factory=IncludeExcludePVectors)
 
 
+class PullRequestTriggerSchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    branches = marshmallow.fields.Nested(IncludeExcludePVectorsSchema())
+    paths = marshmallow.fields.Nested(IncludeExcludePVectorsSchema())
+
+    post_dump = post_dump_remove_skip_values
+
+
+@attr.s(frozen=True, slots=True)
+class PullRequestTrigger:
+    branches = attr.ib(factory=IncludeExcludePVectors)
+    paths = attr.ib(factory=IncludeExcludePVectors)
+
+
 class OrderedDictField(marshmallow.fields.Mapping):
     # https://github.com/marshmallow-code/marshmallow/pull/1098
     mapping_type = collections.OrderedDict
@@ -660,7 +939,7 @@ class UsePythonVersionTaskStepSchema(marshmallow.Schema):
     version_spec = marshmallow.fields.String(data_key='versionSpec')
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class UsePythonVersionTaskStepInputs:
     architecture = attr.ib()
     version_spec = attr.ib()
@@ -674,7 +953,7 @@ class PublishBuildArtifactsTaskStepSchema(marshmallow.Schema):
     artifact_name = marshmallow.fields.String(data_key='artifactName')
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class PublishBuildArtifactsTaskStep:
     path_to_publish = attr.ib()
     artifact_name = attr.ib()
@@ -688,16 +967,48 @@ class DownloadBuildArtifactsTaskStepSchema(marshmallow.Schema):
     artifact_name = marshmallow.fields.String(data_key='artifactName')
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class DownloadBuildArtifactsTaskStep:
     download_path = attr.ib()
     artifact_name = attr.ib()
 
 
+class CacheTaskStepInputsSchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    key = marshmallow.fields.String()
+    restore_keys = marshmallow.fields.String(
+        data_key='restoreKeys',
+        allow_none=True,
+    )
+    path = marshmallow.fields.String()
+
+    post_dump = post_dump_remove_skip_values
+
+
+@attr.s(frozen=True, slots=True)
+class CacheTaskStepInputs:
+    key = attr.ib()
+    restore_keys = attr.ib()
+    path = attr.ib()
+
+
+class DelayTaskStepInputsSchema(marshmallow.Schema):
+    delay_for_minutes = marshmallow.fields.String(data_key='delayForMinutes')
+
+
+@attr.s(frozen=True, slots=True)
+class DelayTaskStepInputs:
+    delay_for_minutes = attr.ib()
+
+
 task_step_inputs_type_schema_map = pmap({
     UsePythonVersionTaskStepInputs: UsePythonVersionTaskStepSchema,
     PublishBuildArtifactsTaskStep: PublishBuildArtifactsTaskStepSchema,
     DownloadBuildArtifactsTaskStep: DownloadBuildArtifactsTaskStepSchema,
+    CacheTaskStepInputs: CacheTaskStepInputsSchema,
+    DelayTaskStepInputs: DelayTaskStepInputsSchema,
 })
 
 
@@ -722,7 +1033,7 @@ class TaskStepSchema(marshmallow.Schema):
     post_dump = post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class TaskStep:
     task = attr.ib()
     inputs = attr.ib()
@@ -737,6 +1048,7 @@ class BashStepSchema(marshmallow.Schema):
 
     script = marshmallow.fields.String(data_key='bash')
     display_name = marshmallow.fields.String(data_key='displayName')
+    condition = marshmallow.fields.String(allow_none=True)
     fail_on_stderr = marshmallow.fields.Boolean(data_key='failOnStderr')
     environment = marshmallow.fields.Dict(
         keys=marshmallow.fields.String(),
@@ -753,7 +1065,7 @@ def sorted_ordered_dict(
     return collections.OrderedDict(sorted(mapping.items()))
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class BashStep:
     script = attr.ib()
     display_name = attr.ib()
@@ -762,6 +1074,43 @@ class BashStep:
         default=pmap(),
         converter=sorted_ordered_dict,
     )
+    condition = attr.ib(default=None)
+
+
+class CheckoutStepSchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    checkout = marshmallow.fields.String()
+    fetch_depth = marshmallow.fields.Integer(data_key='fetchDepth')
+    condition = marshmallow.fields.String(allow_none=True)
+
+    post_dump = post_dump_remove_skip_values
+
+
+@attr.s(frozen=True, slots=True)
+class CheckoutStep:
+    checkout = attr.ib(default='self')
+    fetch_depth = attr.ib(default=None)
+    condition = attr.ib(default=None)
+
+
+class StrategySchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    matrix = OrderedDictField(
+        keys=marshmallow.fields.String(),
+        values=OrderedDictField(
+            keys=marshmallow.fields.String(),
+            values=marshmallow.fields.String(),
+        ),
+    )
+
+
+@attr.s(frozen=True, slots=True)
+class Strategy:
+    matrix = attr.ib()
 
 
 class PoolSchema(marshmallow.Schema):
@@ -772,13 +1121,51 @@ class PoolSchema(marshmallow.Schema):
     )
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Pool:
     vm_image = attr.ib()
 
 
+@attr.s(frozen=True, slots=True)
+class ServerPool:
+    """Runs agentless jobs on the Azure Pipelines server itself."""
+
+
+server_pool = ServerPool()
+
+
+class PoolField(marshmallow.fields.Field):
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+
+        if isinstance(value, ServerPool):
+            return 'server'
+
+        return PoolSchema().dump(value)
+
+
+@ciborg.serialization.register_field_compiler(PoolField)
+def compile_pool_field(field):
+    serialize_pool = ciborg.serialization.memoize(
+        ciborg.serialization.serializer(PoolSchema),
+    )
+
+    def serialize_pool_field(value):
+        if value is None:
+            return None
+
+        if isinstance(value, ServerPool):
+            return 'server'
+
+        return serialize_pool(value)
+
+    return serialize_pool_field
+
+
 step_type_schema_map = pmap({
     BashStep: BashStepSchema,
+    CheckoutStep: CheckoutStepSchema,
     TaskStep: TaskStepSchema,
 })
 
@@ -793,7 +1180,13 @@ class JobSchema(marshmallow.Schema):
 
     id_name = marshmallow.fields.String(data_key='job')
     display_name = marshmallow.fields.String(data_key='displayName')
-    pool = marshmallow.fields.Nested(PoolSchema())
+    strategy = marshmallow.fields.Nested(StrategySchema(), allow_none=True)
+    pool = PoolField()
+    variables = OrderedDictField(
+        keys=marshmallow.fields.String(),
+        values=marshmallow.fields.String(),
+        allow_none=True,
+    )
     depends_on = marshmallow.fields.List(
         marshmallow.fields.Pluck(
             nested='ciborg.azure.JobSchema',
@@ -802,7 +1195,10 @@ class JobSchema(marshmallow.Schema):
         data_key='dependsOn',
     )
     condition = marshmallow.fields.String(allow_none=True)
-    continue_on_error = marshmallow.fields.Boolean(data_key='continueOnError')
+    continue_on_error = marshmallow.fields.Boolean(
+        data_key='continueOnError',
+        allow_none=True,
+    )
     steps = marshmallow.fields.List(
         marshmallow_polyfield.PolyField(
             serialization_schema_selector=(
@@ -814,14 +1210,18 @@ class JobSchema(marshmallow.Schema):
     post_dump = post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Job:
     id_name = attr.ib()
     display_name = attr.ib()
     pool = attr.ib()
+    strategy = attr.ib(default=None)
+    variables = attr.ib(default=None)
     depends_on = attr.ib(factory=pvector)
     condition = attr.ib(default=None)
-    continue_on_error = attr.ib(default=True)
+    # Left unset, a failing job would only be reported as partially
+    # succeeded and the all job would pass regardless.
+    continue_on_error = attr.ib(default=None)
     steps: pyrsistent.typing.PVector[
         typing.Union[BashStep, TaskStep],
     ] = attr.ib(default=pvector(), converter=pvector)
@@ -843,7 +1243,7 @@ class StageSchema(marshmallow.Schema):
     post_dump = post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Stage:
     id_name = attr.ib()
     display_name = attr.ib()
@@ -858,16 +1258,18 @@ class PipelineSchema(marshmallow.Schema):
 
     name = marshmallow.fields.String()
     trigger = marshmallow.fields.Nested(TriggerSchema())
+    pr = marshmallow.fields.Nested(PullRequestTriggerSchema(), allow_none=True)
     stages = marshmallow.fields.List(marshmallow.fields.Nested(StageSchema()))
 
     post_dump = post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Pipeline:
     name = attr.ib()
     trigger = attr.ib(factory=Trigger)
     stages = attr.ib(factory=list)
+    pr = attr.ib(default=None)
 
 
 # @attr.s(frozen=True)
@@ -0,0 +1,113 @@
+import gc
+import tracemalloc
+
+import attr
+import click
+
+import ciborg.benchmarks.scaling
+import ciborg.intermediate
+
+
+default_sizes = [100, 1000, 10000]
+
+
+@attr.s(frozen=True)
+class Result:
+    model = attr.ib()
+    size = attr.ib()
+    retained_bytes = attr.ib()
+    steps = attr.ib()
+    distinct_steps = attr.ib()
+
+    def bytes_per_job(self):
+        return self.retained_bytes / self.size
+
+
+def jobs_of(model):
+    if isinstance(model, ciborg.intermediate.Pipeline):
+        return model.jobs
+
+    stages = getattr(model, 'stages', None)
+    if stages is not None:
+        return [job for stage in stages for job in stage.jobs]
+
+    return model.jobs
+
+
+models = {
+    'intermediate': lambda configuration: (
+        ciborg.intermediate.create_pipeline(
+            configuration=configuration,
+            configuration_path=ciborg.benchmarks.scaling.configuration_path,
+        )
+    ),
+    'azure': ciborg.benchmarks.scaling.create_pipeline,
+    'github': ciborg.benchmarks.scaling.create_workflow,
+}
+
+
+def measure(name, size):
+    configuration = ciborg.benchmarks.scaling.load(
+        ciborg.benchmarks.scaling.synthetic_configuration(size),
+    )
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        model = models[name](configuration)
+        gc.collect()
+        end_bytes, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    steps = [step for job in jobs_of(model) for step in job.steps]
+
+    return Result(
+        model=name,
+        size=size,
+        retained_bytes=end_bytes - start_bytes,
+        steps=len(steps),
+        distinct_steps=len({id(step) for step in steps}),
+    )
+
+
+def parse_sizes(context, parameter, value):
+    try:
+        return [int(size) for size in value.split(',')]
+    except ValueError as e:
+        raise click.BadParameter(str(e)) from e
+
+
+@click.command()
+@click.option(
+    '--sizes',
+    default=','.join(str(size) for size in default_sizes),
+    show_default=True,
+    callback=parse_sizes,
+    help='Comma separated counts of test environments.',
+)
+def cli(sizes):
+    """Report the memory retained by the job models and how many of their
+    steps are shared rather than copied per job.
+    """
+    click.echo('{:<14} {:>8} {:>14} {:>10} {:>8} {:>10}'.format(
+        'model', 'size', 'retained', 'per job', 'steps', 'distinct',
+    ))
+    for name in models:
+        for size in sizes:
+            result = measure(name=name, size=size)
+            click.echo(
+                '{:<14} {:>8} {:>14} {:>10.0f} {:>8} {:>10}'.format(
+                    result.model,
+                    result.size,
+                    result.retained_bytes,
+                    result.bytes_per_job(),
+                    result.steps,
+                    result.distinct_steps,
+                ),
+            )
+
+
+if __name__ == '__main__':
+    cli()
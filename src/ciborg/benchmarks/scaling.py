@@ -0,0 +1,385 @@
+import itertools
+import json
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import attr
+import click
+import click.testing
+
+import ciborg
+import ciborg.azure
+import ciborg.cli
+import ciborg.configuration
+import ciborg.github
+
+
+default_sizes = [10, 100, 1000, 10000, 100000]
+
+
+def synthetic_configuration(size):
+    combinations = list(itertools.product(
+        ciborg.configuration.platforms,
+        ciborg.configuration.interpreters,
+        ciborg.configuration.python_versions,
+        [None, *ciborg.configuration.install_sources],
+    ))
+
+    test_environments = []
+
+    for index in range(size):
+        platform_, interpreter, version, install_source = (
+            combinations[index % len(combinations)]
+        )
+        repetition = index // len(combinations)
+
+        environment = {
+            'platform': platform_.configuration_string,
+            'interpreter': interpreter.configuration_string,
+            'version': version.configuration_string,
+        }
+
+        if install_source is not None:
+            environment['install_source'] = (
+                install_source.configuration_string
+            )
+
+        if repetition > 0:
+            # Keep the job identifiers unique past the first full cycle.
+            environment['tox_environment'] = 'r{}'.format(repetition)
+
+        test_environments.append(environment)
+
+    return {
+        'name': 'synthetic',
+        'build_sdist': True,
+        'build_wheel': 'universal',
+        'tooling_environment': {
+            'platform': 'linux',
+            'interpreter': 'cpython',
+            'version': '3.8',
+        },
+        'test_environments': test_environments,
+        'ciborg_requirement': 'ciborg',
+    }
+
+
+configuration_path = pathlib.Path('ciborg.json')
+
+
+def load(marshalled):
+    return ciborg.configuration.load_marshalled(marshalled)
+
+
+def load_schema(marshalled):
+    return ciborg.configuration.ConfigurationSchema().load(marshalled)
+
+
+def create_pipeline(configuration):
+    return ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=configuration_path,
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+
+def create_workflow(configuration):
+    return ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=configuration_path,
+        output_path=pathlib.Path('.github/workflows/ci.yml'),
+    )
+
+
+def run_cli(marshalled, backend):
+    with tempfile.TemporaryDirectory() as directory:
+        directory_path = pathlib.Path(directory)
+        input_path = directory_path / 'ciborg.json'
+        input_path.write_text(json.dumps(marshalled))
+
+        result = click.testing.CliRunner().invoke(
+            ciborg.cli.cli,
+            [
+                backend,
+                '--configuration',
+                str(input_path),
+                '--output',
+                str(directory_path / 'output.yml'),
+            ],
+            catch_exceptions=False,
+        )
+
+        if result.exit_code != 0:
+            raise Exception(result.output)
+
+
+@attr.s(frozen=True)
+class Phase:
+    name = attr.ib()
+    # Builds the phase input outside of the measured region.
+    prepare = attr.ib()
+    run = attr.ib()
+
+
+phases = [
+    Phase(
+        name='load',
+        prepare=synthetic_configuration,
+        run=load,
+    ),
+    Phase(
+        name='load_schema',
+        prepare=synthetic_configuration,
+        run=load_schema,
+    ),
+    Phase(
+        name='create_pipeline',
+        prepare=lambda size: load(synthetic_configuration(size)),
+        run=create_pipeline,
+    ),
+    Phase(
+        name='create_workflow',
+        prepare=lambda size: load(synthetic_configuration(size)),
+        run=create_workflow,
+    ),
+    Phase(
+        name='dump_pipeline',
+        prepare=lambda size: create_pipeline(
+            load(synthetic_configuration(size)),
+        ),
+        run=ciborg.azure.dump_pipeline,
+    ),
+    Phase(
+        name='dump_workflow',
+        prepare=lambda size: create_workflow(
+            load(synthetic_configuration(size)),
+        ),
+        run=ciborg.github.dump_workflow,
+    ),
+    Phase(
+        name='cli_azure',
+        prepare=synthetic_configuration,
+        run=lambda marshalled: run_cli(marshalled, backend='azure'),
+    ),
+    Phase(
+        name='cli_github',
+        prepare=synthetic_configuration,
+        run=lambda marshalled: run_cli(marshalled, backend='github'),
+    ),
+]
+
+phases_by_name = {phase.name: phase for phase in phases}
+
+
+@attr.s(frozen=True)
+class Result:
+    phase = attr.ib()
+    size = attr.ib()
+    seconds = attr.ib()
+    peak_bytes = attr.ib()
+
+    def key(self):
+        return (self.phase, self.size)
+
+
+def measure(phase, size, repeat):
+    durations = []
+
+    for _ in range(repeat):
+        argument = phase.prepare(size)
+        start = time.perf_counter()
+        phase.run(argument)
+        durations.append(time.perf_counter() - start)
+
+    # Tracing slows allocation heavy code down so memory gets its own run.
+    argument = phase.prepare(size)
+    tracemalloc.start()
+    try:
+        phase.run(argument)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return Result(
+        phase=phase.name,
+        size=size,
+        seconds=min(durations),
+        peak_bytes=peak_bytes,
+    )
+
+
+def dump_results(results, file):
+    json.dump(
+        {
+            'ciborg': ciborg.__version__,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'results': [attr.asdict(result) for result in results],
+        },
+        file,
+        indent=4,
+    )
+    file.write('\n')
+
+
+def load_results(file):
+    return [Result(**result) for result in json.load(file)['results']]
+
+
+def compare(baseline, results, threshold):
+    baseline_by_key = {result.key(): result for result in baseline}
+    regressions = []
+
+    for result in results:
+        reference = baseline_by_key.get(result.key())
+        if reference is None:
+            continue
+
+        for name in ['seconds', 'peak_bytes']:
+            old = getattr(reference, name)
+            new = getattr(result, name)
+            if old > 0 and new > old * (1 + threshold):
+                regressions.append(
+                    '{phase} [{size}] {name}: {old} -> {new} ({ratio:+.0%})'
+                    .format(
+                        phase=result.phase,
+                        size=result.size,
+                        name=name,
+                        old=old,
+                        new=new,
+                        ratio=new / old - 1,
+                    ),
+                )
+
+    return regressions
+
+
+def parse_sizes(context, parameter, value):
+    try:
+        return [int(size) for size in value.split(',')]
+    except ValueError as e:
+        raise click.BadParameter(str(e)) from e
+
+
+@click.command()
+@click.option(
+    '--sizes',
+    default=','.join(str(size) for size in default_sizes),
+    show_default=True,
+    callback=parse_sizes,
+    help='Comma separated counts of test environments.',
+)
+@click.option(
+    '--phase',
+    'phase_names',
+    type=click.Choice(sorted(phases_by_name)),
+    multiple=True,
+    help='Phases to run, all by default.',
+)
+@click.option('--repeat', default=3, show_default=True)
+@click.option(
+    '--output',
+    type=click.File('w'),
+    default=None,
+    help='Write the results as JSON.',
+)
+@click.option(
+    '--baseline',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help=(
+        'Compare against this JSON result file.  A missing baseline is an'
+        ' error unless --write-baseline is passed.'
+    ),
+)
+@click.option(
+    '--write-baseline',
+    is_flag=True,
+    help='Write the results to the baseline file rather than comparing.',
+)
+@click.option(
+    '--threshold',
+    type=float,
+    default=0.25,
+    show_default=True,
+    help='Relative slowdown or memory growth treated as a regression.',
+)
+def cli(
+        sizes,
+        phase_names,
+        repeat,
+        output,
+        baseline,
+        write_baseline,
+        threshold,
+):
+    selected = (
+        phases
+        if len(phase_names) == 0
+        else [phases_by_name[name] for name in phase_names]
+    )
+
+    results = []
+
+    click.echo('{:<16} {:>8} {:>12} {:>14}'.format(
+        'phase', 'size', 'seconds', 'peak [bytes]',
+    ))
+    for phase in selected:
+        for size in sizes:
+            result = measure(phase=phase, size=size, repeat=repeat)
+            results.append(result)
+            click.echo('{:<16} {:>8} {:>12.4f} {:>14}'.format(
+                result.phase,
+                result.size,
+                result.seconds,
+                result.peak_bytes,
+            ))
+
+    if output is not None:
+        dump_results(results=results, file=output)
+
+    if baseline is None:
+        if write_baseline:
+            raise click.UsageError('--write-baseline requires --baseline')
+
+        return
+
+    baseline_path = pathlib.Path(baseline)
+    if write_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with baseline_path.open('w') as file:
+            dump_results(results=results, file=file)
+        click.echo('Wrote baseline to {}'.format(baseline_path))
+
+        return
+
+    if not baseline_path.exists():
+        # Passing silently would never catch a regression on a fresh
+        # checkout or in CI.
+        raise click.ClickException(
+            'Baseline {} does not exist, create it with --write-baseline'
+            .format(baseline_path),
+        )
+
+    with baseline_path.open() as file:
+        regressions = compare(
+            baseline=load_results(file),
+            results=results,
+            threshold=threshold,
+        )
+
+    if len(regressions) > 0:
+        raise click.ClickException(
+            'Regressions beyond {:.0%}:\n{}'.format(
+                threshold,
+                '\n'.join(regressions),
+            ),
+        )
+
+
+if __name__ == '__main__':
+    cli()
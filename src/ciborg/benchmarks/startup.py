@@ -0,0 +1,175 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import attr
+import click
+
+import ciborg
+
+
+# Modules that the lazily loaded commands are expected to keep out of a bare
+# ``python -m ciborg --help``.
+deferred_modules = [
+    'ciborg.azure',
+    'ciborg.configuration',
+    'ciborg.github',
+    'importlib_resources',
+    'marshmallow',
+    'marshmallow_polyfield',
+    'pyrsistent',
+    'yaml',
+]
+
+_import_time_pattern = re.compile(
+    r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<name>.*)$',
+)
+
+
+@attr.s(frozen=True)
+class ImportTime:
+    name = attr.ib()
+    depth = attr.ib()
+    self_microseconds = attr.ib()
+    cumulative_microseconds = attr.ib()
+
+
+def parse_import_times(text):
+    import_times = []
+
+    for line in text.splitlines():
+        match = _import_time_pattern.match(line)
+        if match is None:
+            continue
+
+        name = match.group('name')
+        stripped = name.lstrip()
+
+        import_times.append(
+            ImportTime(
+                name=stripped,
+                depth=(len(name) - len(stripped) - 1) // 2,
+                self_microseconds=int(match.group('self')),
+                cumulative_microseconds=int(match.group('cumulative')),
+            ),
+        )
+
+    return import_times
+
+
+def command(arguments):
+    return [sys.executable, '-m', 'ciborg', *arguments]
+
+
+def environment():
+    # Make sure the subprocess measures this same copy of ciborg.
+    source = os.path.dirname(os.path.dirname(ciborg.__file__))
+    python_path = os.environ.get('PYTHONPATH')
+
+    return {
+        **os.environ,
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'PYTHONPATH': (
+            source
+            if python_path is None
+            else os.pathsep.join([source, python_path])
+        ),
+    }
+
+
+def measure_import_times(arguments):
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', *command(arguments)[1:]],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=environment(),
+        check=True,
+    )
+
+    return parse_import_times(completed.stderr)
+
+
+def measure_wall_clock(arguments, repeat):
+    durations = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            command(arguments),
+            stdout=subprocess.DEVNULL,
+            env=environment(),
+            check=True,
+        )
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+@click.command()
+@click.option('--repeat', default=10, show_default=True)
+@click.option(
+    '--top',
+    default=15,
+    show_default=True,
+    help='Number of top level imports to list by cumulative time.',
+)
+@click.option(
+    '--budget',
+    type=float,
+    default=None,
+    help='Fail if the median wall clock time exceeds this many seconds.',
+)
+@click.argument('arguments', nargs=-1)
+def cli(repeat, top, budget, arguments):
+    if len(arguments) == 0:
+        arguments = ('--help',)
+
+    import_times = measure_import_times(arguments)
+    top_level = sorted(
+        (
+            import_time
+            for import_time in import_times
+            if import_time.depth == 0
+        ),
+        key=lambda import_time: import_time.cumulative_microseconds,
+        reverse=True,
+    )
+
+    click.echo('cumulative [ms]  self [ms]  module')
+    for import_time in top_level[:top]:
+        click.echo('{:>15.1f}  {:>9.1f}  {}'.format(
+            import_time.cumulative_microseconds / 1000,
+            import_time.self_microseconds / 1000,
+            import_time.name,
+        ))
+
+    imported = {import_time.name for import_time in import_times}
+    unexpected = sorted(imported.intersection(deferred_modules))
+    if arguments == ('--help',) and len(unexpected) > 0:
+        raise click.ClickException(
+            'Unexpectedly imported: {}'.format(', '.join(unexpected)),
+        )
+
+    durations = measure_wall_clock(arguments=arguments, repeat=repeat)
+    median = statistics.median(durations)
+    click.echo('wall clock [s]: median {:.3f}, min {:.3f}, max {:.3f}'.format(
+        median,
+        min(durations),
+        max(durations),
+    ))
+
+    if budget is not None and median > budget:
+        raise click.ClickException(
+            'Median startup of {:.3f}s exceeds the budget of {:.3f}s'.format(
+                median,
+                budget,
+            ),
+        )
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,12 +1,74 @@
+import functools
+import importlib
+import io
 import json
 import os
 import pathlib
+import sys
 
 import click
 
-import ciborg.configuration
-import ciborg.azure
-import ciborg.github
+import ciborg.output
+import ciborg.profiling
+
+
+# The backends, and through them marshmallow, yaml and the rest, are only
+# imported once a command actually needs them so that --help and the
+# fingerprint --check fast path start quickly.
+backends = {
+    'azure': {
+        'module': 'ciborg.azure',
+        'lower': 'lower_pipeline',
+        'dump': 'dump_pipeline',
+        'stream': 'stream_pipeline',
+    },
+    'github': {
+        'module': 'ciborg.github',
+        'lower': 'lower_workflow',
+        'dump': 'dump_workflow',
+        'stream': 'stream_workflow',
+    },
+}
+
+
+default_outputs = {
+    'azure': 'azure-pipelines.yml',
+    'github': '.github/workflows/ci.yml',
+}
+
+
+def load_backend(name):
+    names = backends[name]
+    module = importlib.import_module(names['module'])
+
+    return {
+        key: getattr(module, value)
+        for key, value in names.items()
+        if key != 'module'
+    }
+
+
+def parse_configuration(configuration_file):
+    with ciborg.profiling.phase('parse'):
+        return json.load(configuration_file)
+
+
+def load_configuration(marshalled):
+    configuration_module = importlib.import_module('ciborg.configuration')
+
+    with ciborg.profiling.phase('load'):
+        return configuration_module.load_marshalled(marshalled)
+
+
+def create_intermediate(configuration, configuration_path, lazy):
+    intermediate = importlib.import_module('ciborg.intermediate')
+
+    with ciborg.profiling.phase('build'):
+        return intermediate.create_pipeline(
+            configuration=configuration,
+            configuration_path=configuration_path,
+            lazy=lazy,
+        )
 
 
 @click.group()
@@ -14,73 +76,667 @@ def cli():
     pass
 
 
+def configuration_option():
+    return click.option(
+        '--configuration',
+        'configuration_file',
+        type=click.File(mode='r'),
+        default='ciborg.json',
+        show_default=True,
+    )
+
+
+def output_option(default):
+    return click.option(
+        '--output',
+        'output_name',
+        type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+        default=default,
+        show_default=True,
+    )
+
+
+def stream_option():
+    return click.option(
+        '--stream/--no-stream',
+        default=False,
+        show_default=True,
+        help='Create and write the jobs one at a time to limit memory use.',
+    )
+
+
+def fingerprint_option():
+    return click.option(
+        '--fingerprint/--no-fingerprint',
+        default=None,
+        help=(
+            'Embed a hash of the configuration, ciborg version and output'
+            ' path as the first line of the output.  By default when the'
+            ' configuration sets fingerprint or the existing output already'
+            ' has the header.'
+        ),
+    )
+
+
+def check_options(function):
+    function = click.option(
+        '--full-check',
+        is_flag=True,
+        help='Like --check but always regenerate and compare the content.',
+    )(function)
+    function = click.option(
+        '--check',
+        is_flag=True,
+        help=(
+            'Exit with a failure if the output is not up to date instead of'
+            ' writing it.  A matching fingerprint header is trusted without'
+            ' regenerating.'
+        ),
+    )(function)
+
+    return function
+
+
+def profile_options(function):
+    @click.option(
+        '--profile',
+        is_flag=True,
+        help=(
+            'Report the wall time and allocations of each phase on stderr.'
+        ),
+    )
+    @click.option(
+        '--profile-report',
+        type=click.File(mode='w'),
+        default=None,
+        help='Write the phase timings as JSON.  Implies --profile.',
+    )
+    @click.option(
+        '--profile-stats',
+        type=click.Path(dir_okay=False, writable=True),
+        default=None,
+        help='Write cProfile statistics for pstats.  Implies --profile.',
+    )
+    @functools.wraps(function)
+    def wrapper(*args, profile, profile_report, profile_stats, **kwargs):
+        if not (profile or profile_report or profile_stats):
+            return function(*args, **kwargs)
+
+        with ciborg.profiling.profile(stats_path=profile_stats) as profiler:
+            result = function(*args, **kwargs)
+
+        click.echo(profiler.format(), err=True)
+        if profile_report is not None:
+            profiler.dump_report(profile_report)
+
+        return result
+
+    return wrapper
+
+
+def generate_output(
+        backend,
+        marshalled,
+        configuration_path,
+        output_name,
+        stream,
+        fingerprint,
+        check,
+        full_check,
+        get_intermediate,
+):
+    to_stdout = output_name == '-'
+    output_path = pathlib.Path(
+        output_name
+        if to_stdout
+        else os.path.relpath(output_name, configuration_path.parent),
+    )
+
+    if fingerprint is None:
+        # Regenerating, such as in the verify job, keeps the header of an
+        # output that was fingerprinted when written.
+        fingerprint = marshalled.get('fingerprint') is True or (
+            not to_stdout
+            and ciborg.output.read_fingerprint(output_name) is not None
+        )
+
+    header = ''
+    if fingerprint or check or full_check:
+        expected_fingerprint = ciborg.output.fingerprint(
+            marshalled=marshalled,
+            backend=backend,
+            output_path=output_path,
+        )
+        if fingerprint:
+            header = ciborg.output.create_header(expected_fingerprint)
+
+    if check and not full_check and not to_stdout:
+        existing_fingerprint = ciborg.output.read_fingerprint(output_name)
+        if existing_fingerprint is not None:
+            if existing_fingerprint != expected_fingerprint:
+                raise click.ClickException(
+                    'Fingerprint mismatch, {} is out of date'.format(
+                        output_name,
+                    ),
+                )
+
+            return None
+
+    loaded_backend = load_backend(backend)
+
+    intermediate = get_intermediate(lazy=stream)
+    with ciborg.profiling.phase('lower'):
+        model = loaded_backend['lower'](
+            pipeline=intermediate,
+            output_path=output_path,
+            lazy=stream,
+        )
+
+    if stream:
+        # The jobs are built, lowered and emitted one at a time while
+        # writing so all of that is recorded as emitting.
+        def write(file):
+            file.write(header)
+
+            with ciborg.profiling.phase('emit'):
+                loaded_backend['stream'](model, file)
+    else:
+        dumped = header + loaded_backend['dump'](model)
+
+        def write(file):
+            with ciborg.profiling.phase('write'):
+                file.write(dumped)
+
+    if check or full_check:
+        buffer = io.StringIO()
+        write(buffer)
+
+        if buffer.getvalue() != ciborg.output.read_text(output_name):
+            raise click.ClickException(
+                '{} is out of date'.format(output_name),
+            )
+    elif to_stdout:
+        write(sys.stdout)
+    else:
+        return ciborg.output.write_if_changed(path=output_name, write=write)
+
+    return None
+
+
+def generate_single_output(backend, configuration_file, **kwargs):
+    marshalled = parse_configuration(configuration_file)
+    configuration_path = pathlib.Path(configuration_file.name)
+
+    def get_intermediate(lazy):
+        return create_intermediate(
+            configuration=load_configuration(marshalled),
+            configuration_path=configuration_path,
+            lazy=lazy,
+        )
+
+    generate_output(
+        backend=backend,
+        marshalled=marshalled,
+        configuration_path=configuration_path,
+        get_intermediate=get_intermediate,
+        **kwargs,
+    )
+
+
+@cli.command()
+@configuration_option()
+@output_option(default=default_outputs['azure'])
+@stream_option()
+@fingerprint_option()
+@check_options
+@profile_options
+def azure(
+        configuration_file,
+        output_name,
+        stream,
+        fingerprint,
+        check,
+        full_check,
+):
+    generate_single_output(
+        backend='azure',
+        configuration_file=configuration_file,
+        output_name=output_name,
+        stream=stream,
+        fingerprint=fingerprint,
+        check=check,
+        full_check=full_check,
+    )
+
+
+@cli.command()
+@configuration_option()
+@output_option(default=default_outputs['github'])
+@stream_option()
+@fingerprint_option()
+@check_options
+@profile_options
+def github(
+        configuration_file,
+        output_name,
+        stream,
+        fingerprint,
+        check,
+        full_check,
+):
+    generate_single_output(
+        backend='github',
+        configuration_file=configuration_file,
+        output_name=output_name,
+        stream=stream,
+        fingerprint=fingerprint,
+        check=check,
+        full_check=full_check,
+    )
+
+
+@cli.command()
+@configuration_option()
+@stream_option()
+@fingerprint_option()
+@check_options
+@profile_options
+def generate(
+        configuration_file,
+        stream,
+        fingerprint,
+        check,
+        full_check,
+):
+    """Write every output listed in the configuration from a single load."""
+    marshalled = parse_configuration(configuration_file)
+    configuration_path = pathlib.Path(configuration_file.name)
+    configuration = load_configuration(marshalled)
+
+    if len(configuration.outputs) == 0:
+        raise click.ClickException(
+            'No outputs configured in {}'.format(configuration_path),
+        )
+
+    unknown = sorted(
+        {output.backend for output in configuration.outputs} - set(backends),
+    )
+    if len(unknown) > 0:
+        raise click.ClickException(
+            'Unknown backends: {}'.format(', '.join(unknown)),
+        )
+
+    cache = {}
+
+    def get_intermediate(lazy):
+        # Shared by every output so the jobs are only built once.
+        if 'intermediate' not in cache:
+            cache['intermediate'] = create_intermediate(
+                configuration=configuration,
+                configuration_path=configuration_path,
+                lazy=False,
+            )
+
+        return cache['intermediate']
+
+    for output in configuration.outputs:
+        generate_output(
+            backend=output.backend,
+            marshalled=marshalled,
+            configuration_path=configuration_path,
+            output_name=str(configuration_path.parent / output.path),
+            stream=stream,
+            fingerprint=fingerprint,
+            check=check,
+            full_check=full_check,
+            get_intermediate=get_intermediate,
+        )
+
+
 @cli.command()
+@click.argument(
+    'roots',
+    nargs=-1,
+    type=click.Path(exists=True, file_okay=False),
+)
 @click.option(
-    '--configuration',
-    'configuration_file',
+    '--manifest',
     type=click.File(mode='r'),
+    default=None,
+    help=(
+        'File listing one configuration path per line, relative to the'
+        ' manifest.  Used instead of searching the roots.'
+    ),
+)
+@click.option(
+    '--name',
     default='ciborg.json',
     show_default=True,
+    help='Configuration file name to search for under the roots.',
 )
 @click.option(
-    '--output',
-    'output_file',
-    type=click.File(mode='w', atomic=True),
-    default='azure-pipelines.yml',
-    show_default=True,
+    '--backend',
+    'default_backends',
+    type=click.Choice(sorted(backends)),
+    multiple=True,
+    help=(
+        'Generate this backend at its default path for configurations'
+        ' without outputs.  Such configurations are skipped otherwise.'
+    ),
+)
+@click.option(
+    '--jobs',
+    type=click.IntRange(min=1),
+    default=None,
+    help='Number of worker processes, the CPU count by default.',
+)
+@click.option(
+    '--report',
+    type=click.File(mode='w'),
+    default=None,
+    help='Write the per configuration results as JSON.',
+)
+@click.option(
+    '--root',
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help=(
+        'Repository root the generated verify jobs run from.  The enclosing'
+        ' git repository of each configuration by default.'
+    ),
 )
-def azure(configuration_file, output_file):
-    marshalled = json.load(configuration_file)
+@fingerprint_option()
+@check_options
+def fleet(
+        roots,
+        manifest,
+        name,
+        default_backends,
+        jobs,
+        report,
+        root,
+        fingerprint,
+        check,
+        full_check,
+):
+    """Generate the outputs of many configurations in one process pool."""
+    import ciborg.fleet
 
-    configuration = ciborg.configuration.ConfigurationSchema().load(
-        marshalled,
-    )
+    if manifest is not None:
+        configuration_paths = ciborg.fleet.read_manifest(manifest)
+    else:
+        configuration_paths = ciborg.fleet.discover(
+            roots=[pathlib.Path(root) for root in roots or ['.']],
+            name=name,
+        )
 
-    configuration_path = pathlib.Path(configuration_file.name)
-    output_path = pathlib.Path(
-        os.path.relpath(output_file.name, configuration_path.parent),
+    results = ciborg.fleet.run(
+        configuration_paths=configuration_paths,
+        default_backends=default_backends,
+        jobs=jobs,
+        fingerprint=fingerprint,
+        check=check,
+        full_check=full_check,
+        root=None if root is None else pathlib.Path(root),
     )
 
-    pipeline = ciborg.azure.create_pipeline(
-        configuration=configuration,
-        configuration_path=configuration_path,
-        output_path=output_path,
+    for result in results:
+        click.echo(result.format())
+
+    failed = [result for result in results if result.error is not None]
+    changed = [result for result in results if len(result.changed) > 0]
+    click.echo(
+        '{total} configurations: {changed} changed, {failed} failed,'
+        ' {seconds:.2f}s total worker time'.format(
+            total=len(results),
+            changed=len(changed),
+            failed=len(failed),
+            seconds=sum(result.seconds for result in results),
+        ),
     )
-    dumped_pipeline = ciborg.azure.dump_pipeline(pipeline=pipeline)
-    output_file.write(dumped_pipeline)
+
+    if report is not None:
+        ciborg.fleet.dump_report(results=results, file=report)
+
+    if len(failed) > 0:
+        raise click.ClickException(
+            '{} configurations failed'.format(len(failed)),
+        )
+
+
+def parse_junit(context, parameter, value):
+    junit = []
+    for item in value:
+        key, separator, path = item.rpartition('=')
+        if separator == '':
+            key = pathlib.Path(path).stem
+
+        junit.append((key, pathlib.Path(path)))
+
+    return junit
+
+
+def timings_options(function):
+    function = click.option(
+        '--junit',
+        multiple=True,
+        callback=parse_junit,
+        help=(
+            'JUnit XML report of an environment as KEY=PATH, or just PATH'
+            ' when the file is named after the key.  Keys are the'
+            ' environment identifiers used for matrix legs, such as'
+            ' typehints_linux_cpython_3_8.'
+        ),
+    )(function)
+    function = click.option(
+        '--timings',
+        'timings_files',
+        type=click.File(mode='r'),
+        multiple=True,
+        help='JSON history of the environment and test file durations.',
+    )(function)
+
+    return function
+
+
+def load_timings(timings_files, junit):
+    import xml.etree.ElementTree
+
+    import marshmallow
+
+    import ciborg.timings
+
+    try:
+        return ciborg.timings.merge_all([
+            *(
+                ciborg.timings.load_json(timings_file)
+                for timings_file in timings_files
+            ),
+            *(ciborg.timings.load_junit(path, key=key) for key, path in junit),
+        ])
+    except (
+            json.JSONDecodeError,
+            xml.etree.ElementTree.ParseError,
+            marshmallow.ValidationError,
+            OSError,
+    ) as e:
+        raise click.ClickException(str(e)) from e
 
 
 @cli.command()
+@configuration_option()
+@timings_options
 @click.option(
-    '--configuration',
-    'configuration_file',
-    type=click.File(mode='r'),
-    default='ciborg.json',
-    show_default=True,
+    '--runners',
+    type=click.IntRange(min=1),
+    required=True,
+    help='Number of jobs that can run at once.',
 )
 @click.option(
-    '--output',
-    'output_file',
-    type=click.File(mode='w', atomic=True),
-    default='.github/workflows/ci.yml',
+    '--job-overhead',
+    type=click.FloatRange(min=0),
+    default=0,
     show_default=True,
+    help='Seconds each job spends before testing, such as on setup.',
 )
-def github(configuration_file, output_file):
-    marshalled = json.load(configuration_file)
+@click.option(
+    '--write',
+    is_flag=True,
+    help='Record the planned shards and packs in the configuration.',
+)
+def plan(
+        configuration_file,
+        timings_files,
+        junit,
+        runners,
+        job_overhead,
+        write,
+):
+    """Predict the makespan of the test jobs from recorded durations and
+    choose the environments to shard or pack to shorten it.
+    """
+    import ciborg.planning
 
-    configuration = ciborg.configuration.ConfigurationSchema().load(
-        marshalled,
+    marshalled = parse_configuration(configuration_file)
+    configuration = load_configuration(marshalled)
+
+    planned = ciborg.planning.plan(
+        test_environments=configuration.test_environments,
+        timings=load_timings(timings_files=timings_files, junit=junit),
+        runners=runners,
+        job_overhead=job_overhead,
     )
 
+    click.echo(planned.format())
+
+    if write:
+        def write_configuration(file):
+            json.dump(planned.apply(marshalled), file, indent=4)
+            file.write('\n')
+
+        ciborg.output.write_if_changed(
+            path=configuration_file.name,
+            write=write_configuration,
+        )
+
+
+def parse_runners(context, parameter, value):
+    runners = {}
+    for item in value:
+        vm_image, separator, count = item.rpartition('=')
+        try:
+            runners[vm_image] = int(count)
+        except ValueError:
+            runners[vm_image] = 0
+
+        if separator == '' or runners[vm_image] < 1:
+            raise click.BadParameter(
+                'Expected IMAGE=COUNT with a positive count: {}'.format(item),
+            )
+
+    return runners
+
+
+@cli.command()
+@configuration_option()
+@timings_options
+@click.option(
+    '--default-seconds',
+    type=click.FloatRange(min=0),
+    default=60,
+    show_default=True,
+    help='Seconds assumed for jobs without recorded timings.',
+)
+@click.option(
+    '--runners',
+    multiple=True,
+    callback=parse_runners,
+    help=(
+        'Runners available for a VM image as IMAGE=COUNT, such as'
+        ' ubuntu-latest=4.  Images not listed have unlimited runners.'
+    ),
+)
+def analyze(
+        configuration_file,
+        timings_files,
+        junit,
+        default_seconds,
+        runners,
+):
+    """Report the job graph, its critical path and the makespan of running
+    it on the given runners.
+    """
+    import ciborg.graph
+
     configuration_path = pathlib.Path(configuration_file.name)
-    output_path = pathlib.Path(
-        os.path.relpath(output_file.name, configuration_path.parent),
+    pipeline = create_intermediate(
+        configuration=load_configuration(
+            parse_configuration(configuration_file),
+        ),
+        configuration_path=configuration_path,
+        lazy=False,
     )
 
-    workflow = ciborg.github.create_workflow(
-        configuration=configuration,
-        configuration_path=configuration_path,
-        output_path=output_path,
+    analysis = ciborg.graph.analyze(
+        pipeline=pipeline,
+        timings=load_timings(timings_files=timings_files, junit=junit),
+        default_seconds=default_seconds,
+        runners=runners,
     )
-    dumped_pipeline = ciborg.github.dump_workflow(pipeline=workflow)
-    output_file.write(dumped_pipeline)
+
+    click.echo(analysis.format())
+
+
+@cli.command()
+@click.option(
+    '--output',
+    type=click.Path(dir_okay=False),
+    default='ciborg.pyz',
+    show_default=True,
+    help='Path to write the zipapp to.',
+)
+@click.option(
+    '--requirement',
+    'requirements',
+    multiple=True,
+    help=(
+        'Requirement to install into the zipapp, this version of ciborg by'
+        ' default.  May be a local path such as a checkout of ciborg.'
+    ),
+)
+@click.option(
+    '--constraint',
+    'constraints',
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    help=(
+        'Constraints file for the dependencies, such as a lock file.  By'
+        ' default they are pinned to the versions installed with this'
+        ' ciborg.'
+    ),
+)
+def zipapp(output, requirements, constraints):
+    """Build ciborg and its pure Python dependencies into a single file
+    that CI jobs can run without installing anything.
+    """
+    import subprocess
+
+    import ciborg
+    import ciborg.pyz
+
+    if len(requirements) == 0:
+        requirements = ['ciborg=={}'.format(ciborg.__version__)]
+
+    try:
+        removed = ciborg.pyz.build(
+            requirements=requirements,
+            output=pathlib.Path(output),
+            constraints=[pathlib.Path(path) for path in constraints] or None,
+        )
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise click.ClickException(str(e)) from e
+
+    for path in removed:
+        click.echo('Left out compiled module: {}'.format(path.as_posix()))
+
+    click.echo('Wrote {}'.format(output))
@@ -5,6 +5,8 @@ import marshmallow
 import marshmallow.fields
 import marshmallow.validate
 
+from pyrsistent import pmap
+
 import ciborg
 
 
@@ -19,7 +21,7 @@ def create_one_of_string(choices, missing=_NOTHING):
         extras['missing'] = missing
 
     return marshmallow.fields.String(
-        validator=marshmallow.validate.OneOf(choices=choices),
+        validate=marshmallow.validate.OneOf(choices=choices),
         **extras,
     )
 
@@ -169,6 +171,12 @@ class EnvironmentSchema(marshmallow.Schema):
         missing=None,
     )
     tox_environment = marshmallow.fields.String(missing=None, allow_none=True)
+    tox_cache = marshmallow.fields.Boolean(missing=False)
+    shards = marshmallow.fields.Integer(
+        missing=1,
+        validate=marshmallow.validate.Range(min=1),
+    )
+    pack = marshmallow.fields.String(missing=None, allow_none=True)
 
     @marshmallow.decorators.post_load
     def post_load(self, data, partial, many):
@@ -187,15 +195,21 @@ class EnvironmentSchema(marshmallow.Schema):
         return Environment(**data)
 
 
-@attr.s
+@attr.s(frozen=True, slots=True)
 class Environment:
     platform = attr.ib()
     interpreter = attr.ib()
     version = attr.ib()
     install_source = attr.ib()
     tox_environment = attr.ib()
-
-    def identifier(self):
+    tox_cache = attr.ib(default=False)
+    shards = attr.ib(default=1)
+    # Environments sharing a pack name run one after another in one job.
+    pack = attr.ib(default=None)
+    _identifier = attr.ib(default=None, init=False, repr=False, eq=False)
+    _display_name = attr.ib(default=None, init=False, repr=False, eq=False)
+
+    def elements(self):
         elements = [
             self.platform,
             self.interpreter,
@@ -205,19 +219,51 @@ class Environment:
         if self.install_source is not None:
             elements.append(self.install_source)
 
-        return '_'.join(element.identifier_string for element in elements)
+        return elements
+
+    def identifier(self):
+        if self._identifier is None:
+            object.__setattr__(
+                self,
+                '_identifier',
+                '_'.join(
+                    element.identifier_string
+                    for element in self.elements()
+                ),
+            )
+
+        return self._identifier
 
     def display_name(self):
-        elements = [
-            self.platform,
-            self.interpreter,
-            self.version,
-        ]
+        if self._display_name is None:
+            object.__setattr__(
+                self,
+                '_display_name',
+                ' '.join(
+                    element.display_string
+                    for element in self.elements()
+                ),
+            )
 
-        if self.install_source is not None:
-            elements.append(self.install_source)
+        return self._display_name
 
-        return ' '.join(element.display_string for element in elements)
+
+class OutputSchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    backend = create_one_of_string(['azure', 'github'])
+    path = marshmallow.fields.String()
+
+    @marshmallow.decorators.post_load
+    def post_load(self, data, partial, many):
+        return Output(**data)
+
+
+@attr.s(frozen=True)
+class Output:
+    backend = attr.ib()
+    path = attr.ib()
 
 
 class ConfigurationSchema(marshmallow.Schema):
@@ -236,6 +282,19 @@ class ConfigurationSchema(marshmallow.Schema):
         marshmallow.fields.Nested(EnvironmentSchema()),
     )
     ciborg_requirement = marshmallow.fields.String(allow_none=True)
+    ciborg_zipapp = marshmallow.fields.String(allow_none=True)
+    outputs = marshmallow.fields.List(
+        marshmallow.fields.Nested(OutputSchema()),
+    )
+    matrix = marshmallow.fields.Boolean()
+    pip_cache = marshmallow.fields.Boolean()
+    lock_file = marshmallow.fields.String()
+    paths = marshmallow.fields.List(marshmallow.fields.String())
+    paths_ignore = marshmallow.fields.List(marshmallow.fields.String())
+    verify_only_when_changed = marshmallow.fields.Boolean()
+    cancel_superseded_runs = marshmallow.fields.Boolean()
+    fail_fast = marshmallow.fields.Boolean()
+    fingerprint = marshmallow.fields.Boolean()
 
     @marshmallow.decorators.post_load
     def post_load(self, data, partial, many):
@@ -252,6 +311,194 @@ class Configuration:
     ciborg_requirement = attr.ib(
         default='ciborg=={version}'.format(version=ciborg.__version__),
     )
+    # URL or repository path of a zipapp for the verify job to run instead
+    # of installing ciborg_requirement.
+    ciborg_zipapp = attr.ib(default=None)
+    outputs = attr.ib(factory=list)
+    matrix = attr.ib(default=False)
+    pip_cache = attr.ib(default=False)
+    # Formatted with the platform to locate the test requirements which key
+    # the pip cache.
+    lock_file = attr.ib(default='requirements/test.{platform}.txt')
+    # Patterns of the changed files that do or don't trigger the pipeline.
+    paths = attr.ib(factory=list)
+    paths_ignore = attr.ib(factory=list)
+    # Skip the verify job unless the configuration or output changed.
+    verify_only_when_changed = attr.ib(default=False)
+    # Drop runs for a branch or pull request once a newer commit is pushed.
+    cancel_superseded_runs = attr.ib(default=False)
+    # Cancel the remaining jobs once a test job fails.
+    fail_fast = attr.ib(default=False)
+    # Write a fingerprint header to the outputs and have the verify job
+    # trust a matching one rather than regenerating.
+    fingerprint = attr.ib(default=False)
+
+
+class _Unsupported(Exception):
+    """Raised by the compiled loader to hand the input to the schema."""
+
+
+def _string(value):
+    if type(value) is not str:
+        raise _Unsupported()
+
+    return value
+
+
+def _optional_string(value):
+    if value is None:
+        return None
+
+    return _string(value)
+
+
+def _boolean(value):
+    if type(value) is not bool:
+        raise _Unsupported()
+
+    return value
+
+
+def _positive_integer(value):
+    if type(value) is not int or value < 1:
+        raise _Unsupported()
+
+    return value
+
+
+def _one_of(lookup):
+    def load_one_of(value):
+        try:
+            return lookup[value]
+        except (KeyError, TypeError):
+            raise _Unsupported()
+
+    return load_one_of
+
+
+def _list_of(load_item):
+    def load_list(value):
+        if type(value) is not list:
+            raise _Unsupported()
+
+        return [load_item(item) for item in value]
+
+    return load_list
+
+
+def _object(factory, fields, optional=(), defaults=pmap()):
+    # Every field of the schema is optional to marshmallow, but a missing one
+    # without a default fails when building the object.  Those cases, like
+    # any other invalid input, are left to the schema for its error.
+    required = set(fields) - set(optional)
+
+    def load_object(value):
+        if type(value) is not dict or not required.issubset(value):
+            raise _Unsupported()
+
+        arguments = dict(defaults)
+        for key, item in value.items():
+            load_field = fields.get(key)
+            if load_field is None:
+                raise _Unsupported()
+
+            arguments[key] = load_field(item)
+
+        return factory(**arguments)
+
+    return load_object
+
+
+_load_environment = _object(
+    factory=Environment,
+    fields={
+        'platform': _one_of(platforms_by_identifier_string),
+        'interpreter': _one_of(interpreter_by_identifier_string),
+        'version': _one_of(python_version_by_identifier_string),
+        'install_source': _one_of(install_source_by_identifier_string),
+        'tox_environment': _optional_string,
+        'tox_cache': _boolean,
+        'shards': _positive_integer,
+        'pack': _optional_string,
+    },
+    optional=[
+        'install_source',
+        'tox_environment',
+        'tox_cache',
+        'shards',
+        'pack',
+    ],
+    defaults=pmap({
+        'install_source': None,
+        'tox_environment': None,
+        'tox_cache': False,
+        'shards': 1,
+        'pack': None,
+    }),
+)
+
+
+_load_output = _object(
+    factory=Output,
+    fields={
+        'backend': _one_of({'azure': 'azure', 'github': 'github'}),
+        'path': _string,
+    },
+)
+
+
+_load_configuration = _object(
+    factory=Configuration,
+    fields={
+        'name': _string,
+        'build_sdist': _boolean,
+        'build_wheel': _one_of({
+            'universal': 'universal',
+            'specific': 'specific',
+        }),
+        'tooling_environment': _load_environment,
+        'test_environments': _list_of(_load_environment),
+        'ciborg_requirement': _optional_string,
+        'ciborg_zipapp': _optional_string,
+        'outputs': _list_of(_load_output),
+        'matrix': _boolean,
+        'pip_cache': _boolean,
+        'lock_file': _string,
+        'paths': _list_of(_string),
+        'paths_ignore': _list_of(_string),
+        'verify_only_when_changed': _boolean,
+        'cancel_superseded_runs': _boolean,
+        'fail_fast': _boolean,
+        'fingerprint': _boolean,
+    },
+    optional=[
+        'ciborg_requirement',
+        'ciborg_zipapp',
+        'outputs',
+        'matrix',
+        'pip_cache',
+        'lock_file',
+        'paths',
+        'paths_ignore',
+        'verify_only_when_changed',
+        'cancel_superseded_runs',
+        'fail_fast',
+        'fingerprint',
+    ],
+)
+
+
+def load_marshalled(marshalled):
+    """Build a :class:`Configuration` from JSON compatible basic types.
+
+    Plain valid input is converted directly through the lookup tables.
+    Anything else goes through :class:`ConfigurationSchema` so errors are
+    reported exactly as before.
+    """
+    try:
+        return _load_configuration(marshalled)
+    except _Unsupported:
+        return ConfigurationSchema().load(marshalled)
 
 
 def marshal(configuration):
@@ -263,6 +510,6 @@ def marshal(configuration):
 def load(file):
     marshalled = json.load(file)
 
-    configuration = ConfigurationSchema().load(marshalled)
+    configuration = load_marshalled(marshalled)
 
     return configuration
@@ -0,0 +1,265 @@
+import concurrent.futures
+import importlib
+import json
+import os
+import pathlib
+import time
+
+import attr
+import click
+
+import ciborg.cli
+
+
+ignored_directories = {
+    '.git',
+    '.hg',
+    '.tox',
+    '.venv',
+    '__pycache__',
+    'build',
+    'dist',
+    'node_modules',
+    'venv',
+}
+
+
+def discover(roots, name):
+    found = []
+
+    for root in roots:
+        for directory, directories, files in os.walk(root):
+            directories[:] = sorted(
+                child
+                for child in directories
+                if child not in ignored_directories
+            )
+
+            if name in files:
+                found.append(pathlib.Path(directory) / name)
+
+    return found
+
+
+def read_manifest(file):
+    base = pathlib.Path(file.name).parent
+    paths = []
+
+    for line in file:
+        line = line.split('#', 1)[0].strip()
+        if len(line) > 0:
+            paths.append(base / line)
+
+    return paths
+
+
+def find_root(path):
+    """Return the enclosing git repository of ``path``, or None."""
+    for directory in pathlib.Path(path).absolute().parents:
+        # A file in worktrees and submodules, a directory otherwise.
+        if (directory / '.git').exists():
+            return directory
+
+    return None
+
+
+def relative_configuration_path(configuration_path, root=None):
+    """The configuration path as the generated verify job, which runs from
+    the repository root, has to pass it.
+    """
+    if root is None:
+        root = find_root(configuration_path)
+
+    if root is None:
+        return pathlib.Path(configuration_path.name)
+
+    return pathlib.Path(
+        os.path.relpath(
+            pathlib.Path(configuration_path).absolute(),
+            pathlib.Path(root).absolute(),
+        ),
+    )
+
+
+@attr.s(frozen=True)
+class Result:
+    configuration_path = attr.ib()
+    changed = attr.ib(factory=list)
+    unchanged = attr.ib(factory=list)
+    skipped = attr.ib(default=False)
+    error = attr.ib(default=None)
+    seconds = attr.ib(default=0)
+
+    def status(self):
+        if self.error is not None:
+            return 'failed'
+
+        if self.skipped:
+            return 'skipped'
+
+        if len(self.changed) > 0:
+            return 'changed'
+
+        return 'unchanged'
+
+    def format(self):
+        details = self.error if self.error is not None else ', '.join(
+            str(path) for path in self.changed
+        )
+
+        return '{status:<9} {seconds:>7.3f}s  {path}{details}'.format(
+            status=self.status(),
+            seconds=self.seconds,
+            path=self.configuration_path,
+            details='' if len(details) == 0 else '  ' + details,
+        )
+
+
+def initialize_worker():
+    # Pay for the heavy imports once per worker rather than per repository.
+    importlib.import_module('ciborg.configuration')
+    importlib.import_module('ciborg.intermediate')
+    for backend in ciborg.cli.backends:
+        ciborg.cli.load_backend(backend)
+
+
+def generate(
+        configuration_path,
+        default_backends,
+        fingerprint,
+        check,
+        full_check,
+        root=None,
+):
+    start = time.perf_counter()
+    changed = []
+    unchanged = []
+
+    try:
+        with open(configuration_path) as file:
+            marshalled = json.load(file)
+
+        configuration = ciborg.cli.load_configuration(marshalled)
+
+        outputs = [
+            (output.backend, output.path)
+            for output in configuration.outputs
+        ]
+        if len(outputs) == 0:
+            outputs = [
+                (backend, ciborg.cli.default_outputs[backend])
+                for backend in default_backends
+            ]
+
+        if len(outputs) == 0:
+            return Result(
+                configuration_path=configuration_path,
+                skipped=True,
+                seconds=time.perf_counter() - start,
+            )
+
+        cache = {}
+
+        def get_intermediate(lazy):
+            # Only built once an output needs generating, so checks that
+            # match the fingerprint skip it, and then shared by the outputs.
+            if 'intermediate' not in cache:
+                cache['intermediate'] = ciborg.cli.create_intermediate(
+                    configuration=configuration,
+                    configuration_path=relative_configuration_path(
+                        configuration_path=configuration_path,
+                        root=root,
+                    ),
+                    lazy=False,
+                )
+
+            return cache['intermediate']
+
+        for backend, path in outputs:
+            output_path = configuration_path.parent / path
+            output_changed = ciborg.cli.generate_output(
+                backend=backend,
+                marshalled=marshalled,
+                configuration_path=configuration_path,
+                output_name=str(output_path),
+                stream=False,
+                fingerprint=fingerprint,
+                check=check,
+                full_check=full_check,
+                get_intermediate=get_intermediate,
+            )
+
+            if output_changed:
+                changed.append(output_path)
+            else:
+                unchanged.append(output_path)
+    except click.ClickException as e:
+        error = e.format_message()
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    else:
+        error = None
+
+    return Result(
+        configuration_path=configuration_path,
+        changed=changed,
+        unchanged=unchanged,
+        error=error,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def run(
+        configuration_paths,
+        default_backends,
+        jobs,
+        fingerprint,
+        check,
+        full_check,
+        root=None,
+):
+    arguments = dict(
+        default_backends=default_backends,
+        fingerprint=fingerprint,
+        check=check,
+        full_check=full_check,
+        root=root,
+    )
+
+    if jobs == 1:
+        initialize_worker()
+
+        return [
+            generate(configuration_path=path, **arguments)
+            for path in configuration_paths
+        ]
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=initialize_worker,
+    ) as executor:
+        futures = [
+            executor.submit(generate, configuration_path=path, **arguments)
+            for path in configuration_paths
+        ]
+
+        return [future.result() for future in futures]
+
+
+def dump_report(results, file):
+    json.dump(
+        [
+            {
+                'configuration': str(result.configuration_path),
+                'status': result.status(),
+                'changed': [str(path) for path in result.changed],
+                'unchanged': [str(path) for path in result.unchanged],
+                'error': result.error,
+                'seconds': result.seconds,
+            }
+            for result in results
+        ],
+        file,
+        indent=4,
+    )
+    file.write('\n')
@@ -1,4 +1,5 @@
 import collections
+import functools
 import typing
 
 import attr
@@ -11,114 +12,556 @@ from pyrsistent import pvector, pmap
 
 import ciborg.azure
 import ciborg.configuration
-
-
-def create_tox_test_job(
-        build_job,
-        environment,
-        distribution_name,
-        distribution_type,
+import ciborg.intermediate
+import ciborg.profiling
+import ciborg.pyz
+import ciborg.serialization
+import ciborg.sharding
+
+
+def create_tox_step(
+        tox_environment,
+        install_distribution,
+        shard_index=None,
+        shard_count=None,
 ):
-    steps = pvector()
-
-    use_python_version_step = create_setup_python_action_step(
-        python_version=environment.version,
-        architecture='x64',
-    )
-    steps = steps.append(use_python_version_step)
-
-    checkout_step = create_checkout_action_step()
-    steps = steps.append(checkout_step)
-
-    if distribution_type is not None:
-        download_task_step = create_download_build_artifacts_action_step(
-            download_path='dist',
-            artifact_name='dist',
-        )
-        steps = steps.append(download_task_step)
-
-        select_dist_step = create_set_dist_file_path_task(
-            distribution_name=distribution_name,
-            distribution_type=distribution_type,
-        )
-        steps = steps.append(select_dist_step)
-
     tox_command = 'python -m tox'
 
-    if distribution_type is not None:
+    if install_distribution:
         tox_command += ''' --installpkg="${{ env['DIST_FILE_PATH'] }}"'''
 
-    bash_step = create_bash_step(
+    shard_commands = []
+    if shard_index is not None:
+        shard_commands = ciborg.sharding.commands(
+            index=shard_index,
+            count=shard_count,
+        )
+        tox_command += ciborg.sharding.posargs
+
+    return create_bash_step(
         name='Tox',
         commands=[
+            *shard_commands,
             'python -m pip install --quiet --upgrade pip setuptools wheel',
             'python -m pip install tox',
             tox_command,
         ],
         environment={
-            'TOXENV': environment.tox_env(),
+            'TOXENV': tox_environment,
         },
     )
-    steps = steps.append(bash_step)
 
-    id_pieces = [
-        'tox',
-        *(
-            []
-            if environment.tox_environment is None
-            else [environment.tox_environment]
+
+def create_generation_step(
+        configuration_path,
+        output_path,
+        ciborg_command='python -m ciborg',
+        check=False,
+):
+    generation_command_format = (
+        '{ciborg} github --configuration {configuration}'
+        + ' --output {output}'
+    )
+    if check:
+        generation_command_format += ' --check'
+
+    generation_command = generation_command_format.format(
+        ciborg=ciborg_command,
+        configuration=configuration_path,
+        output=configuration_path.parent / output_path,
+    )
+
+    return create_bash_step(
+        name='Generate',
+        commands=[
+            generation_command,
+        ],
+    )
+
+
+def matrix_expression(variable):
+    return 'matrix.{}'.format(variable.name)
+
+
+def matrix_reference(variable):
+    return '${{{{ {} }}}}'.format(matrix_expression(variable))
+
+
+def matrix_value(value, convert=str):
+    if isinstance(value, ciborg.intermediate.MatrixVariable):
+        return matrix_reference(value)
+
+    return convert(value)
+
+
+def python_version_string(version):
+    return matrix_value(version, lambda version: version.display_string)
+
+
+def lower_setup_python_step(step, output_path):
+    return create_setup_python_action_step(
+        python_version=python_version_string(step.version),
+        architecture=step.architecture,
+    )
+
+
+def lower_checkout_step(step, output_path):
+    return create_checkout_action_step(fetch_depth=step.fetch_depth)
+
+
+changes_step_id = 'changes'
+
+
+# The commit before a push, or the target branch of a pull request.
+changes_base = (
+    "${{ github.event_name == 'push' && github.event.before || 'HEAD^1' }}"
+)
+
+
+def lower_changes_step(step, output_path):
+    return attr.evolve(
+        create_bash_step(
+            name='Check for changes',
+            commands=[
+                *ciborg.intermediate.changes_commands(
+                    paths=step.all_paths(output_path),
+                    base=changes_base,
+                ),
+                'echo "{variable}=${{{variable}}}" >> "${{GITHUB_OUTPUT}}"'
+                .format(variable=ciborg.intermediate.changed_variable),
+            ],
         ),
-        environment.identifier_string,
+        id_name=changes_step_id,
+    )
+
+
+changed_condition = "steps.{}.outputs.{} == 'true'".format(
+    changes_step_id,
+    ciborg.intermediate.changed_variable,
+)
+
+
+def lower_run_step(step, output_path):
+    return create_bash_step(
+        name=step.name,
+        commands=step.commands,
+        environment=step.environment,
+    )
+
+
+def lower_generate_step(step, output_path):
+    if step.zipapp is None:
+        return create_generation_step(
+            configuration_path=step.configuration_path,
+            output_path=output_path,
+            check=step.check,
+        )
+
+    return create_generation_step(
+        configuration_path=step.configuration_path,
+        output_path=output_path,
+        ciborg_command='python {}'.format(zipapp_path(step.zipapp)),
+        check=step.check,
+    )
+
+
+def zipapp_path(zipapp):
+    if zipapp.is_url():
+        return zipapp_directory + '/ciborg.pyz'
+
+    return zipapp.location
+
+
+def lower_publish_artifact_step(step, output_path):
+    return create_publish_build_artifacts_task_step(
+        path_to_publish=step.path,
+        artifact_name=step.artifact_name,
+    )
+
+
+def lower_download_artifact_step(step, output_path):
+    return create_download_build_artifacts_action_step(
+        download_path=step.path,
+        artifact_name=step.artifact_name,
+    )
+
+
+def lower_select_distribution_step(step, output_path):
+    return create_set_dist_file_path_task(
+        distribution_name=step.distribution_name,
+        distribution_type=step.distribution_type,
+    )
+
+
+def hash_files(paths):
+    arguments = [
+        matrix_expression(path)
+        if isinstance(path, ciborg.intermediate.MatrixVariable)
+        else "'{}'".format(path)
+        for path in paths
     ]
 
-    display_pieces = [
-        'Tox',
-        *(
-            []
-            if environment.tox_environment is None
-            else [environment.tox_environment]
+    return '${{{{ hashFiles({}) }}}}'.format(', '.join(arguments))
+
+
+def lower_pip_cache_step(step, output_path):
+    prefix = 'pip-${{{{ runner.os }}}}-{}-'.format(
+        python_version_string(step.python_version),
+    )
+
+    return create_cache_action_step(
+        name='Cache pip',
+        path=pip_cache_directory,
+        key=prefix + hash_files([step.lock_file, 'tox.ini']),
+        restore_keys=[prefix],
+    )
+
+
+def lower_tox_environment_cache_step(step, output_path):
+    tox_environment = matrix_value(step.tox_environment)
+
+    return create_cache_action_step(
+        name='Cache tox environment',
+        path='.tox/{}'.format(tox_environment),
+        key='-'.join([
+            'tox',
+            '${{ runner.os }}',
+            python_version_string(step.python_version),
+            tox_environment,
+            # Missing files are ignored by hashFiles.
+            hash_files([*step.key_files, *step.optional_key_files]),
+        ]),
+    )
+
+
+def lower_zipapp_cache_step(step, output_path):
+    return create_cache_action_step(
+        name='Cache ciborg zipapp',
+        path=zipapp_directory,
+        key='ciborg-' + step.zipapp.location,
+    )
+
+
+def lower_fetch_zipapp_step(step, output_path):
+    return create_bash_step(
+        name='Fetch ciborg zipapp',
+        commands=ciborg.pyz.fetch_commands(
+            url=step.zipapp.location,
+            path=zipapp_path(step.zipapp),
         ),
-    ]
+    )
+
+
+def lower_tox_step(step, output_path):
+    return create_tox_step(
+        tox_environment=matrix_value(step.tox_environment),
+        install_distribution=step.install_distribution,
+        shard_index=(
+            None
+            if step.shard_index is None
+            else matrix_value(step.shard_index)
+        ),
+        shard_count=(
+            None
+            if step.shard_count is None
+            else matrix_value(step.shard_count)
+        ),
+    )
+
+
+step_lowerings = pmap({
+    ciborg.intermediate.SetupPythonStep: lower_setup_python_step,
+    ciborg.intermediate.CheckoutStep: lower_checkout_step,
+    ciborg.intermediate.RunStep: lower_run_step,
+    ciborg.intermediate.ChangesStep: lower_changes_step,
+    ciborg.intermediate.GenerateStep: lower_generate_step,
+    ciborg.intermediate.ZipappCacheStep: lower_zipapp_cache_step,
+    ciborg.intermediate.FetchZipappStep: lower_fetch_zipapp_step,
+    ciborg.intermediate.PublishArtifactStep: lower_publish_artifact_step,
+    ciborg.intermediate.DownloadArtifactStep: lower_download_artifact_step,
+    ciborg.intermediate.SelectDistributionStep: lower_select_distribution_step,
+    ciborg.intermediate.PipCacheStep: lower_pip_cache_step,
+    ciborg.intermediate.ToxEnvironmentCacheStep: (
+        lower_tox_environment_cache_step
+    ),
+    ciborg.intermediate.ToxStep: lower_tox_step,
+})
+
+
+# Steps are interned frozen values so the jobs of a pipeline mostly hit this
+# cache and share the lowered steps rather than building copies.
+@functools.lru_cache(maxsize=1024)
+def lower_step(step, output_path):
+    return step_lowerings[type(step)](step, output_path=output_path)
 
-    job = Job(
-        id_name='_'.join(id_pieces),
-        display_name='{} - {}'.format(
-            ' '.join(display_pieces),
-            environment.display_string,
+
+matrix_display_name_variable = ciborg.intermediate.MatrixVariable(
+    name='display_name',
+)
+matrix_vm_image = ciborg.azure.VmImage(
+    id_name=matrix_reference(ciborg.intermediate.vm_image_variable),
+    display_name=None,
+    platform=None,
+)
+
+
+aggregate_vm_image = ciborg.intermediate.vm_images[
+    ciborg.configuration.linux_platform
+]
+
+
+def create_check_needs_step():
+    # Skipped needs were not required by the event so only failures and
+    # cancellations fail the join.
+    return create_bash_step(
+        name='Check needed jobs',
+        commands=[
+            "results='${{ join(needs.*.result, ' ') }}'",
+            'echo "${results}"',
+            'for result in ${results}; do',
+            '    [ "${result}" = success ] || [ "${result}" = skipped ]'
+            ' || exit 1',
+            'done',
+        ],
+    )
+
+
+# The default token may be read only.
+cancel_run_permissions = collections.OrderedDict([
+    ('actions', 'write'),
+    ('contents', 'read'),
+])
+
+
+def create_cancel_run_step():
+    # fail-fast only cancels the other legs of the same matrix so the whole
+    # run is cancelled through the API instead.  The token needs
+    # cancel_run_permissions.
+    return attr.evolve(
+        create_bash_step(
+            name='Cancel workflow run',
+            commands=[
+                'gh run cancel ${{ github.run_id }}'
+                ' --repo ${{ github.repository }}',
+            ],
+            environment={'GH_TOKEN': '${{ github.token }}'},
         ),
+        condition='failure()',
+    )
+
+
+def lower_job(job, output_path):
+    steps = pvector()
+    condition = None
+
+    for step in job.steps:
+        lowered = lower_step(step, output_path=output_path)
+        if lowered is not None:
+            if condition is not None:
+                lowered = attr.evolve(lowered, condition=condition)
+
+            steps = steps.append(lowered)
+
+        if isinstance(step, ciborg.intermediate.ChangesStep):
+            condition = changed_condition
+
+    if job.aggregate:
+        # Runs even when needs fail, which would skip it otherwise, so that
+        # it fails itself and reports them.
+        return Job(
+            id_name=job.id_name,
+            display_name=job.display_name,
+            runs_on=aggregate_vm_image,
+            needs=job.needs,
+            condition='always()',
+            steps=[create_check_needs_step()],
+        )
+
+    if job.matrix is None:
+        display_name = job.display_name
+        vm_image = job.environment.vm_image
+        strategy = None
+    else:
+        display_name = '{} - {}'.format(
+            job.display_name,
+            matrix_reference(matrix_display_name_variable),
+        )
+        vm_image = matrix_vm_image
+        strategy = Strategy(
+            # Explicit since GitHub defaults to cancelling the other legs,
+            # which separate jobs never did.
+            fail_fast=job.fail_fast,
+            matrix=Matrix(
+                include=[
+                    collections.OrderedDict([
+                        (matrix_display_name_variable.name, leg.display_name),
+                        *leg.variables().items(),
+                    ])
+                    for leg in job.matrix
+                ],
+            ),
+        )
+
+    environment = None
+    if any(
+            isinstance(step, ciborg.intermediate.PipCacheStep)
+            for step in job.steps
+    ):
+        # Pointed at the cached directory for every step, tox included.
+        environment = {'PIP_CACHE_DIR': pip_cache_directory}
+
+    permissions = None
+    if job.fail_fast:
+        steps = steps.append(create_cancel_run_step())
+        permissions = cancel_run_permissions
+
+    return Job(
+        id_name=job.id_name,
+        display_name=display_name,
         steps=steps,
-        needs=[] if build_job is None else [build_job],
-        runs_on=environment.vm_image,
+        needs=job.needs,
+        runs_on=vm_image,
+        strategy=strategy,
+        environment=environment,
+        permissions=permissions,
     )
 
-    return job
 
+def create_path_filters(paths, paths_ignore, required_paths):
+    if len(paths) == 0 and len(paths_ignore) == 0:
+        return {}
+
+    # An event can't have both paths and paths-ignore so the ignored ones
+    # are negated instead.  The last matching pattern wins so the required
+    # paths come last to be included even if ignored.
+    return {
+        'paths': [
+            *(paths if len(paths) > 0 else ['**']),
+            *('!' + pattern for pattern in paths_ignore),
+            *required_paths,
+        ],
+    }
+
+
+def lower_workflow(pipeline, output_path, lazy=False):
+    path_filters = create_path_filters(
+        paths=pipeline.paths,
+        paths_ignore=pipeline.paths_ignore,
+        required_paths=pipeline.required_paths(output_path=output_path),
+    )
+
+    jobs = (
+        lower_job(job=job, output_path=output_path)
+        for job in pipeline.jobs
+    )
+
+    if not lazy:
+        jobs = pvector(jobs)
+
+    return Workflow(
+        name='CI',
+        on=On(
+            push=Push(branches=['master'], tags=['v*'], **path_filters),
+            pull_request=PullRequest(branches=['*'], **path_filters),
+        ),
+        concurrency=(
+            superseded_concurrency if pipeline.cancel_superseded else None
+        ),
+        jobs=jobs,
+    )
+
+
+def create_workflow(
+        configuration,
+        configuration_path,
+        output_path,
+        lazy=False,
+):
+    pipeline = ciborg.intermediate.create_pipeline(
+        configuration=configuration,
+        configuration_path=configuration_path,
+        lazy=lazy,
+    )
 
-def dump_workflow(pipeline):
-    basic_types = WorkflowSchema().dump(pipeline)
-    dumped = yaml.dump(
-        basic_types,
-        sort_keys=False,
-        Dumper=ciborg.azure.TidyOrderedDictDumper,
+    return lower_workflow(
+        pipeline=pipeline,
+        output_path=output_path,
+        lazy=lazy,
     )
 
+
+def marshal_workflow(pipeline):
+    with ciborg.serialization.memoized():
+        return ciborg.serialization.serializer(WorkflowSchema)(pipeline)
+
+
+def dump_workflow(pipeline, dumper=None):
+    if dumper is None:
+        dumper = ciborg.azure.default_dumper
+
+    with ciborg.profiling.phase('marshal'):
+        basic_types = marshal_workflow(pipeline)
+
+    with ciborg.profiling.phase('emit'):
+        dumped = yaml.dump(
+            basic_types,
+            sort_keys=False,
+            Dumper=dumper,
+            width=ciborg.azure.dump_width,
+        )
+
     return dumped
 
 
+def stream_workflow(pipeline, stream, dumper=None):
+    emitter = ciborg.azure.open_event_stream(stream=stream, dumper=dumper)
+    serialize_job = ciborg.serialization.serializer(JobSchema)
+
+    with ciborg.serialization.memoized(
+            maxsize=ciborg.serialization.streaming_memo_size,
+    ):
+        # The jobs are the last field of the workflow schema so they can be
+        # emitted after the rest of the mapping.
+        ciborg.azure.emit_mapping_start(emitter)
+        shell = marshal_workflow(attr.evolve(pipeline, jobs=pvector()))
+        for key, value in shell.items():
+            ciborg.azure.emit_scalar(emitter, key)
+            ciborg.azure.emit_data(emitter, value)
+
+        ciborg.azure.emit_scalar(emitter, 'jobs')
+        ciborg.azure.emit_mapping_start(emitter)
+        for job in pipeline.jobs:
+            serialized = serialize_job(job)
+            ciborg.azure.emit_scalar(emitter, serialized.pop('id_name'))
+            ciborg.azure.emit_data(emitter, serialized)
+        ciborg.azure.emit_mapping_end(emitter)
+
+        ciborg.azure.emit_mapping_end(emitter)
+
+    ciborg.azure.close_event_stream(emitter)
+
+
 class PushSchema(marshmallow.Schema):
     class Meta:
         ordered = True
 
     branches = marshmallow.fields.List(marshmallow.fields.String)
     tags = marshmallow.fields.List(marshmallow.fields.String)
+    paths = marshmallow.fields.List(marshmallow.fields.String)
+    paths_ignore = marshmallow.fields.List(
+        marshmallow.fields.String,
+        data_key='paths-ignore',
+    )
 
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Push:
     branches = attr.ib()
     tags = attr.ib()
+    paths = attr.ib(default=pvector(), converter=pvector)
+    paths_ignore = attr.ib(default=pvector(), converter=pvector)
 
 
 class PullRequestSchema(marshmallow.Schema):
@@ -126,13 +569,20 @@ class PullRequestSchema(marshmallow.Schema):
         ordered = True
 
     branches = marshmallow.fields.List(marshmallow.fields.String)
+    paths = marshmallow.fields.List(marshmallow.fields.String)
+    paths_ignore = marshmallow.fields.List(
+        marshmallow.fields.String,
+        data_key='paths-ignore',
+    )
 
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class PullRequest:
     branches = attr.ib()
+    paths = attr.ib(default=pvector(), converter=pvector)
+    paths_ignore = attr.ib(default=pvector(), converter=pvector)
 
 
 class OnSchema(marshmallow.Schema):
@@ -145,7 +595,7 @@ class OnSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class On:
     push = attr.ib()
     pull_request = attr.ib()
@@ -161,7 +611,7 @@ class SetupPythonActionWithSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class SetupPythonActionWith:
     python_version = attr.ib()
     architecture = attr.ib()
@@ -177,7 +627,7 @@ class UploadArtifactsActionStepSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class UploadArtifactsActionStep:
     name = attr.ib()
     path = attr.ib()
@@ -193,7 +643,7 @@ class DownloadArtifactActionStepSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class DownloadArtifactActionStep:
     name = attr.ib()
     path = attr.ib()
@@ -203,12 +653,38 @@ class CheckoutActionStepSchema(marshmallow.Schema):
     class Meta:
         ordered = True
 
+    fetch_depth = marshmallow.fields.Integer(
+        data_key='fetch-depth',
+        allow_none=True,
+    )
+
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class CheckoutActionStep:
-    pass
+    fetch_depth = attr.ib(default=None)
+
+
+class CacheActionWithSchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    path = marshmallow.fields.String()
+    key = marshmallow.fields.String()
+    restore_keys = marshmallow.fields.String(
+        data_key='restore-keys',
+        allow_none=True,
+    )
+
+    post_dump = ciborg.azure.post_dump_remove_skip_values
+
+
+@attr.s(frozen=True, slots=True)
+class CacheActionWith:
+    path = attr.ib()
+    key = attr.ib()
+    restore_keys = attr.ib()
 
 
 task_step_inputs_type_schema_map = pmap({
@@ -216,6 +692,7 @@ task_step_inputs_type_schema_map = pmap({
     UploadArtifactsActionStep: UploadArtifactsActionStepSchema,
     DownloadArtifactActionStep: DownloadArtifactActionStepSchema,
     CheckoutActionStep: CheckoutActionStepSchema,
+    CacheActionWith: CacheActionWithSchema,
 })
 
 
@@ -228,6 +705,7 @@ class ActionStepSchema(marshmallow.Schema):
         ordered = True
 
     name = marshmallow.fields.String()
+    condition = marshmallow.fields.String(allow_none=True, data_key='if')
     uses = marshmallow.fields.String()
     with_ = marshmallow_polyfield.PolyField(
         serialization_schema_selector=(
@@ -239,11 +717,12 @@ class ActionStepSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class ActionStep:
     name = attr.ib()
     uses = attr.ib()
     with_ = attr.ib()
+    condition = attr.ib(default=None)
 
 
 def create_bash_step(name, commands, environment=pmap()):
@@ -260,6 +739,8 @@ class RunStepSchema(marshmallow.Schema):
         ordered = True
 
     name = marshmallow.fields.String()
+    id_name = marshmallow.fields.String(allow_none=True, data_key='id')
+    condition = marshmallow.fields.String(allow_none=True, data_key='if')
     shell = marshmallow.fields.String()
     run = marshmallow.fields.String()
     environment = marshmallow.fields.Dict(
@@ -271,7 +752,7 @@ class RunStepSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class RunStep:
     name = attr.ib()
     shell = attr.ib()
@@ -280,6 +761,8 @@ class RunStep:
         default=pmap(),
         converter=ciborg.azure.sorted_ordered_dict,
     )
+    id_name = attr.ib(default=None)
+    condition = attr.ib(default=None)
 
 
 step_type_schema_map = pmap({
@@ -292,6 +775,42 @@ def job_steps_serialization_schema_selector(base_object, parent_object):
     return step_type_schema_map[type(base_object)]()
 
 
+class MatrixSchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    include = marshmallow.fields.List(
+        ciborg.azure.OrderedDictField(
+            keys=marshmallow.fields.String(),
+            values=marshmallow.fields.String(),
+        ),
+    )
+
+
+@attr.s(frozen=True, slots=True)
+class Matrix:
+    include = attr.ib(converter=pvector)
+
+
+class StrategySchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    fail_fast = marshmallow.fields.Boolean(
+        data_key='fail-fast',
+        allow_none=True,
+    )
+    matrix = marshmallow.fields.Nested(MatrixSchema())
+
+    post_dump = ciborg.azure.post_dump_remove_skip_values
+
+
+@attr.s(frozen=True, slots=True)
+class Strategy:
+    matrix = attr.ib()
+    fail_fast = attr.ib(default=None)
+
+
 class JobSchema(marshmallow.Schema):
     class Meta:
         ordered = True
@@ -309,6 +828,19 @@ class JobSchema(marshmallow.Schema):
             field_name='id_name',
         ),
     )
+    condition = marshmallow.fields.String(allow_none=True, data_key='if')
+    permissions = ciborg.azure.OrderedDictField(
+        keys=marshmallow.fields.String(),
+        values=marshmallow.fields.String(),
+        allow_none=True,
+    )
+    strategy = marshmallow.fields.Nested(StrategySchema(), allow_none=True)
+    environment = ciborg.azure.OrderedDictField(
+        keys=marshmallow.fields.String(),
+        values=marshmallow.fields.String(),
+        allow_none=True,
+        data_key='env',
+    )
     steps = marshmallow.fields.List(
         marshmallow_polyfield.PolyField(
             serialization_schema_selector=(
@@ -326,7 +858,7 @@ class JobSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Job:
     id_name = attr.ib()
     display_name = attr.ib()
@@ -335,6 +867,10 @@ class Job:
     steps: pyrsistent.typing.PVector[
         typing.Union[ActionStep, RunStep],
     ] = attr.ib(default=pvector(), converter=pvector)
+    strategy = attr.ib(default=None)
+    environment = attr.ib(default=None)
+    condition = attr.ib(default=None)
+    permissions = attr.ib(default=None)
 
 
 # https://github.com/marshmallow-code/marshmallow/issues/483#issuecomment-229557880
@@ -357,12 +893,61 @@ class NestedDict(marshmallow.fields.Nested):
         return nested_list
 
 
+@ciborg.serialization.register_field_compiler(NestedDict)
+def compile_nested_dict(field):
+    serialize_item = ciborg.serialization.memoize(
+        ciborg.serialization.serializer(
+            ciborg.serialization.resolve_schema_class(field.nested),
+        ),
+    )
+    key = field.key
+
+    def serialize_nested_dict(value):
+        nested_dict = {}
+
+        for item in value:
+            # Copied since memoized results may be shared.
+            serialized = serialize_item(item).copy()
+            nested_dict[serialized.pop(key)] = serialized
+
+        return nested_dict
+
+    return serialize_nested_dict
+
+
+class ConcurrencySchema(marshmallow.Schema):
+    class Meta:
+        ordered = True
+
+    group = marshmallow.fields.String()
+    cancel_in_progress = marshmallow.fields.Boolean(
+        data_key='cancel-in-progress',
+    )
+
+
+@attr.s(frozen=True, slots=True)
+class Concurrency:
+    group = attr.ib()
+    cancel_in_progress = attr.ib()
+
+
+# Runs of the workflow for the same branch, tag or pull request.
+superseded_concurrency = Concurrency(
+    group='${{ github.workflow }}-${{ github.ref }}',
+    cancel_in_progress=True,
+)
+
+
 class WorkflowSchema(marshmallow.Schema):
     class Meta:
         ordered = True
 
     name = marshmallow.fields.String()
     on = marshmallow.fields.Nested(OnSchema())
+    concurrency = marshmallow.fields.Nested(
+        ConcurrencySchema(),
+        allow_none=True,
+    )
     jobs = NestedDict(
         nested=JobSchema(),
         key='id_name',
@@ -372,29 +957,30 @@ class WorkflowSchema(marshmallow.Schema):
     post_dump = ciborg.azure.post_dump_remove_skip_values
 
 
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Workflow:
     name = attr.ib()
     on = attr.ib()
     jobs = attr.ib()
+    concurrency = attr.ib(default=None)
 
 
 def create_setup_python_action_step(python_version, architecture):
     return ActionStep(
-        name='Set up CPython {}'.format(python_version.display_string),
+        name='Set up CPython {}'.format(python_version),
         uses='actions/setup-python@v1',
         with_=SetupPythonActionWith(
-            python_version=python_version.display_string,
+            python_version=python_version,
             architecture=architecture,
         ),
     )
 
 
-def create_checkout_action_step():
+def create_checkout_action_step(fetch_depth=None):
     return ActionStep(
         name='Checkout',
         uses='actions/checkout@v2',
-        with_=CheckoutActionStep(),
+        with_=CheckoutActionStep(fetch_depth=fetch_depth),
     )
 
 
@@ -420,6 +1006,22 @@ def create_download_build_artifacts_action_step(download_path, artifact_name):
     )
 
 
+pip_cache_directory = '~/.cache/ciborg-pip'
+zipapp_directory = '~/.cache/ciborg-zipapp'
+
+
+def create_cache_action_step(name, path, key, restore_keys=()):
+    return ActionStep(
+        name=name,
+        uses='actions/cache@v2',
+        with_=CacheActionWith(
+            path=path,
+            key=key,
+            restore_keys='\n'.join(restore_keys) or None,
+        ),
+    )
+
+
 def create_set_dist_file_path_task(distribution_name, distribution_type):
     if distribution_type == ciborg.configuration.sdist_install_source:
         # only_or_no_binary = '--no-binary :all:'
@@ -453,243 +1055,3 @@ def create_set_dist_file_path_task(distribution_name, distribution_type):
             set_variable_command,
         ],
     )
-
-
-def create_verify_up_to_date_job(
-        environment,
-        configuration_path,
-        output_path,
-        ciborg_requirement,
-):
-    setup_python_step = create_setup_python_action_step(
-        python_version=environment.version,
-        architecture='x64',
-    )
-
-    checkout_step = create_checkout_action_step()
-
-    installation_step = create_bash_step(
-        name='Install ciborg',
-        commands=[
-            'python -m pip install --upgrade pip setuptools',
-            'python -m pip install "{}"'.format(ciborg_requirement),
-        ],
-    )
-
-    generation_command_format = (
-        'python -m ciborg github --configuration {configuration}'
-        + ' --output {output}'
-    )
-    generation_command = generation_command_format.format(
-        configuration=configuration_path,
-        output=configuration_path.parent / output_path,
-    )
-
-    generation_step = create_bash_step(
-        name='Generate',
-        commands=[
-            generation_command,
-        ],
-    )
-
-    verification_step = create_bash_step(
-        name='Verify',
-        commands=[
-            '[ -z "$(git status --porcelain)" ]',
-        ],
-    )
-
-    job = Job(
-        id_name='verify_up_to_date',
-        display_name='Verify up to date',
-        steps=[
-            setup_python_step,
-            checkout_step,
-            installation_step,
-            generation_step,
-            verification_step,
-        ],
-        runs_on=environment.vm_image,
-    )
-
-    return job
-
-
-def create_sdist_job(environment):
-    use_python_version_step = create_setup_python_action_step(
-        python_version=environment.version,
-        architecture='x64',
-    )
-
-    checkout_step = create_checkout_action_step()
-
-    bash_step = create_bash_step(
-        name='Build',
-        commands=[
-            'python -m pip install --quiet --upgrade pip',
-            'python -m pip install --quiet --upgrade pep517',
-            'python -m pep517.build --source --out-dir dist/ .',
-        ],
-    )
-
-    publish_task_step = create_publish_build_artifacts_task_step(
-        path_to_publish='dist/',
-        artifact_name='dist',
-    )
-
-    sdist_job = Job(
-        id_name='sdist',
-        display_name='Build sdist',
-        steps=[
-            use_python_version_step,
-            checkout_step,
-            bash_step,
-            publish_task_step,
-        ],
-        runs_on=environment.vm_image,
-    )
-
-    return sdist_job
-
-
-def create_bdist_wheel_pure_job(environment):
-    use_python_version_step = create_setup_python_action_step(
-        python_version=environment.version,
-        architecture='x64',
-    )
-
-    checkout_step = create_checkout_action_step()
-
-    bash_step = create_bash_step(
-        name='Build',
-        commands=[
-            'python -m pip install --quiet --upgrade pip',
-            'python -m pip install --quiet --upgrade pep517',
-            'python -m pep517.build --binary --out-dir dist/ .',
-        ],
-    )
-
-    publish_task_step = create_publish_build_artifacts_task_step(
-        path_to_publish='dist/',
-        artifact_name='dist',
-    )
-
-    job = Job(
-        id_name='bdist',
-        display_name='Build pure wheel',
-        steps=[
-            use_python_version_step,
-            checkout_step,
-            bash_step,
-            publish_task_step,
-        ],
-        runs_on=environment.vm_image,
-    )
-
-    return job
-
-
-def create_all_job(environment, other_jobs):
-    use_python_version_step = create_setup_python_action_step(
-        python_version=environment.version,
-        architecture='x64',
-    )
-
-    this_step = create_bash_step(
-        name='This',
-        commands=[
-            'python -m this',
-        ],
-    )
-
-    job = Job(
-        id_name='all',
-        display_name='All',
-        steps=[
-            use_python_version_step,
-            this_step,
-        ],
-        needs=other_jobs,
-        runs_on=environment.vm_image,
-    )
-
-    return job
-
-
-def create_workflow(configuration, configuration_path, output_path):
-    jobs = pvector()
-
-    tooling_environment = ciborg.azure.Environment.build(
-        platform=configuration.tooling_environment.platform,
-        interpreter=configuration.tooling_environment.interpreter,
-        version=configuration.tooling_environment.version,
-        architecture='x64',
-        display_string=configuration.tooling_environment.display_name(),
-        identifier_string=configuration.tooling_environment.identifier(),
-    )
-
-    verify_job = create_verify_up_to_date_job(
-        environment=tooling_environment,
-        configuration_path=configuration_path,
-        output_path=output_path,
-        ciborg_requirement=configuration.ciborg_requirement,
-    )
-
-    jobs = jobs.append(verify_job)
-
-    if configuration.build_sdist:
-        sdist_job = create_sdist_job(
-            environment=tooling_environment,
-        )
-        jobs = jobs.append(sdist_job)
-
-    if configuration.build_wheel == 'universal':
-        bdist_job = create_bdist_wheel_pure_job(
-            environment=tooling_environment,
-        )
-        jobs = jobs.append(bdist_job)
-    # elif configuration.build_wheel == 'specific':
-
-    build_jobs = {
-        ciborg.configuration.sdist_install_source: sdist_job,
-        ciborg.configuration.bdist_install_source: bdist_job,
-    }
-
-    for environment in configuration.test_environments:
-        vm_image = ciborg.azure.vm_images[environment.platform]
-
-        test_job_environment = ciborg.azure.Environment(
-            platform=vm_image.platform,
-            vm_image=vm_image,
-            interpreter=environment.interpreter,
-            version=environment.version,
-            architecture=None,
-            display_string=environment.display_name(),
-            identifier_string=environment.identifier(),
-            tox_environment=environment.tox_environment,
-        )
-
-        build_job = build_jobs.get(environment.install_source)
-
-        jobs = jobs.append(
-            create_tox_test_job(
-                build_job=build_job,
-                environment=test_job_environment,
-                distribution_name=configuration.name,
-                distribution_type=environment.install_source,
-            ),
-        )
-
-    all_job = create_all_job(environment=tooling_environment, other_jobs=jobs)
-    jobs = jobs.append(all_job)
-
-    pipeline = Workflow(
-        name='CI',
-        on=On(
-            push=Push(branches=['master'], tags=['v*']),
-            pull_request=PullRequest(branches=['*']),
-        ),
-        jobs=jobs,
-    )
-
-    return pipeline
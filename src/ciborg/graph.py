@@ -0,0 +1,476 @@
+"""The dependencies between the jobs of a :class:`ciborg.intermediate.Pipeline`
+as an explicit graph, along with estimates of how long it takes to run.
+"""
+import collections
+import heapq
+import itertools
+
+import attr
+from pyrsistent import pmap, pvector
+
+import ciborg.intermediate
+
+
+@attr.s(frozen=True)
+class Graph:
+    # Job ids in pipeline order mapped to the ids they need.
+    needs = attr.ib(converter=collections.OrderedDict)
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        needs = collections.OrderedDict()
+        for job in pipeline.jobs:
+            needs[job.id_name] = pvector(
+                reference.id_name
+                for reference in job.needs
+            )
+
+        unknown = sorted({
+            need
+            for job_needs in needs.values()
+            for need in job_needs
+            if need not in needs
+        })
+        if len(unknown) > 0:
+            raise Exception(
+                'Jobs are needed but not defined: {}'.format(
+                    ', '.join(unknown),
+                ),
+            )
+
+        return cls(needs=needs)
+
+    def edge_count(self):
+        return sum(len(job_needs) for job_needs in self.needs.values())
+
+    def find_cycle(self):
+        """Return the ids along a cycle, starting and ending with the same
+        one, or None.
+        """
+        visiting = set()
+        visited = set()
+        stack = []
+
+        def visit(id_name):
+            visiting.add(id_name)
+            stack.append(id_name)
+
+            for need in self.needs[id_name]:
+                if need in visiting:
+                    return [*stack[stack.index(need):], need]
+
+                if need not in visited:
+                    cycle = visit(need)
+                    if cycle is not None:
+                        return cycle
+
+            stack.pop()
+            visiting.remove(id_name)
+            visited.add(id_name)
+
+            return None
+
+        for id_name in self.needs:
+            if id_name not in visited:
+                cycle = visit(id_name)
+                if cycle is not None:
+                    return cycle
+
+        return None
+
+    def topological_order(self):
+        """Job ids with each after all that it needs."""
+        cycle = self.find_cycle()
+        if cycle is not None:
+            raise Exception(
+                'Jobs depend on each other: {}'.format(' -> '.join(cycle)),
+            )
+
+        order = []
+        done = set()
+
+        def visit(id_name):
+            if id_name in done:
+                return
+
+            done.add(id_name)
+            for need in self.needs[id_name]:
+                visit(need)
+
+            order.append(id_name)
+
+        for id_name in self.needs:
+            visit(id_name)
+
+        return order
+
+    def ancestors(self):
+        ancestors = {}
+        for id_name in self.topological_order():
+            ancestors[id_name] = frozenset(
+                itertools.chain.from_iterable(
+                    [need, *ancestors[need]]
+                    for need in self.needs[id_name]
+                ),
+            )
+
+        return ancestors
+
+    def transitive_reduction(self):
+        """Return the graph without the needs already implied by others."""
+        ancestors = self.ancestors()
+
+        return Graph(
+            needs=collections.OrderedDict(
+                (
+                    id_name,
+                    pvector(
+                        need
+                        for need in job_needs
+                        if not any(
+                            need in ancestors[other]
+                            for other in job_needs
+                            if other != need
+                        )
+                    ),
+                )
+                for id_name, job_needs in self.needs.items()
+            ),
+        )
+
+    def redundant_needs(self):
+        reduced = self.transitive_reduction()
+
+        return [
+            (id_name, need)
+            for id_name, job_needs in self.needs.items()
+            for need in job_needs
+            if need not in reduced.needs[id_name]
+        ]
+
+    def critical_path(self, seconds):
+        """Return the longest chain of needs by the summed ``seconds`` of its
+        jobs, and that length.
+        """
+        finish = {}
+        previous = {}
+        order = self.topological_order()
+        for id_name in order:
+            start = 0
+            for need in self.needs[id_name]:
+                if finish[need] > start:
+                    start = finish[need]
+                    previous[id_name] = need
+
+            finish[id_name] = start + seconds[id_name]
+
+        if len(finish) == 0:
+            return [], 0
+
+        # Ties go to the later job so that instant joins end the path.
+        last = max(reversed(order), key=finish.get)
+        path = [last]
+        while path[-1] in previous:
+            path.append(previous[path[-1]])
+
+        return path[::-1], finish[last]
+
+    def remaining(self, seconds):
+        """The seconds from the start of each job to the end of the longest
+        chain of jobs needing it.
+        """
+        needed_by = collections.defaultdict(list)
+        for id_name, job_needs in self.needs.items():
+            for need in job_needs:
+                needed_by[need].append(id_name)
+
+        remaining = {}
+        for id_name in reversed(self.topological_order()):
+            remaining[id_name] = seconds[id_name] + max(
+                (remaining[other] for other in needed_by[id_name]),
+                default=0,
+            )
+
+        return remaining
+
+
+@attr.s(frozen=True)
+class Task:
+    """A single run of a job, or of a leg of a matrix job, on a runner."""
+
+    id_name = attr.ib()
+    vm_image = attr.ib()
+    seconds = attr.ib()
+
+
+@attr.s(frozen=True)
+class ScheduledJob:
+    id_name = attr.ib()
+    start = attr.ib()
+    finish = attr.ib()
+
+
+@attr.s(frozen=True)
+class Schedule:
+    jobs = attr.ib(converter=pvector)
+
+    def makespan(self):
+        return max((job.finish for job in self.jobs), default=0)
+
+
+def simulate(graph, tasks, runners):
+    """Run the ``tasks`` of each job once all it needs have finished.
+
+    ``runners`` maps VM images to how many tasks on them can run at once,
+    unlimited for those not listed.  Among ready tasks those heading the
+    longest remaining chain of jobs start first.
+    """
+    seconds = {
+        id_name: max((task.seconds for task in job_tasks), default=0)
+        for id_name, job_tasks in tasks.items()
+    }
+    priorities = graph.remaining(seconds)
+
+    waiting = {
+        id_name: len(job_needs)
+        for id_name, job_needs in graph.needs.items()
+    }
+    needed_by = collections.defaultdict(list)
+    for id_name, job_needs in graph.needs.items():
+        for need in job_needs:
+            needed_by[need].append(id_name)
+
+    unfinished = {id_name: len(tasks[id_name]) for id_name in graph.needs}
+    free = dict(runners)
+    queued = collections.defaultdict(list)
+    running = []
+    counter = itertools.count()
+    starts = {}
+    finishes = {}
+    now = 0
+
+    def release(id_name):
+        if unfinished[id_name] == 0:
+            starts.setdefault(id_name, now)
+            finish(id_name)
+            return
+
+        for task in tasks[id_name]:
+            heapq.heappush(
+                queued[task.vm_image],
+                (-priorities[id_name], next(counter), task),
+            )
+
+    def finish(id_name):
+        finishes[id_name] = now
+        for other in needed_by[id_name]:
+            waiting[other] -= 1
+            if waiting[other] == 0:
+                release(other)
+
+    for id_name, count in waiting.items():
+        if count == 0:
+            release(id_name)
+
+    while True:
+        for vm_image, queue in queued.items():
+            while len(queue) > 0 and free.get(vm_image, 1) > 0:
+                _, _, task = heapq.heappop(queue)
+                if vm_image in free:
+                    free[vm_image] -= 1
+
+                starts.setdefault(task.id_name, now)
+                heapq.heappush(
+                    running,
+                    (now + task.seconds, next(counter), task),
+                )
+
+        if len(running) == 0:
+            break
+
+        now, _, task = heapq.heappop(running)
+        if task.vm_image in free:
+            free[task.vm_image] += 1
+
+        unfinished[task.id_name] -= 1
+        if unfinished[task.id_name] == 0:
+            finish(task.id_name)
+
+    return Schedule(
+        jobs=[
+            ScheduledJob(
+                id_name=id_name,
+                start=starts[id_name],
+                finish=finishes[id_name],
+            )
+            for id_name in graph.needs
+            if id_name in finishes
+        ],
+    )
+
+
+def environment_seconds(environment, timings, default_seconds):
+    identifier = environment.identifier_string
+    if environment.tox_environment is None:
+        names = [None]
+    else:
+        names = environment.tox_environment.split(',')
+
+    default_name = attr.evolve(environment, tox_environment=None).tox_env()
+
+    total = 0
+    for name in names:
+        keys = [identifier] if name is None else ['{}_{}'.format(
+            name,
+            identifier,
+        )]
+        if name == default_name:
+            keys.append(identifier)
+
+        timing = next(
+            (
+                timings.get(key)
+                for key in keys
+                if timings.get(key) is not None
+            ),
+            None,
+        )
+        total += default_seconds if timing is None else timing.seconds
+
+    return total
+
+
+def create_tasks(job, timings, default_seconds):
+    if job.aggregate:
+        # Joins take no runner from the pools and next to no time.
+        return [Task(id_name=job.id_name, vm_image=None, seconds=0)]
+
+    if job.matrix is not None:
+        return [
+            Task(
+                id_name=job.id_name,
+                vm_image=leg.environment.vm_image.id_name,
+                seconds=environment_seconds(
+                    environment=leg.environment,
+                    timings=timings,
+                    default_seconds=default_seconds,
+                ) / (1 if leg.shard is None else leg.shard.count),
+            )
+            for leg in job.matrix
+        ]
+
+    tox_steps = [
+        step
+        for step in job.steps
+        if isinstance(step, ciborg.intermediate.ToxStep)
+    ]
+    if len(tox_steps) == 0:
+        seconds = default_seconds
+    else:
+        seconds = environment_seconds(
+            environment=job.environment,
+            timings=timings,
+            default_seconds=default_seconds,
+        )
+        shard_counts = [
+            step.shard_count
+            for step in tox_steps
+            if step.shard_count is not None
+        ]
+        if len(shard_counts) > 0:
+            seconds /= shard_counts[0]
+
+    return [
+        Task(
+            id_name=job.id_name,
+            vm_image=job.environment.vm_image.id_name,
+            seconds=seconds,
+        ),
+    ]
+
+
+@attr.s(frozen=True)
+class Analysis:
+    graph = attr.ib()
+    tasks = attr.ib(converter=pmap)
+    critical_path = attr.ib(converter=pvector)
+    critical_seconds = attr.ib()
+    schedule = attr.ib()
+    runners = attr.ib(converter=pmap)
+
+    def format(self):
+        redundant = self.graph.redundant_needs()
+
+        lines = [
+            '{jobs} jobs, {tasks} runs, {edges} needs of which {redundant}'
+            ' are implied by others'.format(
+                jobs=len(self.graph.needs),
+                tasks=sum(len(tasks) for tasks in self.tasks.values()),
+                edges=self.graph.edge_count(),
+                redundant=len(redundant),
+            ),
+        ]
+        lines.extend(
+            '    {} needs {} indirectly'.format(id_name, need)
+            for id_name, need in redundant
+        )
+
+        lines.append(
+            'Critical path {:.1f}s: {}'.format(
+                self.critical_seconds,
+                ' -> '.join(self.critical_path),
+            ),
+        )
+
+        lines.append('{:<48} {:>10} {:>10}'.format('job', 'start', 'finish'))
+        lines.extend(
+            '{:<48} {:>10.1f} {:>10.1f}'.format(
+                job.id_name,
+                job.start,
+                job.finish,
+            )
+            for job in self.schedule.jobs
+        )
+
+        runners = 'unlimited runners'
+        if len(self.runners) > 0:
+            runners = ', '.join(
+                '{} {}'.format(count, vm_image)
+                for vm_image, count in sorted(self.runners.items())
+            ) + ' runners, unlimited for other images'
+
+        lines.append(
+            'Makespan {:.1f}s with {}'.format(
+                self.schedule.makespan(),
+                runners,
+            ),
+        )
+
+        return '\n'.join(lines)
+
+
+def analyze(pipeline, timings, default_seconds, runners=pmap()):
+    graph = Graph.from_pipeline(pipeline)
+
+    tasks = {
+        job.id_name: create_tasks(
+            job=job,
+            timings=timings,
+            default_seconds=default_seconds,
+        )
+        for job in pipeline.jobs
+    }
+    seconds = {
+        id_name: max((task.seconds for task in job_tasks), default=0)
+        for id_name, job_tasks in tasks.items()
+    }
+    critical_path, critical_seconds = graph.critical_path(seconds)
+
+    return Analysis(
+        graph=graph,
+        tasks=tasks,
+        critical_path=critical_path,
+        critical_seconds=critical_seconds,
+        schedule=simulate(graph=graph, tasks=tasks, runners=runners),
+        runners=runners,
+    )
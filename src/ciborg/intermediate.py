@@ -0,0 +1,1062 @@
+"""Backend neutral description of the CI jobs.
+
+The job graph is built once from a :class:`ciborg.configuration.Configuration`
+and then lowered to the service specific models in :mod:`ciborg.azure` and
+:mod:`ciborg.github`.
+"""
+import collections
+import typing
+import weakref
+
+import attr
+import pyrsistent.typing
+
+from pyrsistent import pvector, pmap
+
+import ciborg.configuration
+
+
+@attr.s(frozen=True, slots=True)
+class Platform:
+    display_name = attr.ib()
+
+    def identifier(self):
+        return self.display_name.casefold()
+
+
+platforms = {
+    'linux': Platform(display_name='Linux'),
+    'macos': Platform(display_name='macOS'),
+    'windows': Platform(display_name='Windows'),
+}
+
+
+@attr.s(frozen=True, slots=True)
+class VmImage:
+    id_name = attr.ib()
+    display_name = attr.ib()
+    platform = attr.ib()
+
+
+vm_images = {
+    ciborg.configuration.linux_platform: VmImage(
+        platform=platforms['linux'],
+        display_name=platforms['linux'].display_name,
+        id_name='ubuntu-latest',
+    ),
+    ciborg.configuration.macos_platform: VmImage(
+        platform=platforms['macos'],
+        display_name=platforms['macos'].display_name,
+        id_name='macOS-latest',
+    ),
+    ciborg.configuration.windows_platform: VmImage(
+        platform=platforms['windows'],
+        display_name=platforms['windows'].display_name,
+        id_name='windows-latest',
+    ),
+}
+
+
+@attr.s(frozen=True, slots=True)
+class Environment:
+    platform = attr.ib()
+    vm_image = attr.ib()
+    interpreter = attr.ib()
+    version = attr.ib()
+    architecture = attr.ib()
+    display_string = attr.ib()
+    identifier_string = attr.ib()
+    tox_environment = attr.ib()
+    tox_cache = attr.ib(default=False)
+    shards = attr.ib(default=1)
+
+    @classmethod
+    def build(
+            cls,
+            platform,
+            interpreter,
+            version,
+            architecture,
+            display_string,
+            identifier_string,
+            tox_environment=None,
+            tox_cache=False,
+            shards=1,
+    ):
+        return cls(
+            platform=platform,
+            vm_image=vm_images[platform],
+            interpreter=interpreter,
+            version=version,
+            architecture=architecture,
+            display_string=display_string,
+            identifier_string=identifier_string,
+            tox_environment=tox_environment,
+            tox_cache=tox_cache,
+            shards=shards,
+        )
+
+    @classmethod
+    def from_configuration(cls, environment, architecture=None):
+        return cls.build(
+            platform=environment.platform,
+            interpreter=environment.interpreter,
+            version=environment.version,
+            architecture=architecture,
+            display_string=environment.display_name(),
+            identifier_string=environment.identifier(),
+            tox_environment=environment.tox_environment,
+            tox_cache=environment.tox_cache,
+            shards=environment.shards,
+        )
+
+    def pack(self, others):
+        """Run the tox environments of ``others`` after this one."""
+        others = list(others)
+        if len(others) == 0:
+            return self
+
+        return attr.evolve(
+            self,
+            tox_environment=','.join(
+                environment.tox_env()
+                for environment in [self, *others]
+            ),
+        )
+
+    def tox_env(self):
+        if self.tox_environment is not None:
+            return self.tox_environment
+
+        env = 'py'
+        if self.interpreter == 'PyPy':
+            env += 'py'
+            if self.version[0] == '3':
+                env += '3'
+        else:
+            env += self.version.joined_by('')
+
+        return env
+
+    def matrix_version(self):
+        if self.interpreter == 'CPython':
+            return self.version
+
+        return 'pypy{}'.format(self.version[0])
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class MatrixVariable:
+    """A step value that differs between the legs of a matrix job."""
+
+    name = attr.ib()
+
+
+vm_image_variable = MatrixVariable(name='vm_image')
+python_version_variable = MatrixVariable(name='python_version')
+tox_environment_variable = MatrixVariable(name='tox_environment')
+lock_file_variable = MatrixVariable(name='lock_file')
+shard_index_variable = MatrixVariable(name='shard_index')
+shard_count_variable = MatrixVariable(name='shard_count')
+
+
+@attr.s(frozen=True, slots=True)
+class Shard:
+    """The zero based ``index`` of ``count`` deterministic subsets of the
+    test files.  See :mod:`ciborg.sharding`.
+    """
+
+    index = attr.ib()
+    count = attr.ib()
+
+    def id_string(self):
+        return 'shard_{}_of_{}'.format(self.index + 1, self.count)
+
+    def display_string(self):
+        return 'shard {} of {}'.format(self.index + 1, self.count)
+
+
+def shards_of(count):
+    if count == 1:
+        return [None]
+
+    return [Shard(index=index, count=count) for index in range(count)]
+
+
+@attr.s(frozen=True, slots=True)
+class MatrixLeg:
+    id_name = attr.ib()
+    display_name = attr.ib()
+    environment = attr.ib()
+    lock_file = attr.ib(default=None)
+    shard = attr.ib(default=None)
+
+    def variables(self):
+        variables = collections.OrderedDict([
+            (vm_image_variable.name, self.environment.vm_image.id_name),
+            (
+                python_version_variable.name,
+                self.environment.version.display_string,
+            ),
+            (tox_environment_variable.name, self.environment.tox_env()),
+        ])
+
+        if self.lock_file is not None:
+            variables[lock_file_variable.name] = self.lock_file
+
+        if self.shard is not None:
+            variables[shard_index_variable.name] = str(self.shard.index)
+            variables[shard_count_variable.name] = str(self.shard.count)
+
+        return variables
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class SetupPythonStep:
+    version = attr.ib()
+    architecture = attr.ib()
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class CheckoutStep:
+    # Commits of history to fetch, the backend default when None.
+    fetch_depth = attr.ib(default=None)
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class RunStep:
+    name = attr.ib()
+    commands: pyrsistent.typing.PVector[str] = attr.ib(converter=pvector)
+    environment: typing.Mapping[str, str] = attr.ib(
+        default=pmap(),
+        converter=pmap,
+    )
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class GenerateStep:
+    configuration_path = attr.ib()
+    # Run the zipapp instead of the installed ciborg when set.
+    zipapp = attr.ib(default=None)
+    # Only check that the output is up to date, trusting its fingerprint.
+    check = attr.ib(default=False)
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class ChangesStep:
+    """Check whether the commit changed any of ``paths``, or the output
+    when ``output_directory`` is set, and skip the rest of the job if not.
+
+    The backends condition every step after this one on the result.
+    """
+
+    paths: pyrsistent.typing.PVector[str] = attr.ib(converter=pvector)
+    output_directory = attr.ib(default=None)
+
+    def all_paths(self, output_path):
+        paths = list(self.paths)
+        if self.output_directory is not None:
+            paths.append(str(self.output_directory / output_path))
+
+        return paths
+
+
+changed_variable = 'ciborg_changed'
+
+
+def changes_commands(paths, base):
+    """Shell commands setting :data:`changed_variable` to true or false.
+
+    The commit is compared to ``base``, shell text expanding to a revision.
+    Comparing only to the first parent would miss all but the last commit of
+    a push so the backends pass the commit before the push where the CI
+    service provides it, and the first parent, the target branch, for the
+    merge commit of a pull request.  When ``base`` expands to nothing, or
+    the revision can't be fetched such as for the first push of a branch,
+    it counts as changed.
+    """
+    return [
+        'base="{}"'.format(base),
+        'if [ -n "${base}" ]'
+        ' && { git rev-parse --verify --quiet "${base}^{commit}" > /dev/null'
+        ' || git fetch --quiet --depth=1 origin "${base}"; }'
+        ' && git diff --quiet "${base}" HEAD -- '
+        + ' '.join("'{}'".format(path) for path in paths)
+        + '; then',
+        '    {}=false'.format(changed_variable),
+        'else',
+        '    {}=true'.format(changed_variable),
+        'fi',
+        'echo "Changed: ${{{}}}"'.format(changed_variable),
+    ]
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class Zipapp:
+    """A single file build of ciborg, see :mod:`ciborg.pyz`.
+
+    The ``location`` is either a URL to download it from or a path in the
+    repository.
+    """
+
+    location = attr.ib()
+
+    def is_url(self):
+        return '://' in self.location
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class ZipappCacheStep:
+    """Restore and save the downloaded zipapp, keyed on its URL."""
+
+    zipapp = attr.ib()
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class FetchZipappStep:
+    """Download the zipapp unless it was restored from the cache."""
+
+    zipapp = attr.ib()
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class PublishArtifactStep:
+    path = attr.ib()
+    artifact_name = attr.ib()
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class DownloadArtifactStep:
+    path = attr.ib()
+    artifact_name = attr.ib()
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class SelectDistributionStep:
+    distribution_name = attr.ib()
+    distribution_type = attr.ib()
+    # Backends that download each artifact into a directory of its own name
+    # need this to find the file.
+    artifact_name = attr.ib(default='dist')
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class PipCacheStep:
+    """Restore and save the pip download cache.
+
+    The key covers the lock file and ``tox.ini`` so any change to the test
+    dependencies starts a new cache, seeded from the latest for the Python
+    version.
+    """
+
+    python_version = attr.ib()
+    lock_file = attr.ib()
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class ToxEnvironmentCacheStep:
+    """Restore and save ``.tox/<tox_environment>``.
+
+    Only an exact key match is restored so that any change to the key files
+    starts from a fresh environment rather than a stale one.
+    """
+
+    python_version = attr.ib()
+    tox_environment = attr.ib()
+    key_files = attr.ib(converter=pvector)
+    # Hashed too where the backend allows them to be missing.
+    optional_key_files = attr.ib(default=pvector(), converter=pvector)
+
+
+# Hashed into the tox environment cache key along with the lock file.
+tox_cache_key_files = pvector(['tox.ini'])
+# Not every project has these.
+tox_cache_optional_key_files = pvector(['setup.cfg', 'pyproject.toml'])
+
+
+@attr.s(frozen=True, slots=True, cache_hash=True)
+class ToxStep:
+    tox_environment = attr.ib()
+    install_distribution = attr.ib()
+    # Either both or neither are set to run only a subset of the tests.
+    shard_index = attr.ib(default=None)
+    shard_count = attr.ib(default=None)
+
+
+_interned_steps = weakref.WeakValueDictionary()
+
+
+def intern_step(step):
+    """Return the existing step equal to ``step`` if there is one.
+
+    Most jobs share the same few steps so this keeps one copy of each alive
+    and lets the backends reuse their lowering of it.
+    """
+    return _interned_steps.setdefault(step, step)
+
+
+def intern_steps(steps):
+    return pvector(intern_step(step) for step in steps)
+
+
+@attr.s(frozen=True, slots=True)
+class JobReference:
+    id_name = attr.ib()
+
+    @classmethod
+    def from_job(cls, job):
+        return cls(id_name=job.id_name)
+
+
+@attr.s(frozen=True, slots=True)
+class Job:
+    id_name = attr.ib()
+    display_name = attr.ib()
+    environment = attr.ib()
+    needs: pyrsistent.typing.PVector[JobReference] = attr.ib(
+        factory=pvector,
+        converter=pvector,
+    )
+    steps = attr.ib(default=pvector(), converter=intern_steps)
+    # The legs of a matrix job, which then has no single environment.
+    matrix: typing.Optional[pyrsistent.typing.PVector[MatrixLeg]] = attr.ib(
+        default=None,
+    )
+    # Only joins the results of its needs so the backends can run it without
+    # an environment or steps of its own.
+    aggregate = attr.ib(default=False)
+    # A failure cancels the rest of the pipeline rather than letting the
+    # other jobs run to completion.
+    fail_fast = attr.ib(default=False)
+
+
+@attr.s(frozen=True, slots=True)
+class Pipeline:
+    name = attr.ib()
+    configuration_path = attr.ib()
+    jobs = attr.ib()
+    # Patterns of changed files that trigger, or don't trigger, a run.
+    paths: pyrsistent.typing.PVector[str] = attr.ib(
+        default=pvector(),
+        converter=pvector,
+    )
+    paths_ignore: pyrsistent.typing.PVector[str] = attr.ib(
+        default=pvector(),
+        converter=pvector,
+    )
+    cancel_superseded = attr.ib(default=False)
+
+    def filtered(self):
+        return len(self.paths) > 0 or len(self.paths_ignore) > 0
+
+    def required_paths(self, output_path):
+        """Files that always trigger a run when path filters are set, so
+        that a change to either is checked by the verify job.
+        """
+        return [
+            self.configuration_path.as_posix(),
+            (self.configuration_path.parent / output_path).as_posix(),
+        ]
+
+
+distribution_artifact_name = 'dist'
+
+
+def create_artifact_name(suffix):
+    # Each kind of distribution is published on its own so test jobs only
+    # download what they install and no two jobs upload to one artifact.
+    return '{}-{}'.format(distribution_artifact_name, suffix)
+
+
+sdist_artifact_name = create_artifact_name('sdist')
+# Named after the platform tag shared by all pure wheels.
+pure_wheel_artifact_name = create_artifact_name('any')
+
+
+def create_verify_up_to_date_job(
+        environment,
+        configuration_path,
+        ciborg_requirement,
+        ciborg_zipapp=None,
+        only_when_changed=False,
+        check=False,
+):
+    if only_when_changed:
+        # The parent commit is needed to diff against.
+        steps = [
+            CheckoutStep(fetch_depth=2),
+            ChangesStep(
+                paths=[str(configuration_path)],
+                output_directory=configuration_path.parent,
+            ),
+            SetupPythonStep(version=environment.version, architecture='x64'),
+        ]
+    else:
+        steps = [
+            SetupPythonStep(version=environment.version, architecture='x64'),
+            CheckoutStep(),
+        ]
+
+    if ciborg_zipapp is None:
+        zipapp = None
+        steps.append(
+            RunStep(
+                name='Install ciborg',
+                commands=[
+                    'python -m pip install --upgrade pip setuptools',
+                    'python -m pip install "{}"'.format(ciborg_requirement),
+                ],
+            ),
+        )
+    else:
+        # Nothing to resolve or install, at most one file to download.
+        zipapp = Zipapp(location=ciborg_zipapp)
+        if zipapp.is_url():
+            steps.extend([
+                ZipappCacheStep(zipapp=zipapp),
+                FetchZipappStep(zipapp=zipapp),
+            ])
+
+    steps.extend([
+        GenerateStep(
+            configuration_path=configuration_path,
+            zipapp=zipapp,
+            check=check,
+        ),
+        RunStep(
+            name='Verify',
+            commands=[
+                '[ -z "$(git status --porcelain)" ]',
+            ],
+        ),
+    ])
+
+    return Job(
+        id_name='verify_up_to_date',
+        display_name='Verify up to date',
+        environment=environment,
+        steps=steps,
+    )
+
+
+def create_build_job(
+        environment,
+        id_name,
+        display_name,
+        pep517_option,
+        artifact_name=distribution_artifact_name,
+):
+    return Job(
+        id_name=id_name,
+        display_name=display_name,
+        environment=environment,
+        steps=[
+            SetupPythonStep(version=environment.version, architecture='x64'),
+            CheckoutStep(),
+            RunStep(
+                name='Build',
+                commands=[
+                    'python -m pip install --quiet --upgrade pip',
+                    'python -m pip install --quiet --upgrade pep517',
+                    'python -m pep517.build {} --out-dir dist/ .'.format(
+                        pep517_option,
+                    ),
+                ],
+            ),
+            PublishArtifactStep(path='dist/', artifact_name=artifact_name),
+        ],
+    )
+
+
+def create_sdist_job(environment):
+    return create_build_job(
+        environment=environment,
+        id_name='sdist',
+        display_name='Build sdist',
+        pep517_option='--source',
+        artifact_name=sdist_artifact_name,
+    )
+
+
+def create_bdist_wheel_pure_job(environment):
+    return create_build_job(
+        environment=environment,
+        id_name='bdist',
+        display_name='Build pure wheel',
+        pep517_option='--binary',
+        artifact_name=pure_wheel_artifact_name,
+    )
+
+
+def wheel_artifact_name(environment):
+    return create_artifact_name(environment.identifier_string)
+
+
+def create_bdist_wheel_specific_job(environment):
+    return create_build_job(
+        environment=environment,
+        id_name='bdist_{}'.format(environment.identifier_string),
+        display_name='Build wheel - {}'.format(environment.display_string),
+        pep517_option='--binary',
+        artifact_name=wheel_artifact_name(environment),
+    )
+
+
+def wheel_key(environment):
+    bdist = ciborg.configuration.bdist_install_source
+    if environment.install_source != bdist:
+        return None
+
+    return (
+        environment.platform,
+        environment.interpreter,
+        environment.version,
+    )
+
+
+def create_bdist_wheel_specific_jobs(test_environments):
+    # One build per platform and Python version tested against a wheel so
+    # that each test job only waits for, and downloads, its own.
+    jobs = collections.OrderedDict()
+    for environment in test_environments:
+        key = wheel_key(environment)
+        if key is None or key in jobs:
+            continue
+
+        jobs[key] = create_bdist_wheel_specific_job(
+            environment=Environment.from_configuration(
+                environment=ciborg.configuration.Environment(
+                    platform=environment.platform,
+                    interpreter=environment.interpreter,
+                    version=environment.version,
+                    install_source=None,
+                    tox_environment=None,
+                ),
+                architecture='x64',
+            ),
+        )
+
+    return jobs
+
+
+def format_lock_file(lock_file_format, environment):
+    if lock_file_format is None:
+        return None
+
+    return lock_file_format.format(
+        platform=environment.platform.configuration_string,
+    )
+
+
+def create_tox_test_steps(
+        python_version,
+        tox_environment,
+        distribution_name,
+        distribution_type,
+        lock_file=None,
+        pip_cache=False,
+        tox_cache=False,
+        artifact_name=distribution_artifact_name,
+        shard_index=None,
+        shard_count=None,
+):
+    steps = [
+        SetupPythonStep(version=python_version, architecture='x64'),
+        CheckoutStep(),
+    ]
+
+    if pip_cache:
+        steps.append(
+            PipCacheStep(python_version=python_version, lock_file=lock_file),
+        )
+
+    if distribution_type is not None:
+        steps.extend([
+            DownloadArtifactStep(path='dist', artifact_name=artifact_name),
+            SelectDistributionStep(
+                distribution_name=distribution_name,
+                distribution_type=distribution_type,
+                artifact_name=artifact_name,
+            ),
+        ])
+
+    if tox_cache:
+        steps.append(
+            ToxEnvironmentCacheStep(
+                python_version=python_version,
+                tox_environment=tox_environment,
+                key_files=[*tox_cache_key_files, lock_file],
+                optional_key_files=tox_cache_optional_key_files,
+            ),
+        )
+
+    steps.append(
+        ToxStep(
+            tox_environment=tox_environment,
+            install_distribution=distribution_type is not None,
+            shard_index=shard_index,
+            shard_count=shard_count,
+        ),
+    )
+
+    return steps
+
+
+def environment_id_pieces(environment):
+    return [
+        *(
+            []
+            if environment.tox_environment is None
+            else [environment.tox_environment.replace(',', '_')]
+        ),
+        environment.identifier_string,
+    ]
+
+
+def pack_test_environments(test_environments):
+    """Combine the environments sharing a ``pack`` name into one.
+
+    Pairs the first configuration environment of each pack, which decides
+    the build it tests, with the environment to test.
+    """
+    packs = collections.OrderedDict()
+    for environment in test_environments:
+        key = environment if environment.pack is None else environment.pack
+        packs.setdefault(key, []).append(environment)
+
+    for key, (first, *others) in packs.items():
+        for other in others:
+            compatible = (
+                (other.platform, other.interpreter, other.version)
+                == (first.platform, first.interpreter, first.version)
+                and other.install_source == first.install_source
+                and not (first.tox_cache or other.tox_cache)
+                and first.shards == other.shards == 1
+            )
+            if not compatible:
+                raise Exception(
+                    'Environments packed as {!r} must share the platform,'
+                    ' interpreter, version and install source and not use'
+                    ' tox_cache or shards'.format(key),
+                )
+
+        yield first, Environment.from_configuration(first).pack(
+            Environment.from_configuration(other)
+            for other in others
+        )
+
+
+def create_tox_test_job(
+        build_job,
+        environment,
+        distribution_name,
+        distribution_type,
+        lock_file_format=None,
+        pip_cache=False,
+        artifact_name=distribution_artifact_name,
+        shard=None,
+):
+    steps = create_tox_test_steps(
+        python_version=environment.version,
+        tox_environment=environment.tox_env(),
+        distribution_name=distribution_name,
+        distribution_type=distribution_type,
+        lock_file=format_lock_file(lock_file_format, environment),
+        pip_cache=pip_cache,
+        tox_cache=environment.tox_cache,
+        artifact_name=artifact_name,
+        shard_index=None if shard is None else shard.index,
+        shard_count=None if shard is None else shard.count,
+    )
+
+    id_pieces = ['tox', *environment_id_pieces(environment)]
+    display_name = '{} - {}'.format(
+        ' '.join([
+            'Tox',
+            *(
+                []
+                if environment.tox_environment is None
+                else [environment.tox_environment]
+            ),
+        ]),
+        environment.display_string,
+    )
+
+    if shard is not None:
+        id_pieces.append(shard.id_string())
+        display_name += ' - {}'.format(shard.display_string())
+
+    return Job(
+        id_name='_'.join(id_pieces),
+        display_name=display_name,
+        environment=environment,
+        steps=steps,
+        needs=[] if build_job is None else [JobReference.from_job(build_job)],
+    )
+
+
+def create_tox_test_jobs(environment, **kwargs):
+    for shard in shards_of(environment.shards):
+        yield create_tox_test_job(
+            environment=environment,
+            shard=shard,
+            **kwargs,
+        )
+
+
+def create_matrix_tox_test_job(
+        build_job,
+        environments,
+        distribution_name,
+        distribution_type,
+        lock_file_format=None,
+        pip_cache=False,
+        tox_cache=False,
+        build_environment=None,
+        artifact_name=distribution_artifact_name,
+        sharded=False,
+):
+    uses_lock_file = pip_cache or tox_cache
+
+    legs = [
+        MatrixLeg(
+            id_name='_'.join([
+                *environment_id_pieces(environment),
+                *([] if shard is None else [shard.id_string()]),
+            ]),
+            display_name=' '.join([
+                *(
+                    []
+                    if environment.tox_environment is None
+                    else [environment.tox_environment]
+                ),
+                environment.display_string,
+                *([] if shard is None else [shard.display_string()]),
+            ]),
+            environment=environment,
+            lock_file=(
+                format_lock_file(lock_file_format, environment)
+                if uses_lock_file
+                else None
+            ),
+            shard=shard,
+        )
+        for environment in environments
+        for shard in shards_of(environment.shards)
+    ]
+
+    id_pieces = ['tox']
+    display_name = 'Tox'
+    if distribution_type is not None:
+        id_pieces.append(distribution_type.identifier_string)
+        display_name += ' - {}'.format(distribution_type.display_string)
+    if build_environment is not None:
+        id_pieces.append(build_environment.identifier_string)
+        display_name += ' {}'.format(build_environment.display_string)
+    if tox_cache:
+        id_pieces.append('cached')
+        display_name += ' (cached)'
+    if sharded:
+        id_pieces.append('sharded')
+        display_name += ' (sharded)'
+
+    return Job(
+        id_name='_'.join(id_pieces),
+        display_name=display_name,
+        environment=None,
+        steps=create_tox_test_steps(
+            python_version=python_version_variable,
+            tox_environment=tox_environment_variable,
+            distribution_name=distribution_name,
+            distribution_type=distribution_type,
+            lock_file=lock_file_variable if uses_lock_file else None,
+            pip_cache=pip_cache,
+            tox_cache=tox_cache,
+            artifact_name=artifact_name,
+            shard_index=shard_index_variable if sharded else None,
+            shard_count=shard_count_variable if sharded else None,
+        ),
+        needs=[] if build_job is None else [JobReference.from_job(build_job)],
+        matrix=pvector(legs),
+    )
+
+
+def create_all_job(other_jobs):
+    return Job(
+        id_name='all',
+        display_name='All',
+        environment=None,
+        needs=[JobReference.from_job(job) for job in other_jobs],
+        aggregate=True,
+    )
+
+
+# Compared by identity so test environments can be grouped by their build
+# without hashing the whole job.
+@attr.s(frozen=True, slots=True, eq=False)
+class Build:
+    job = attr.ib()
+    artifact_name = attr.ib(default=distribution_artifact_name)
+    # Only set for wheels specific to a platform and Python version.
+    environment = attr.ib(default=None)
+
+
+no_build = Build(job=None)
+
+
+def find_build(builds, wheel_builds, environment):
+    build = wheel_builds.get(wheel_key(environment))
+    if build is not None:
+        return build
+
+    return builds.get(environment.install_source, no_build)
+
+
+def create_matrix_tox_test_jobs(configuration, find_build):
+    # Environments sharing a build dependency and caching differ only in the
+    # values the matrix varies so each such group becomes one job.
+    groups = collections.OrderedDict()
+    packed = pack_test_environments(configuration.test_environments)
+    for environment, test_environment in packed:
+        key = (
+            environment.install_source,
+            find_build(environment),
+            environment.tox_cache,
+            environment.shards > 1,
+        )
+        groups.setdefault(key, []).append(test_environment)
+
+    for key, environments in groups.items():
+        install_source, build, tox_cache, sharded = key
+
+        yield create_matrix_tox_test_job(
+            build_job=build.job,
+            environments=environments,
+            distribution_name=configuration.name,
+            distribution_type=install_source,
+            lock_file_format=configuration.lock_file,
+            pip_cache=configuration.pip_cache,
+            tox_cache=tox_cache,
+            build_environment=build.environment,
+            artifact_name=build.artifact_name,
+            sharded=sharded,
+        )
+
+
+def create_jobs(configuration, configuration_path):
+    tooling_environment = Environment.from_configuration(
+        environment=configuration.tooling_environment,
+        architecture='x64',
+    )
+
+    # Only the identifiers are retained so that jobs already handed out can
+    # be released while the rest are still being created.
+    job_references = []
+
+    verify_job = create_verify_up_to_date_job(
+        environment=tooling_environment,
+        configuration_path=configuration_path,
+        ciborg_requirement=configuration.ciborg_requirement,
+        ciborg_zipapp=configuration.ciborg_zipapp,
+        only_when_changed=configuration.verify_only_when_changed,
+        check=configuration.fingerprint,
+    )
+    job_references.append(JobReference.from_job(verify_job))
+    yield verify_job
+
+    builds = {}
+    wheel_builds = {}
+
+    if configuration.build_sdist:
+        sdist_job = create_sdist_job(environment=tooling_environment)
+        builds[ciborg.configuration.sdist_install_source] = Build(
+            job=sdist_job,
+            artifact_name=sdist_artifact_name,
+        )
+        job_references.append(JobReference.from_job(sdist_job))
+        yield sdist_job
+
+    if configuration.build_wheel == 'universal':
+        bdist_job = create_bdist_wheel_pure_job(
+            environment=tooling_environment,
+        )
+        builds[ciborg.configuration.bdist_install_source] = Build(
+            job=bdist_job,
+            artifact_name=pure_wheel_artifact_name,
+        )
+        job_references.append(JobReference.from_job(bdist_job))
+        yield bdist_job
+    elif configuration.build_wheel == 'specific':
+        wheel_jobs = create_bdist_wheel_specific_jobs(
+            test_environments=configuration.test_environments,
+        )
+        for key, wheel_job in wheel_jobs.items():
+            wheel_builds[key] = Build(
+                job=wheel_job,
+                artifact_name=wheel_artifact_name(wheel_job.environment),
+                environment=wheel_job.environment,
+            )
+            job_references.append(JobReference.from_job(wheel_job))
+            yield wheel_job
+
+    def find_environment_build(environment):
+        return find_build(
+            builds=builds,
+            wheel_builds=wheel_builds,
+            environment=environment,
+        )
+
+    if configuration.matrix:
+        test_jobs = create_matrix_tox_test_jobs(
+            configuration=configuration,
+            find_build=find_environment_build,
+        )
+    else:
+        def create_test_jobs(environment, test_environment):
+            build = find_environment_build(environment)
+
+            return create_tox_test_jobs(
+                build_job=build.job,
+                environment=test_environment,
+                distribution_name=configuration.name,
+                distribution_type=environment.install_source,
+                lock_file_format=configuration.lock_file,
+                pip_cache=configuration.pip_cache,
+                artifact_name=build.artifact_name,
+            )
+
+        test_jobs = (
+            test_job
+            for environment, test_environment in pack_test_environments(
+                configuration.test_environments,
+            )
+            for test_job in create_test_jobs(environment, test_environment)
+        )
+
+    for test_job in test_jobs:
+        if configuration.fail_fast:
+            test_job = attr.evolve(test_job, fail_fast=True)
+
+        job_references.append(JobReference.from_job(test_job))
+        yield test_job
+
+    yield create_all_job(other_jobs=job_references)
+
+
+def create_pipeline(configuration, configuration_path, lazy=False):
+    jobs = create_jobs(
+        configuration=configuration,
+        configuration_path=configuration_path,
+    )
+
+    if not lazy:
+        jobs = pvector(jobs)
+
+    return Pipeline(
+        name=configuration.name,
+        configuration_path=configuration_path,
+        jobs=jobs,
+        paths=configuration.paths,
+        paths_ignore=configuration.paths_ignore,
+        cancel_superseded=configuration.cancel_superseded_runs,
+    )
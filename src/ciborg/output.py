@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import ciborg
+
+
+fingerprint_prefix = '# ciborg fingerprint: '
+
+
+def normalize_configuration(marshalled):
+    return json.dumps(marshalled, sort_keys=True, separators=(',', ':'))
+
+
+def fingerprint(marshalled, backend, output_path, version=None):
+    if version is None:
+        version = ciborg.__version__
+
+    hasher = hashlib.sha256()
+
+    for piece in [
+        normalize_configuration(marshalled),
+        version,
+        backend,
+        pathlib.PurePath(output_path).as_posix(),
+    ]:
+        hasher.update(piece.encode('utf-8'))
+        hasher.update(b'\0')
+
+    return 'sha256:' + hasher.hexdigest()
+
+
+def create_header(fingerprint):
+    return fingerprint_prefix + fingerprint + '\n'
+
+
+def read_fingerprint(path):
+    try:
+        with open(path, encoding='utf-8') as file:
+            first_line = file.readline()
+    except FileNotFoundError:
+        return None
+
+    if not first_line.startswith(fingerprint_prefix):
+        return None
+
+    return first_line[len(fingerprint_prefix):].strip()
+
+
+def read_text(path):
+    try:
+        with open(path, encoding='utf-8') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_if_changed(path, write):
+    path = pathlib.Path(path)
+
+    file_descriptor, temporary_name = tempfile.mkstemp(
+        dir=path.parent,
+        prefix='.{}.'.format(path.name),
+        suffix='.tmp',
+    )
+
+    try:
+        with open(file_descriptor, 'w', encoding='utf-8') as file:
+            write(file)
+
+        with open(temporary_name, 'rb') as file:
+            new = file.read()
+
+        try:
+            with open(path, 'rb') as file:
+                old = file.read()
+        except FileNotFoundError:
+            old = None
+
+        if new == old:
+            return False
+
+        if old is None:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary_name, 0o666 & ~umask)
+        else:
+            os.chmod(temporary_name, path.stat().st_mode)
+
+        os.replace(temporary_name, path)
+
+        return True
+    finally:
+        if os.path.exists(temporary_name):
+            os.remove(temporary_name)
@@ -0,0 +1,351 @@
+"""Lay out the test jobs from recorded durations.
+
+Long environments are split into shards and short compatible ones are packed
+into a single job for as long as that lowers the predicted makespan, the
+wall time until the last test job finishes on a given number of runners.
+The result is written back to the configuration as the ``shards`` and
+``pack`` of each environment so generation itself stays independent of the
+timings.
+
+Shards still divide the test files by hash, as they run, and the recorded
+test file durations only predict how long each shard takes.
+"""
+import heapq
+import statistics
+
+import attr
+from pyrsistent import pvector
+
+import ciborg.intermediate
+import ciborg.sharding
+import ciborg.timings
+
+
+def makespan(durations, runners):
+    """Predict the makespan of scheduling the longest job first onto the
+    runner that frees up first.
+    """
+    loads = [0] * min(runners, max(len(durations), 1))
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(loads, loads[0] + duration)
+
+    return max(loads)
+
+
+@attr.s(frozen=True)
+class Unit:
+    """An environment to plan for and its predicted duration."""
+
+    index = attr.ib()
+    key = attr.ib()
+    seconds = attr.ib()
+    timing = attr.ib()
+    # Environments can only be packed with others of the same class.
+    pack_class = attr.ib()
+
+    def shard_seconds(self, count):
+        if count == 1:
+            return [self.seconds]
+
+        if self.timing is None or len(self.timing.tests) == 0:
+            return [self.seconds / count] * count
+
+        shards = [self.timing.overhead()] * count
+        for path, seconds in self.timing.tests.items():
+            shards[ciborg.sharding.shard_of(path, count)] += seconds
+
+        return shards
+
+    def max_shards(self, runners):
+        if self.timing is None or len(self.timing.tests) == 0:
+            return runners
+
+        return min(runners, len(self.timing.tests))
+
+
+@attr.s(frozen=True)
+class PlannedJob:
+    indexes = attr.ib(converter=pvector)
+    keys = attr.ib(converter=pvector)
+    seconds = attr.ib()
+    shard = attr.ib(default=None)
+
+
+@attr.s(frozen=True)
+class Plan:
+    runners = attr.ib()
+    job_overhead = attr.ib()
+    jobs = attr.ib(converter=pvector)
+    # Per test environment, in the configuration order.
+    shards = attr.ib(converter=pvector)
+    packs = attr.ib(converter=pvector)
+    unplanned_makespan = attr.ib()
+    # Environments without recorded timings, predicted at the mean.
+    missing = attr.ib(converter=pvector)
+
+    def makespan(self):
+        return makespan(
+            durations=[job.seconds for job in self.jobs],
+            runners=self.runners,
+        )
+
+    def format(self):
+        lines = [
+            '{:<48} {:>10}'.format('job', 'seconds'),
+        ]
+        for job in self.jobs:
+            name = ' + '.join(job.keys)
+            if job.shard is not None:
+                name += ' ({})'.format(job.shard.display_string())
+
+            lines.append('{:<48} {:>10.1f}'.format(name, job.seconds))
+
+        lines.append(
+            '{jobs} jobs on {runners} runners, predicted makespan'
+            ' {makespan:.1f}s, {unplanned:.1f}s with one job per'
+            ' environment'.format(
+                jobs=len(self.jobs),
+                runners=self.runners,
+                makespan=self.makespan(),
+                unplanned=self.unplanned_makespan,
+            ),
+        )
+
+        if len(self.missing) > 0:
+            lines.append(
+                'No timings for: {}'.format(', '.join(self.missing)),
+            )
+
+        return '\n'.join(lines)
+
+    def apply(self, marshalled):
+        """Return the marshalled configuration with the planned shards and
+        packs of the test environments.
+        """
+        test_environments = []
+        for environment, shards, pack in zip(
+                marshalled['test_environments'],
+                self.shards,
+                self.packs,
+        ):
+            environment = {
+                key: value
+                for key, value in environment.items()
+                if key not in {'shards', 'pack'}
+            }
+            if shards > 1:
+                environment['shards'] = shards
+            if pack is not None:
+                environment['pack'] = pack
+
+            test_environments.append(environment)
+
+        return {**marshalled, 'test_environments': test_environments}
+
+
+def create_units(test_environments, timings):
+    keys = [
+        ciborg.timings.environment_key(environment)
+        for environment in test_environments
+    ]
+    known = [
+        timings.get(key).seconds
+        for key in keys
+        if timings.get(key) is not None
+    ]
+    default_seconds = statistics.mean(known) if len(known) > 0 else 0
+
+    return [
+        Unit(
+            index=index,
+            key=key,
+            seconds=(
+                default_seconds
+                if timings.get(key) is None
+                else timings.get(key).seconds
+            ),
+            timing=timings.get(key),
+            pack_class=(
+                None
+                if environment.tox_cache
+                else (
+                    environment.platform,
+                    environment.interpreter,
+                    environment.version,
+                    environment.install_source,
+                )
+            ),
+        )
+        for index, (environment, key) in enumerate(
+            zip(test_environments, keys),
+        )
+    ]
+
+
+def layout_jobs(units, shards, packs, job_overhead):
+    # Packs are lists of unit indexes, any unit not in one runs alone.
+    packed = {index for pack in packs for index in pack}
+    jobs = [
+        PlannedJob(
+            indexes=pack,
+            keys=[units[index].key for index in pack],
+            seconds=job_overhead + sum(
+                units[index].seconds
+                for index in pack
+            ),
+        )
+        for pack in packs
+    ]
+
+    for unit in units:
+        if unit.index in packed:
+            continue
+
+        count = shards[unit.index]
+        for shard, seconds in zip(
+                ciborg.intermediate.shards_of(count),
+                unit.shard_seconds(count),
+        ):
+            jobs.append(
+                PlannedJob(
+                    indexes=[unit.index],
+                    keys=[unit.key],
+                    seconds=job_overhead + seconds,
+                    shard=shard,
+                ),
+            )
+
+    jobs.sort(key=lambda job: job.seconds, reverse=True)
+
+    return jobs
+
+
+def predict(units, shards, packs, job_overhead, runners):
+    jobs = layout_jobs(
+        units=units,
+        shards=shards,
+        packs=packs,
+        job_overhead=job_overhead,
+    )
+
+    return makespan([job.seconds for job in jobs], runners), jobs
+
+
+def split_longest(units, shards, packs, job_overhead, runners):
+    best, jobs = predict(units, shards, packs, job_overhead, runners)
+
+    while True:
+        # Keep splitting the longest job for as long as that helps.
+        if len(jobs) == 0 or len(jobs[0].indexes) > 1:
+            return shards
+
+        [index] = jobs[0].indexes
+        unit = units[index]
+        count = shards[unit.index] + 1
+        if count > unit.max_shards(runners):
+            return shards
+
+        candidate = {**shards, unit.index: count}
+        candidate_makespan, candidate_jobs = predict(
+            units,
+            candidate,
+            packs,
+            job_overhead,
+            runners,
+        )
+        if candidate_makespan >= best:
+            return shards
+
+        shards = candidate
+        best = candidate_makespan
+        jobs = candidate_jobs
+
+
+def pack_shortest(units, shards, job_overhead, runners):
+    packs = []
+    best, _ = predict(units, shards, packs, job_overhead, runners)
+
+    classes = {}
+    for unit in sorted(units, key=lambda unit: unit.seconds):
+        if unit.pack_class is not None and shards[unit.index] == 1:
+            classes.setdefault(unit.pack_class, []).append([unit.index])
+
+    # Merge the two shortest groups of a class while it doesn't lengthen
+    # the makespan.  Each merge saves the overhead of a job.
+    for groups in classes.values():
+        while len(groups) > 1:
+            groups.sort(
+                key=lambda group: sum(units[index].seconds for index in group),
+            )
+            merged = groups[0] + groups[1]
+            candidate = [
+                *packs,
+                *(group for group in groups[2:] if len(group) > 1),
+                merged,
+            ]
+            candidate_makespan, _ = predict(
+                units,
+                shards,
+                candidate,
+                job_overhead,
+                runners,
+            )
+            if candidate_makespan > best:
+                break
+
+            best = candidate_makespan
+            groups[:2] = [merged]
+
+        packs.extend(group for group in groups if len(group) > 1)
+
+    return packs
+
+
+def plan(test_environments, timings, runners, job_overhead=0):
+    units = create_units(
+        test_environments=test_environments,
+        timings=timings,
+    )
+    unsplit = {unit.index: 1 for unit in units}
+
+    unplanned_makespan, _ = predict(
+        units=units,
+        shards=unsplit,
+        packs=[],
+        job_overhead=job_overhead,
+        runners=runners,
+    )
+
+    shards = split_longest(
+        units=units,
+        shards=unsplit,
+        packs=[],
+        job_overhead=job_overhead,
+        runners=runners,
+    )
+    packs = pack_shortest(
+        units=units,
+        shards=shards,
+        job_overhead=job_overhead,
+        runners=runners,
+    )
+
+    pack_names = {}
+    for pack in packs:
+        for index in pack:
+            pack_names[index] = units[min(pack)].key
+
+    return Plan(
+        runners=runners,
+        job_overhead=job_overhead,
+        jobs=layout_jobs(
+            units=units,
+            shards=shards,
+            packs=packs,
+            job_overhead=job_overhead,
+        ),
+        shards=[shards[unit.index] for unit in units],
+        packs=[pack_names.get(unit.index) for unit in units],
+        unplanned_makespan=unplanned_makespan,
+        missing=[unit.key for unit in units if unit.timing is None],
+    )
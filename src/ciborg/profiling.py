@@ -0,0 +1,179 @@
+"""Wall time and allocation measurements for the phases of a generation.
+
+Phases are marked with :func:`phase` throughout ciborg and cost nothing
+unless a :class:`Profiler` has been activated with :func:`profile`.  Phases
+run once each in the regular commands but a repeated name, such as when
+streaming interleaves building and emitting jobs, is accumulated.
+"""
+import contextlib
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import attr
+
+import ciborg
+
+
+active = None
+
+
+@attr.s(frozen=True)
+class PhaseTiming:
+    name = attr.ib()
+    seconds = attr.ib()
+    # Net bytes still allocated at the end of the phase and the most bytes
+    # allocated at once during it, both relative to the start.  None when
+    # memory was not traced.
+    allocated_bytes = attr.ib(default=None)
+    peak_bytes = attr.ib(default=None)
+    calls = attr.ib(default=1)
+
+    def merge(self, other):
+        def add(a, b):
+            if a is None or b is None:
+                return None
+
+            return a + b
+
+        return attr.evolve(
+            self,
+            seconds=self.seconds + other.seconds,
+            allocated_bytes=add(self.allocated_bytes, other.allocated_bytes),
+            peak_bytes=(
+                None
+                if self.peak_bytes is None or other.peak_bytes is None
+                else max(self.peak_bytes, other.peak_bytes)
+            ),
+            calls=self.calls + other.calls,
+        )
+
+
+@attr.s
+class Profiler:
+    trace_memory = attr.ib(default=True)
+    timings = attr.ib(factory=dict)
+    _depth = attr.ib(default=0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Only the outermost phase is recorded so that nested markers, such
+        # as marshalling inside a dump, don't count their time twice.
+        if self._depth > 0:
+            yield
+            return
+
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start_bytes, _ = tracemalloc.get_traced_memory()
+
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._depth -= 1
+
+            allocated_bytes = None
+            peak_bytes = None
+            if tracing:
+                end_bytes, peak = tracemalloc.get_traced_memory()
+                allocated_bytes = end_bytes - start_bytes
+                if hasattr(tracemalloc, 'reset_peak'):
+                    peak_bytes = max(0, peak - start_bytes)
+
+            timing = PhaseTiming(
+                name=name,
+                seconds=seconds,
+                allocated_bytes=allocated_bytes,
+                peak_bytes=peak_bytes,
+            )
+
+            existing = self.timings.get(name)
+            self.timings[name] = (
+                timing if existing is None else existing.merge(timing)
+            )
+
+    def report(self):
+        return {
+            'ciborg': ciborg.__version__,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'phases': [
+                attr.asdict(timing) for timing in self.timings.values()
+            ],
+        }
+
+    def dump_report(self, file):
+        json.dump(self.report(), file, indent=4)
+        file.write('\n')
+
+    def format(self):
+        lines = ['{:<12} {:>10} {:>14} {:>14}'.format(
+            'phase', 'seconds', 'allocated', 'peak',
+        )]
+
+        for timing in self.timings.values():
+            lines.append('{:<12} {:>10.4f} {:>14} {:>14}'.format(
+                timing.name,
+                timing.seconds,
+                '-' if timing.allocated_bytes is None
+                else timing.allocated_bytes,
+                '-' if timing.peak_bytes is None else timing.peak_bytes,
+            ))
+
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profile(trace_memory=True, stats_path=None):
+    """Record the phases run within the block in the yielded profiler.
+
+    With ``stats_path`` the block is also run under :mod:`cProfile` and the
+    statistics are written there for :mod:`pstats`.
+    """
+    global active
+
+    if active is not None:
+        raise Exception('Profiling is already active')
+
+    profiler = Profiler(trace_memory=trace_memory)
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    c_profile = None
+    if stats_path is not None:
+        import cProfile
+
+        c_profile = cProfile.Profile()
+        c_profile.enable()
+
+    active = profiler
+    try:
+        yield profiler
+    finally:
+        active = None
+
+        if c_profile is not None:
+            c_profile.disable()
+            c_profile.dump_stats(str(stats_path))
+
+        if started_tracing:
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def phase(name):
+    if active is None:
+        yield
+        return
+
+    with active.phase(name):
+        yield
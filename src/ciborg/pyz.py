@@ -0,0 +1,127 @@
+"""Build ciborg and its dependencies into a single zipapp file.
+
+CI jobs that only generate and compare the outputs can download and run the
+one file rather than resolve and install ciborg from an index.  Compiled
+extension modules can't be imported from a zip so they are left out and the
+pure Python fallbacks of the dependencies, such as those of PyYAML and
+pyrsistent, are used instead.
+
+Unless constraints such as lock files are given the dependencies are pinned
+to the versions installed alongside the running ciborg, so the zipapp runs
+the same combination rather than whatever is latest.
+"""
+import pathlib
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipapp
+
+try:
+    import importlib.metadata as metadata
+except ImportError:
+    import importlib_metadata as metadata
+
+
+main = 'ciborg.cli:cli'
+interpreter = '/usr/bin/env python3'
+compiled_suffixes = ('.so', '.pyd', '.dylib')
+
+
+def installed_pins():
+    """Requirements pinning the distributions installed with this ciborg."""
+    pins = set()
+    for distribution in metadata.distributions():
+        name = distribution.metadata['Name']
+        if name is None or name.lower() == 'ciborg':
+            continue
+
+        pins.add('{}=={}'.format(name, distribution.version))
+
+    return sorted(pins)
+
+
+def install(requirements, directory, constraints=()):
+    subprocess.run(
+        [
+            sys.executable,
+            '-m',
+            'pip',
+            'install',
+            '--disable-pip-version-check',
+            '--no-compile',
+            '--target',
+            str(directory),
+            *(
+                argument
+                for constraint in constraints
+                for argument in ['--constraint', str(constraint)]
+            ),
+            *requirements,
+        ],
+        check=True,
+    )
+
+
+def strip(directory):
+    """Remove what can't run from inside the zip, or isn't needed to."""
+    removed = []
+
+    for path in sorted(directory.rglob('*')):
+        if path.is_file() and path.name.endswith(compiled_suffixes):
+            path.unlink()
+            removed.append(path.relative_to(directory))
+
+    for name in ['bin', '__pycache__']:
+        for path in sorted(directory.rglob(name), reverse=True):
+            if path.is_dir():
+                shutil.rmtree(path)
+
+    return removed
+
+
+def create(directory, output):
+    zipapp.create_archive(
+        source=directory,
+        target=output,
+        interpreter=interpreter,
+        main=main,
+        compressed=True,
+    )
+
+
+def build(requirements, output, constraints=None):
+    with tempfile.TemporaryDirectory() as temporary:
+        temporary = pathlib.Path(temporary)
+
+        if constraints is None:
+            pins = temporary / 'constraints.txt'
+            pins.write_text(''.join(pin + '\n' for pin in installed_pins()))
+            constraints = [pins]
+
+        directory = temporary / 'target'
+        install(
+            requirements=requirements,
+            directory=directory,
+            constraints=constraints,
+        )
+        removed = strip(directory)
+        create(directory=directory, output=output)
+
+    return removed
+
+
+def fetch_commands(url, path):
+    """Shell commands downloading the zipapp to ``path`` unless it is there
+    already, such as when restored from a cache.
+    """
+    directory = path.rpartition('/')[0]
+
+    return [
+        'if [ ! -f {} ]; then'.format(path),
+        '    mkdir -p {}'.format(directory),
+        '    curl --fail --silent --show-error --location --output {} {}'
+        .format(path, shlex.quote(url)),
+        'fi',
+    ]
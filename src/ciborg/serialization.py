@@ -0,0 +1,333 @@
+"""Direct-to-dict serializers compiled from the marshmallow dump schemas.
+
+The marshmallow schemas in :mod:`ciborg.azure` and :mod:`ciborg.github` remain
+the reference definition of the output.  This module walks each schema class
+once and builds a plain function producing the same basic types so that the
+per-object field lookup, schema instantiation and hook dispatch costs are not
+paid for every node in large pipelines.
+
+Within :func:`memoized` each distinct nested object is serialized only once
+and the resulting basic types are shared wherever the object appears again.
+Callers must treat the results as read only.
+"""
+import collections
+import contextlib
+
+import marshmallow
+import marshmallow.class_registry
+import marshmallow.decorators
+import marshmallow.fields
+import marshmallow_polyfield
+
+
+_MISSING = marshmallow.missing
+
+field_compilers = {}
+post_dump_replacements = {}
+
+_memo = None
+
+# Enough for the steps shared across the jobs of a streamed pipeline without
+# holding on to every job.
+streaming_memo_size = 1024
+
+
+class Memo:
+    """Serialized results keyed on the identity of the source object.
+
+    The objects are kept alive alongside their results so an identity can't
+    be reused while its entry exists.  With ``maxsize`` the least recently
+    used entries are dropped so streaming keeps a bounded footprint.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+
+    def lookup(self, obj):
+        entry = self.entries.get(id(obj))
+        if entry is None:
+            return _MISSING
+
+        if self.maxsize is not None:
+            self.entries.move_to_end(id(obj))
+        self.hits += 1
+
+        return entry[1]
+
+    def store(self, obj, result):
+        self.entries[id(obj)] = (obj, result)
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+@contextlib.contextmanager
+def memoized(maxsize=None):
+    global _memo
+
+    if _memo is not None:
+        yield _memo
+        return
+
+    _memo = Memo(maxsize=maxsize)
+    try:
+        yield _memo
+    finally:
+        _memo = None
+
+
+def memoize(serialize):
+    def serialize_memoized(value):
+        memo = _memo
+        if memo is None:
+            return serialize(value)
+
+        result = memo.lookup(value)
+        if result is _MISSING:
+            result = serialize(value)
+            memo.store(value, result)
+
+        return result
+
+    return serialize_memoized
+
+
+def register_field_compiler(field_type):
+    def decorator(compiler):
+        field_compilers[field_type] = compiler
+
+        return compiler
+
+    return decorator
+
+
+def resolve_schema_class(nested):
+    if isinstance(nested, str):
+        return marshmallow.class_registry.get_class(nested)
+
+    if isinstance(nested, marshmallow.Schema):
+        return type(nested)
+
+    return nested
+
+
+def compile_field(field):
+    for field_type in type(field).__mro__:
+        compiler = field_compilers.get(field_type)
+        if compiler is not None:
+            return compiler(field)
+
+    raise Exception('Unsupported field type: {!r}'.format(type(field)))
+
+
+def _none_or(serialize):
+    def serialize_or_none(value):
+        if value is None:
+            return None
+
+        return serialize(value)
+
+    return serialize_or_none
+
+
+@register_field_compiler(marshmallow.fields.String)
+def _compile_string(field):
+    return _none_or(str)
+
+
+@register_field_compiler(marshmallow.fields.Boolean)
+def _compile_boolean(field):
+    return _none_or(bool)
+
+
+@register_field_compiler(marshmallow.fields.Integer)
+def _compile_integer(field):
+    return _none_or(int)
+
+
+@register_field_compiler(marshmallow.fields.List)
+def _compile_list(field):
+    serialize_item = compile_field(field.inner)
+
+    def serialize_list(value):
+        return [serialize_item(item) for item in value]
+
+    return _none_or(serialize_list)
+
+
+@register_field_compiler(marshmallow.fields.Mapping)
+def _compile_mapping(field):
+    mapping_type = field.mapping_type
+
+    if field.key_field is None and field.value_field is None:
+        return _none_or(lambda value: value)
+
+    serialize_key = (
+        (lambda key: key)
+        if field.key_field is None
+        else compile_field(field.key_field)
+    )
+    serialize_value = (
+        (lambda value: value)
+        if field.value_field is None
+        else compile_field(field.value_field)
+    )
+
+    def serialize_mapping(value):
+        return mapping_type(
+            (serialize_key(key), serialize_value(item))
+            for key, item in value.items()
+        )
+
+    return _none_or(serialize_mapping)
+
+
+@register_field_compiler(marshmallow.fields.Nested)
+def _compile_nested(field):
+    schema_class = resolve_schema_class(field.nested)
+    # Resolved at call time since nested references may be recursive.
+    state = {}
+
+    @memoize
+    def serialize_nested(value):
+        serialize = state.get('serialize')
+        if serialize is None:
+            serialize = state['serialize'] = serializer(schema_class)
+
+        return serialize(value)
+
+    if field.many:
+        def serialize_many(value):
+            return [serialize_nested(item) for item in value]
+
+        return _none_or(serialize_many)
+
+    return _none_or(serialize_nested)
+
+
+@register_field_compiler(marshmallow.fields.Pluck)
+def _compile_pluck(field):
+    schema_class = resolve_schema_class(field.nested)
+    plucked_field = schema_class._declared_fields[field.field_name]
+    attribute = (
+        plucked_field.attribute
+        if plucked_field.attribute is not None
+        else field.field_name
+    )
+    serialize_plucked = compile_field(plucked_field)
+
+    def serialize_pluck(value):
+        return serialize_plucked(getattr(value, attribute))
+
+    if field.many:
+        def serialize_many(value):
+            return [serialize_pluck(item) for item in value]
+
+        return _none_or(serialize_many)
+
+    return _none_or(serialize_pluck)
+
+
+@register_field_compiler(marshmallow_polyfield.PolyField)
+def _compile_poly_field(field):
+    selector = field.serialization_schema_selector
+    by_type = {}
+
+    @memoize
+    def serialize_poly(value):
+        value_type = type(value)
+        serialize = by_type.get(value_type)
+        if serialize is None:
+            # The selectors in this package dispatch on type alone, so the
+            # selection for the first instance of a type holds for all of them.
+            schema_class = resolve_schema_class(selector(value, None))
+            serialize = by_type[value_type] = serializer(schema_class)
+
+        return serialize(value)
+
+    if field.many:
+        def serialize_many(value):
+            return [serialize_poly(item) for item in value]
+
+        return _none_or(serialize_many)
+
+    return _none_or(serialize_poly)
+
+
+def _compile_post_dump_hooks(schema_class):
+    hooks = schema_class._hooks[(marshmallow.decorators.POST_DUMP, False)]
+    if len(schema_class._hooks[(marshmallow.decorators.POST_DUMP, True)]) > 0:
+        raise Exception(
+            'pass_many post_dump hooks are not supported: {!r}'.format(
+                schema_class,
+            ),
+        )
+
+    compiled = []
+    schema = None
+
+    for name in hooks:
+        replacement = post_dump_replacements.get(getattr(schema_class, name))
+        if replacement is not None:
+            compiled.append(replacement)
+            continue
+
+        if schema is None:
+            schema = schema_class()
+
+        bound = getattr(schema, name)
+        compiled.append(lambda data, bound=bound: bound(data, many=False))
+
+    return compiled
+
+
+def compile_schema(schema_class):
+    dict_class = (
+        collections.OrderedDict
+        if schema_class.opts.ordered
+        else dict
+    )
+
+    fields = [
+        (
+            name if field.attribute is None else field.attribute,
+            name if field.data_key is None else field.data_key,
+            compile_field(field),
+        )
+        for name, field in schema_class._declared_fields.items()
+        if not field.load_only
+    ]
+
+    post_dump_hooks = _compile_post_dump_hooks(schema_class)
+
+    def serialize(obj):
+        result = dict_class()
+
+        for attribute, key, serialize_field in fields:
+            value = getattr(obj, attribute, _MISSING)
+            if value is _MISSING:
+                continue
+
+            result[key] = serialize_field(value)
+
+        for hook in post_dump_hooks:
+            result = hook(result)
+
+        return result
+
+    serialize.__name__ = 'serialize_{}'.format(schema_class.__name__)
+
+    return serialize
+
+
+_serializers = {}
+
+
+def serializer(schema_class):
+    compiled = _serializers.get(schema_class)
+
+    if compiled is None:
+        compiled = _serializers[schema_class] = compile_schema(schema_class)
+
+    return compiled
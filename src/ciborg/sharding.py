@@ -0,0 +1,77 @@
+"""Deterministic assignment of test files to the shards of an environment.
+
+The selection runs on the CI machines where ciborg is not installed so
+:data:`selection_script` is a self contained equivalent of :func:`select` to
+be run with ``python -c``.
+"""
+import fnmatch
+import hashlib
+import posixpath
+
+
+test_file_patterns = ('test_*.py', '*_test.py')
+
+files_variable = 'SHARD_FILES'
+
+
+def is_test_file(path):
+    name = posixpath.basename(path)
+
+    return any(
+        fnmatch.fnmatchcase(name, pattern)
+        for pattern in test_file_patterns
+    )
+
+
+def shard_of(path, count):
+    digest = hashlib.sha256(path.encode('utf-8')).hexdigest()
+
+    return int(digest, 16) % count
+
+
+def select(paths, index, count):
+    return [
+        path
+        for path in paths
+        if is_test_file(path) and shard_of(path, count) == index
+    ]
+
+
+# Takes the shard index and count as arguments and prints the selected files
+# tracked by git.
+selection_script = '; '.join([
+    'import fnmatch, hashlib, posixpath, subprocess, sys',
+    'index, count = map(int, sys.argv[1:])',
+    'paths = subprocess.check_output(["git", "ls-files"],'
+    ' universal_newlines=True).splitlines()',
+    'print(" ".join(path for path in paths if any(fnmatch.fnmatchcase('
+    'posixpath.basename(path), pattern) for pattern in ({patterns},))'
+    ' and int(hashlib.sha256(path.encode("utf-8")).hexdigest(), 16)'
+    ' % count == index))'.format(
+        patterns=', '.join(
+            '"{}"'.format(pattern)
+            for pattern in test_file_patterns
+        ),
+    ),
+])
+
+
+def commands(index, count):
+    """Shell commands selecting the files of the shard into
+    :data:`files_variable`.  Pass ``posargs`` to tox after them.
+    """
+    return [
+        '{variable}="$(python -c \'{script}\' {index} {count})"'.format(
+            variable=files_variable,
+            script=selection_script,
+            index=index,
+            count=count,
+        ),
+        'if [ -z "${{{}}}" ]; then'.format(files_variable),
+        '    echo "No test files in this shard"',
+        '    exit 0',
+        'fi',
+    ]
+
+
+posargs = ' -- ${{{}}}'.format(files_variable)
@@ -2,6 +2,7 @@ import attr
 import importlib_resources
 import pytest
 
+import ciborg.azure
 import ciborg.configuration
 
 
@@ -23,3 +24,18 @@ def configuration(raw_configuration):
     return configuration
 
 
+@pytest.fixture(
+    params=[
+        pytest.param(ciborg.azure.TidyOrderedDictDumper, id='python'),
+        pytest.param(
+            getattr(ciborg.azure, 'TidyOrderedDictCDumper', None),
+            id='libyaml',
+            marks=pytest.mark.skipif(
+                not hasattr(ciborg.azure, 'TidyOrderedDictCDumper'),
+                reason='libyaml not available',
+            ),
+        ),
+    ],
+)
+def dumper(request):
+    return request.param
@@ -1,10 +1,16 @@
+import io
+import os
 import pathlib
+import subprocess
 
+import attr
 import importlib_resources
 import pytest
+import yaml
 
 import ciborg.azure
 import ciborg.configuration
+import ciborg.intermediate
 
 
 @pytest.fixture
@@ -20,12 +26,467 @@ def azure_yaml():
     return content
 
 
-def test_dump_to_azure(configuration, azure_yaml):
+def test_dump_to_azure(configuration, azure_yaml, dumper):
     pipeline = ciborg.azure.create_pipeline(
         configuration=configuration,
         configuration_path=pathlib.Path('ciborg.json'),
         output_path=pathlib.Path('azure-pipelines.yml'),
     )
-    dumped_pipeline = ciborg.azure.dump_pipeline(pipeline=pipeline)
+    dumped_pipeline = ciborg.azure.dump_pipeline(
+        pipeline=pipeline,
+        dumper=dumper,
+    )
 
     assert azure_yaml == dumped_pipeline
+
+
+def test_compiled_marshal_matches_schema(configuration):
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    reference = ciborg.azure.PipelineSchema().dump(pipeline)
+
+    assert ciborg.azure.marshal_pipeline(pipeline=pipeline) == reference
+
+
+def test_stream_matches_dump(configuration, azure_yaml, dumper):
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+        lazy=True,
+    )
+
+    stream = io.StringIO()
+    ciborg.azure.stream_pipeline(
+        pipeline=pipeline,
+        stream=stream,
+        dumper=dumper,
+    )
+
+    assert azure_yaml == stream.getvalue()
+
+
+def test_marshal_shares_identical_steps(configuration, azure_yaml, dumper):
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    steps = [
+        step
+        for job in marshalled['stages'][0]['jobs']
+        for step in job['steps']
+    ]
+
+    assert len({id(step) for step in steps}) < len(steps)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    dumped = yaml.dump(marshalled, sort_keys=False, Dumper=dumper)
+    assert dumped == azure_yaml
+
+
+def test_matrix_legs_match_environments(configuration):
+    configuration = attr.evolve(configuration, matrix=True)
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    legs = [
+        leg
+        for job in marshalled['stages'][0]['jobs']
+        if 'strategy' in job
+        for leg in job['strategy']['matrix'].values()
+    ]
+    expected = [
+        {
+            'vm_image': ciborg.azure.vm_images[environment.platform].id_name,
+            'python_version': environment.version.display_string,
+            'tox_environment': (
+                environment.tox_environment
+                or 'py' + environment.version.joined_by('')
+            ),
+        }
+        for environment in configuration.test_environments
+    ]
+
+    assert legs == expected
+
+
+def test_pip_cache_keyed_on_lock_file(configuration):
+    configuration = attr.evolve(configuration, pip_cache=True)
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    for job in marshalled['stages'][0]['jobs']:
+        caches = [
+            step
+            for step in job['steps']
+            if step.get('task') == 'Cache@2'
+        ]
+
+        if not job['job'].startswith('tox_'):
+            assert caches == []
+            continue
+
+        [cache] = caches
+        assert cache['inputs']['key'].endswith(
+            ' | requirements/test.linux.txt | tox.ini',
+        )
+        assert job['variables']['PIP_CACHE_DIR'] == cache['inputs']['path']
+
+
+def assert_only_files_unquoted(key, files):
+    for segment in key.split(' | '):
+        if segment in files:
+            continue
+
+        quoted = segment.startswith('"') and segment.endswith('"')
+        assert quoted or segment.isidentifier(), segment
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+def test_cache_keys_quote_strings(configuration, matrix):
+    configuration = attr.evolve(
+        configuration,
+        pip_cache=True,
+        matrix=matrix,
+        test_environments=[
+            attr.evolve(environment, tox_cache=True)
+            for environment in configuration.test_environments
+        ],
+    )
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    caches = [
+        step['inputs']
+        for job in marshalled['stages'][0]['jobs']
+        for step in job['steps']
+        if step.get('task') == 'Cache@2'
+    ]
+    assert len(caches) > 0
+
+    files = {'requirements/test.linux.txt', '$(lock_file)', 'tox.ini'}
+    for inputs in caches:
+        assert_only_files_unquoted(inputs['key'], files)
+        restore_keys = inputs.get('restoreKeys', '')
+        for restore_key in restore_keys.splitlines():
+            assert_only_files_unquoted(restore_key, files)
+
+
+def test_tox_cache_restores_only_exact_matches(configuration):
+    [first, *rest] = configuration.test_environments
+    configuration = attr.evolve(
+        configuration,
+        test_environments=[attr.evolve(first, tox_cache=True), *rest],
+    )
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    caches = {
+        job['job']: step
+        for job in marshalled['stages'][0]['jobs']
+        for step, next_step in zip(job['steps'], job['steps'][1:])
+        if step.get('task') == 'Cache@2'
+        and next_step['displayName'] == 'Tox'
+    }
+
+    assert list(caches) == ['tox_typehints_linux_cpython_3_8']
+    [cache] = caches.values()
+    assert cache['inputs'] == {
+        'key': (
+            'tox | "$(Agent.OS)" | "3.8" | "typehints" | tox.ini'
+            ' | requirements/test.linux.txt'
+        ),
+        'path': '$(System.DefaultWorkingDirectory)/.tox/typehints',
+    }
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+def test_specific_wheels_gate_only_their_tests(configuration, matrix):
+    configuration = attr.evolve(
+        configuration,
+        build_wheel='specific',
+        matrix=matrix,
+        test_environments=[
+            attr.evolve(
+                environment,
+                install_source=ciborg.configuration.bdist_install_source,
+            )
+            for environment in configuration.test_environments
+        ],
+    )
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    jobs = {job['job']: job for job in marshalled['stages'][0]['jobs']}
+    wheel_jobs = {
+        name: job['steps'][-1]['inputs']['artifactName']
+        for name, job in jobs.items()
+        if name.startswith('bdist_')
+    }
+    expected = {
+        'bdist_{}'.format(environment.identifier()[:-len('_bdist')])
+        for environment in configuration.test_environments
+    }
+    assert set(wheel_jobs) == expected
+    assert len(set(wheel_jobs.values())) == len(wheel_jobs)
+
+    test_jobs = [job for name, job in jobs.items() if name.startswith('tox')]
+    assert len(test_jobs) > 0
+    for job in test_jobs:
+        [build] = job['dependsOn']
+        [download] = [
+            step
+            for step in job['steps']
+            if step.get('task') == 'DownloadBuildArtifacts@0'
+        ]
+        assert download['inputs']['artifactName'] == wheel_jobs[build]
+
+
+def test_path_filters_and_verify_only_when_changed(configuration):
+    configuration = attr.evolve(
+        configuration,
+        paths=['src/**'],
+        paths_ignore=['docs/**'],
+        verify_only_when_changed=True,
+    )
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    paths = {
+        'include': ['src/**', 'ciborg.json', 'azure-pipelines.yml'],
+        'exclude': ['docs/**'],
+    }
+    assert marshalled['trigger']['paths'] == paths
+    assert marshalled['pr']['paths'] == paths
+
+    [verify] = [
+        job
+        for job in marshalled['stages'][0]['jobs']
+        if job['job'] == 'verify_up_to_date'
+    ]
+    checkout, changes, *rest = verify['steps']
+    assert checkout == {'checkout': 'self', 'fetchDepth': 2}
+    assert "'ciborg.json' 'azure-pipelines.yml'" in changes['bash']
+    assert 'condition' not in changes
+    assert len(rest) > 0
+    assert all(
+        step['condition'] == ciborg.azure.changed_condition
+        for step in rest
+    )
+
+    others = [
+        step
+        for job in marshalled['stages'][0]['jobs']
+        if job['job'] != 'verify_up_to_date'
+        for step in job['steps']
+    ]
+    assert not any('condition' in step for step in others)
+
+
+@pytest.fixture
+def pushed_repository(tmp_path):
+    # The configuration changes in the first of two pushed commits.
+    def git(*arguments):
+        return subprocess.run(
+            ['git', '-c', 'user.name=ciborg', '-c', 'user.email=ciborg@test']
+            + list(arguments),
+            check=True,
+            cwd=tmp_path,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout.strip()
+
+    git('init', '--quiet')
+    for name, content in [
+            ('ciborg.json', '{}'),
+            ('ciborg.json', '{"name": "x"}'),
+            ('README.rst', 'x'),
+    ]:
+        (tmp_path / name).write_text(content)
+        git('add', name)
+        git('commit', '--quiet', '--message', name)
+
+    return tmp_path, git('rev-parse', 'HEAD~2')
+
+
+@pytest.mark.parametrize(
+    argnames='base, reason, changed',
+    argvalues=[
+        ('before', None, 'true'),
+        ('HEAD^1', None, 'false'),
+        ('', None, 'true'),
+        ('0' * 40, None, 'true'),
+        (ciborg.azure.changes_base, 'PullRequest', 'false'),
+        (ciborg.azure.changes_base, 'IndividualCI', 'true'),
+    ],
+)
+def test_changes_commands(pushed_repository, base, reason, changed):
+    directory, before = pushed_repository
+    if base == 'before':
+        base = before
+
+    environment = dict(os.environ)
+    if reason is not None:
+        environment['BUILD_REASON'] = reason
+
+    completed = subprocess.run(
+        [
+            'bash',
+            '-c',
+            '\n'.join(ciborg.intermediate.changes_commands(
+                paths=['ciborg.json'],
+                base=base,
+            )),
+        ],
+        check=True,
+        cwd=directory,
+        env=environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+
+    assert completed.stdout.splitlines()[-1] == 'Changed: ' + changed
+
+
+@pytest.mark.parametrize(
+    argnames='paths, paths_ignore, expected',
+    argvalues=[
+        ([], ['docs/*'], {
+            'include': ['*', 'ci/ciborg.json', 'ci/azure-pipelines.yml'],
+            'exclude': ['docs/*'],
+        }),
+        (['src/*'], ['ci/*.json', '*.yml', 'docs/*'], {
+            'include': ['src/*', 'ci/ciborg.json', 'ci/azure-pipelines.yml'],
+            'exclude': ['docs/*'],
+        }),
+    ],
+)
+def test_path_filters_keep_configuration_and_output(
+        configuration,
+        paths,
+        paths_ignore,
+        expected,
+):
+    configuration = attr.evolve(
+        configuration,
+        paths=paths,
+        paths_ignore=paths_ignore,
+    )
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ci', 'ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    assert marshalled['trigger']['paths'] == expected
+    assert marshalled['pr']['paths'] == expected
+
+
+@pytest.mark.parametrize(argnames='cancel', argvalues=[False, True])
+def test_cancel_superseded_runs_batches(configuration, cancel):
+    configuration = attr.evolve(configuration, cancel_superseded_runs=cancel)
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+    assert marshalled['trigger']['batch'] is cancel
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+@pytest.mark.parametrize(argnames='fail_fast', argvalues=[False, True])
+def test_fail_fast_cancels_build(configuration, matrix, fail_fast):
+    configuration = attr.evolve(
+        configuration,
+        matrix=matrix,
+        fail_fast=fail_fast,
+    )
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    assert marshalled == ciborg.azure.PipelineSchema().dump(pipeline)
+
+    cancel_step = ciborg.azure.BashStepSchema().dump(
+        ciborg.azure.create_cancel_run_step(),
+    )
+
+    for job in marshalled['stages'][0]['jobs']:
+        if job['pool'] == 'server':
+            continue
+
+        test_job = job['job'].startswith('tox')
+        assert (job['steps'][-1] == cancel_step) is (test_job and fail_fast)
+
+
+def test_failures_reach_the_all_job(configuration):
+    pipeline = ciborg.azure.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('azure-pipelines.yml'),
+    )
+
+    marshalled = ciborg.azure.marshal_pipeline(pipeline=pipeline)
+    jobs = marshalled['stages'][0]['jobs']
+
+    # Failures aren't downgraded to partial success and the join keeps the
+    # default condition of all its dependencies having succeeded.
+    assert not any('continueOnError' in job for job in jobs)
+    [all_job] = [job for job in jobs if job['job'] == 'all']
+    assert 'condition' not in all_job
+    assert all_job['dependsOn'] == [
+        job['job']
+        for job in jobs
+        if job['job'] != 'all'
+    ]
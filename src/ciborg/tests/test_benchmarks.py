@@ -0,0 +1,64 @@
+import json
+
+import click.testing
+
+import ciborg.benchmarks.memory
+import ciborg.benchmarks.scaling
+import ciborg.configuration
+
+
+def test_synthetic_configuration_loads_with_unique_identifiers():
+    marshalled = ciborg.benchmarks.scaling.synthetic_configuration(size=100)
+    configuration = ciborg.configuration.ConfigurationSchema().load(
+        marshalled,
+    )
+
+    identifiers = {
+        (environment.tox_environment, environment.identifier())
+        for environment in configuration.test_environments
+    }
+
+    assert len(identifiers) == 100
+
+
+def test_baseline_regression_fails(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    arguments = [
+        '--sizes',
+        '10',
+        '--repeat',
+        '1',
+        '--phase',
+        'load',
+        '--baseline',
+        str(baseline),
+    ]
+    runner = click.testing.CliRunner()
+
+    result = runner.invoke(ciborg.benchmarks.scaling.cli, arguments)
+    assert result.exit_code == 1
+    assert '--write-baseline' in result.output
+    assert not baseline.exists()
+
+    result = runner.invoke(
+        ciborg.benchmarks.scaling.cli,
+        [*arguments, '--write-baseline'],
+    )
+    assert result.exit_code == 0
+    assert baseline.exists()
+
+    marshalled = json.loads(baseline.read_text())
+    for result in marshalled['results']:
+        result['seconds'] /= 1000
+    baseline.write_text(json.dumps(marshalled))
+
+    result = runner.invoke(ciborg.benchmarks.scaling.cli, arguments)
+    assert result.exit_code == 1
+    assert 'load [10] seconds' in result.output
+
+
+def test_jobs_share_steps():
+    for name in ciborg.benchmarks.memory.models:
+        result = ciborg.benchmarks.memory.measure(name=name, size=100)
+
+        assert result.distinct_steps * 10 < result.steps
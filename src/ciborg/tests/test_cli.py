@@ -0,0 +1,400 @@
+import importlib
+import json
+import pathlib
+import pstats
+import shlex
+import shutil
+
+import click.testing
+import importlib_resources
+import pytest
+
+import ciborg.benchmarks.startup
+import ciborg.cli
+import ciborg.configuration
+import ciborg.data
+import ciborg.intermediate
+import ciborg.output
+import ciborg.profiling
+
+
+@pytest.fixture
+def configured_directory(tmp_path):
+    with importlib_resources.path(ciborg.data, 'ciborg.json') as path:
+        shutil.copy(path, tmp_path / 'ciborg.json')
+
+    return tmp_path
+
+
+def invoke(directory, *args):
+    runner = click.testing.CliRunner()
+
+    return runner.invoke(
+        ciborg.cli.cli,
+        [
+            *args,
+            '--configuration',
+            str(directory / 'ciborg.json'),
+            '--output',
+            str(directory / 'output.yml'),
+        ],
+        catch_exceptions=False,
+    )
+
+
+@pytest.mark.parametrize(argnames='backend', argvalues=['azure', 'github'])
+def test_unchanged_output_is_not_rewritten(configured_directory, backend):
+    output = configured_directory / 'output.yml'
+
+    assert invoke(configured_directory, backend).exit_code == 0
+    first_stat = output.stat()
+
+    assert invoke(configured_directory, backend).exit_code == 0
+    second_stat = output.stat()
+
+    assert first_stat.st_mtime_ns == second_stat.st_mtime_ns
+    assert first_stat.st_ino == second_stat.st_ino
+
+
+@pytest.mark.parametrize(argnames='backend', argvalues=['azure', 'github'])
+def test_check(configured_directory, backend):
+    output = configured_directory / 'output.yml'
+
+    assert invoke(configured_directory, backend, '--check').exit_code == 1
+
+    result = invoke(configured_directory, backend, '--fingerprint')
+    assert result.exit_code == 0
+    assert output.read_text().startswith(ciborg.output.fingerprint_prefix)
+
+    assert invoke(configured_directory, backend, '--check').exit_code == 0
+    assert invoke(
+        configured_directory,
+        backend,
+        '--full-check',
+        '--fingerprint',
+    ).exit_code == 0
+
+    output.write_text(output.read_text() + '# edited\n')
+    assert invoke(configured_directory, backend, '--check').exit_code == 0
+    assert invoke(
+        configured_directory,
+        backend,
+        '--full-check',
+        '--fingerprint',
+    ).exit_code == 1
+
+
+def run_verify_generate(directory, backend, monkeypatch):
+    """Run the Generate step of the verify job from the repository root."""
+    configuration_path = pathlib.Path('ciborg.json')
+    with open(directory / configuration_path) as file:
+        configuration = ciborg.configuration.load(file)
+
+    pipeline = ciborg.intermediate.create_pipeline(
+        configuration=configuration,
+        configuration_path=configuration_path,
+    )
+    [verify_job] = [
+        job
+        for job in pipeline.jobs
+        if job.id_name == 'verify_up_to_date'
+    ]
+    [step] = [
+        step
+        for step in verify_job.steps
+        if isinstance(step, ciborg.intermediate.GenerateStep)
+    ]
+    module = importlib.import_module(ciborg.cli.backends[backend]['module'])
+    command = module.lower_generate_step(
+        step,
+        output_path=pathlib.Path('output.yml'),
+    )
+    command = getattr(command, 'run', None) or command.script
+
+    arguments = shlex.split(command)
+    assert arguments[:3] == ['python', '-m', 'ciborg']
+
+    monkeypatch.chdir(directory)
+    runner = click.testing.CliRunner()
+
+    return arguments, runner.invoke(ciborg.cli.cli, arguments[3:])
+
+
+@pytest.mark.parametrize(argnames='backend', argvalues=['azure', 'github'])
+@pytest.mark.parametrize(argnames='configured', argvalues=[False, True])
+def test_verify_keeps_fingerprint(
+        configured_directory,
+        backend,
+        configured,
+        monkeypatch,
+):
+    # Generated from the repository root, as it would be committed.
+    monkeypatch.chdir(configured_directory)
+    configuration_path = pathlib.Path('ciborg.json')
+    output = pathlib.Path('output.yml')
+    generate = [
+        backend,
+        '--configuration',
+        str(configuration_path),
+        '--output',
+        str(output),
+    ]
+    runner = click.testing.CliRunner()
+
+    if configured:
+        marshalled = json.loads(configuration_path.read_text())
+        marshalled['fingerprint'] = True
+        configuration_path.write_text(json.dumps(marshalled))
+        result = runner.invoke(ciborg.cli.cli, generate)
+    else:
+        result = runner.invoke(ciborg.cli.cli, [*generate, '--fingerprint'])
+
+    assert result.exit_code == 0
+
+    generated = output.read_text()
+    assert generated.startswith(ciborg.output.fingerprint_prefix)
+
+    arguments, result = run_verify_generate(
+        directory=configured_directory,
+        backend=backend,
+        monkeypatch=monkeypatch,
+    )
+    assert result.exit_code == 0, result.output
+    assert ('--check' in arguments) is configured
+    assert output.read_text() == generated
+
+    if configured:
+        marshalled['name'] = 'changed'
+        configuration_path.write_text(json.dumps(marshalled))
+
+        _, result = run_verify_generate(
+            directory=configured_directory,
+            backend=backend,
+            monkeypatch=monkeypatch,
+        )
+        assert result.exit_code == 1
+        assert output.read_text() == generated
+
+
+def test_help_defers_backend_imports():
+    import_times = ciborg.benchmarks.startup.measure_import_times(['--help'])
+    imported = {import_time.name for import_time in import_times}
+
+    assert 'ciborg.cli' in imported
+    assert imported.isdisjoint(ciborg.benchmarks.startup.deferred_modules)
+
+
+def test_generate_matches_single_backends(configured_directory):
+    configuration_path = configured_directory / 'ciborg.json'
+    marshalled = json.loads(configuration_path.read_text())
+    marshalled['outputs'] = [
+        {'backend': 'azure', 'path': 'azure.yml'},
+        {'backend': 'github', 'path': 'github.yml'},
+    ]
+    configuration_path.write_text(json.dumps(marshalled))
+
+    runner = click.testing.CliRunner()
+    result = runner.invoke(
+        ciborg.cli.cli,
+        ['generate', '--configuration', str(configuration_path)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+
+    for backend in ['azure', 'github']:
+        output = configured_directory / 'output.yml'
+        assert invoke(configured_directory, backend).exit_code == 0
+
+        generated = configured_directory / '{}.yml'.format(backend)
+        expected = output.read_text().replace(str(output), str(generated))
+
+        assert generated.read_text() == expected
+
+
+def test_fleet(tmp_path):
+    with importlib_resources.path(ciborg.data, 'ciborg.json') as path:
+        marshalled = json.loads(path.read_text())
+
+    for name in ['first', 'second']:
+        repository = tmp_path / name
+        repository.mkdir()
+        (repository / 'ciborg.json').write_text(json.dumps(marshalled))
+
+    broken = tmp_path / 'broken'
+    broken.mkdir()
+    (broken / 'ciborg.json').write_text(json.dumps({'name': 'broken'}))
+
+    report = tmp_path / 'report.json'
+    runner = click.testing.CliRunner()
+
+    def fleet(*args):
+        return runner.invoke(
+            ciborg.cli.cli,
+            [
+                'fleet',
+                str(tmp_path / 'first'),
+                str(tmp_path / 'second'),
+                '--backend',
+                'azure',
+                '--report',
+                str(report),
+                *args,
+            ],
+            catch_exceptions=False,
+        )
+
+    assert fleet('--jobs', '2').exit_code == 0
+    statuses = [entry['status'] for entry in json.loads(report.read_text())]
+    assert statuses == ['changed', 'changed']
+
+    for name in ['first', 'second']:
+        generated = tmp_path / name / 'azure-pipelines.yml'
+        assert (
+            'python -m ciborg azure --configuration ciborg.json'
+            ' --output azure-pipelines.yml'
+        ) in generated.read_text()
+
+    assert fleet('--jobs', '1', '--check').exit_code == 0
+    statuses = [entry['status'] for entry in json.loads(report.read_text())]
+    assert statuses == ['unchanged', 'unchanged']
+
+    result = runner.invoke(
+        ciborg.cli.cli,
+        ['fleet', str(tmp_path), '--backend', 'azure', '--jobs', '1'],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 1
+    assert 'broken' in result.output
+
+
+@pytest.mark.parametrize(argnames='stream', argvalues=[False, True])
+def test_profile_report(configured_directory, stream):
+    report = configured_directory / 'profile.json'
+    stats = configured_directory / 'profile.pstats'
+
+    result = invoke(
+        configured_directory,
+        'azure',
+        '--stream' if stream else '--no-stream',
+        '--profile-report',
+        str(report),
+        '--profile-stats',
+        str(stats),
+    )
+    assert result.exit_code == 0
+
+    phases = {
+        phase['name']: phase
+        for phase in json.loads(report.read_text())['phases']
+    }
+    expected = ['parse', 'load', 'build', 'lower', 'emit']
+    if not stream:
+        expected.extend(['marshal', 'write'])
+    assert set(phases) == set(expected)
+    assert all(phase['seconds'] >= 0 for phase in phases.values())
+    assert pstats.Stats(str(stats)).total_calls > 0
+    assert ciborg.profiling.active is None
+
+
+@pytest.mark.parametrize(argnames='explicit_root', argvalues=[False, True])
+def test_fleet_nested_configuration(tmp_path, explicit_root):
+    with importlib_resources.path(ciborg.data, 'ciborg.json') as path:
+        marshalled = json.loads(path.read_text())
+
+    repository = tmp_path / 'repository'
+    subproject = repository / 'sub'
+    subproject.mkdir(parents=True)
+    (subproject / 'ciborg.json').write_text(json.dumps(marshalled))
+
+    arguments = ['fleet', str(subproject), '--backend', 'azure']
+    if explicit_root:
+        arguments.extend(['--root', str(repository)])
+    else:
+        (repository / '.git').mkdir()
+
+    runner = click.testing.CliRunner()
+    result = runner.invoke(ciborg.cli.cli, arguments, catch_exceptions=False)
+    assert result.exit_code == 0
+
+    generated = subproject / 'azure-pipelines.yml'
+    assert (
+        'python -m ciborg azure --configuration sub/ciborg.json'
+        ' --output sub/azure-pipelines.yml'
+    ) in generated.read_text()
+
+
+@pytest.mark.parametrize(
+    argnames='content',
+    argvalues=['{', '{"environments": 1}'],
+    ids=['syntax', 'structure'],
+)
+def test_analyze_reports_invalid_timings(configured_directory, content):
+    timings = configured_directory / 'timings.json'
+    timings.write_text(content)
+
+    result = click.testing.CliRunner().invoke(
+        ciborg.cli.cli,
+        [
+            'analyze',
+            '--configuration',
+            str(configured_directory / 'ciborg.json'),
+            '--timings',
+            str(timings),
+        ],
+        catch_exceptions=False,
+    )
+
+    assert result.exit_code == 1
+    assert result.output.startswith('Error: ')
+
+
+def test_analyze_does_not_hide_programming_errors(
+        configured_directory,
+        monkeypatch,
+):
+    import ciborg.graph
+
+    def analyze(**kwargs):
+        raise KeyError('bug')
+
+    monkeypatch.setattr(ciborg.graph, 'analyze', analyze)
+
+    with pytest.raises(KeyError):
+        click.testing.CliRunner().invoke(
+            ciborg.cli.cli,
+            [
+                'analyze',
+                '--configuration',
+                str(configured_directory / 'ciborg.json'),
+            ],
+            catch_exceptions=False,
+        )
+
+
+def test_fleet_check_skips_building_matching_outputs(
+        configured_directory,
+        monkeypatch,
+):
+    import ciborg.fleet
+
+    def generate(fingerprint, check):
+        return ciborg.fleet.generate(
+            configuration_path=configured_directory / 'ciborg.json',
+            default_backends=['azure'],
+            fingerprint=fingerprint,
+            check=check,
+            full_check=False,
+        )
+
+    result = generate(fingerprint=True, check=False)
+    assert result.error is None
+    assert len(result.changed) == 1
+
+    def create_intermediate(**kwargs):
+        raise AssertionError('built the intermediate pipeline')
+
+    monkeypatch.setattr(ciborg.cli, 'create_intermediate', create_intermediate)
+
+    result = generate(fingerprint=None, check=True)
+    assert result.error is None
+    assert len(result.unchanged) == 1
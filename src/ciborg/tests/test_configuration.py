@@ -1,7 +1,45 @@
+import marshmallow
+import pytest
+
 import ciborg
+import ciborg.benchmarks.scaling
+import ciborg.configuration
 
 
 def test_configuration_defaults_to_version(raw_configuration):
     expected = 'ciborg=={}'.format(ciborg.__version__)
 
     assert raw_configuration.ciborg_requirement == expected
+
+
+def test_compiled_load_matches_schema():
+    marshalled = ciborg.benchmarks.scaling.synthetic_configuration(size=100)
+    marshalled['outputs'] = [{'backend': 'azure', 'path': 'azure.yml'}]
+
+    reference = ciborg.configuration.ConfigurationSchema().load(marshalled)
+
+    assert ciborg.configuration.load_marshalled(marshalled) == reference
+
+
+@pytest.mark.parametrize(
+    argnames='change',
+    argvalues=[
+        {'build_wheel': 'sometimes'},
+        {'build_sdist': 'maybe'},
+        {'name': None},
+        {'unknown': 1},
+        {'tooling_environment': {'platform': 'amiga'}},
+        {'outputs': [{'backend': 'jenkins', 'path': 'x'}]},
+    ],
+)
+def test_compiled_load_reports_schema_errors(change):
+    marshalled = ciborg.benchmarks.scaling.synthetic_configuration(size=3)
+    marshalled.update(change)
+
+    with pytest.raises(marshmallow.ValidationError) as reference:
+        ciborg.configuration.ConfigurationSchema().load(marshalled)
+
+    with pytest.raises(marshmallow.ValidationError) as compiled:
+        ciborg.configuration.load_marshalled(marshalled)
+
+    assert compiled.value.messages == reference.value.messages
@@ -1,9 +1,12 @@
+import io
 import pathlib
 
+import attr
 import importlib_resources
 import pytest
 
 import ciborg.github
+import ciborg.intermediate
 import ciborg.configuration
 
 
@@ -20,12 +23,328 @@ def github_yaml():
     return content
 
 
-def test_dump(configuration, github_yaml):
+def test_dump(configuration, github_yaml, dumper):
     workflow = ciborg.github.create_workflow(
         configuration=configuration,
         configuration_path=pathlib.Path('ciborg.json'),
         output_path=pathlib.Path('github.yml'),
     )
-    dumped_workflow = ciborg.github.dump_workflow(pipeline=workflow)
+    dumped_workflow = ciborg.github.dump_workflow(
+        pipeline=workflow,
+        dumper=dumper,
+    )
 
     assert github_yaml == dumped_workflow
+
+
+def test_compiled_marshal_matches_schema(configuration):
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    reference = ciborg.github.WorkflowSchema().dump(workflow)
+
+    assert ciborg.github.marshal_workflow(pipeline=workflow) == reference
+
+
+def test_stream_matches_dump(configuration, github_yaml, dumper):
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+        lazy=True,
+    )
+
+    stream = io.StringIO()
+    ciborg.github.stream_workflow(
+        pipeline=workflow,
+        stream=stream,
+        dumper=dumper,
+    )
+
+    assert github_yaml == stream.getvalue()
+
+
+def test_matrix_legs_match_environments(configuration):
+    configuration = attr.evolve(configuration, matrix=True)
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    legs = [
+        leg
+        for job in marshalled['jobs'].values()
+        if 'strategy' in job
+        for leg in job['strategy']['matrix']['include']
+    ]
+
+    # GitHub would otherwise cancel the other legs when one fails.
+    assert all(
+        job['strategy']['fail-fast'] is False
+        for job in marshalled['jobs'].values()
+        if 'strategy' in job
+    )
+    assert [
+        (leg['vm_image'], leg['python_version'], leg['tox_environment'])
+        for leg in legs
+    ] == [
+        (
+            ciborg.intermediate.vm_images[environment.platform].id_name,
+            environment.version.display_string,
+            environment.tox_environment
+            or 'py' + environment.version.joined_by(''),
+        )
+        for environment in configuration.test_environments
+    ]
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+def test_pip_cache_keyed_on_lock_file(configuration, matrix):
+    configuration = attr.evolve(configuration, pip_cache=True, matrix=matrix)
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    lock_file = (
+        'matrix.lock_file'
+        if matrix
+        else "'requirements/test.linux.txt'"
+    )
+
+    for id_name, job in marshalled['jobs'].items():
+        caches = [
+            step
+            for step in job['steps']
+            if step.get('uses') == 'actions/cache@v2'
+        ]
+
+        if not id_name.startswith('tox'):
+            assert caches == []
+            continue
+
+        [cache] = caches
+        assert cache['with']['key'].endswith(
+            "hashFiles({}, 'tox.ini') }}}}".format(lock_file),
+        )
+        assert job['env']['PIP_CACHE_DIR'] == cache['with']['path']
+
+
+def test_tox_cache_in_matrix(configuration):
+    configuration = attr.evolve(
+        configuration,
+        matrix=True,
+        test_environments=[
+            attr.evolve(environment, tox_cache=True)
+            for environment in configuration.test_environments
+        ],
+    )
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    job = marshalled['jobs']['tox_sdist_cached']
+    [cache] = [
+        step
+        for step in job['steps']
+        if step['name'] == 'Cache tox environment'
+    ]
+
+    assert cache['with']['path'] == '.tox/${{ matrix.tox_environment }}'
+    assert 'restore-keys' not in cache['with']
+    assert [
+        leg['lock_file'] for leg in job['strategy']['matrix']['include']
+    ] == ['requirements/test.linux.txt']
+
+
+@pytest.mark.parametrize(
+    argnames='paths, paths_ignore, expected',
+    argvalues=[
+        ([], [], {}),
+        ([], ['docs/**'], {
+            'paths': ['**', '!docs/**', 'ciborg.json', 'github.yml'],
+        }),
+        (['src/**'], [], {
+            'paths': ['src/**', 'ciborg.json', 'github.yml'],
+        }),
+        (['src/**'], ['src/ciborg/data/**'], {
+            'paths': [
+                'src/**',
+                '!src/ciborg/data/**',
+                'ciborg.json',
+                'github.yml',
+            ],
+        }),
+        (['src/**'], ['*.json', '*.yml'], {
+            'paths': [
+                'src/**',
+                '!*.json',
+                '!*.yml',
+                'ciborg.json',
+                'github.yml',
+            ],
+        }),
+    ],
+)
+def test_path_filters(configuration, paths, paths_ignore, expected):
+    configuration = attr.evolve(
+        configuration,
+        paths=paths,
+        paths_ignore=paths_ignore,
+    )
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    for event in marshalled['on'].values():
+        filters = {
+            key: value
+            for key, value in event.items()
+            if key.startswith('paths')
+        }
+        assert filters == expected
+
+
+def test_verify_only_when_changed(configuration):
+    configuration = attr.evolve(configuration, verify_only_when_changed=True)
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    checkout, changes, *rest = marshalled['jobs']['verify_up_to_date'][
+        'steps'
+    ]
+    assert checkout['with'] == {'fetch-depth': 2}
+    assert changes['id'] == ciborg.github.changes_step_id
+    assert "'ciborg.json' 'github.yml'" in changes['run']
+    assert len(rest) > 0
+    assert all(
+        step['if'] == ciborg.github.changed_condition
+        for step in rest
+    )
+
+
+@pytest.mark.parametrize(argnames='cancel', argvalues=[False, True])
+def test_cancel_superseded_runs_concurrency(configuration, cancel):
+    configuration = attr.evolve(configuration, cancel_superseded_runs=cancel)
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    if cancel:
+        assert marshalled['concurrency'] == {
+            'group': '${{ github.workflow }}-${{ github.ref }}',
+            'cancel-in-progress': True,
+        }
+        assert list(marshalled)[:3] == ['name', 'on', 'concurrency']
+    else:
+        assert 'concurrency' not in marshalled
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+def test_tests_download_only_their_distribution(configuration, matrix):
+    configuration = attr.evolve(configuration, matrix=matrix)
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+
+    published = {}
+    downloaded = {}
+    for id_name, job in marshalled['jobs'].items():
+        for step in job['steps']:
+            if step.get('uses') == 'actions/upload-artifact@v2':
+                published[id_name] = step['with']['name']
+            elif step.get('uses') == 'actions/download-artifact@v2':
+                downloaded.setdefault(id_name, []).append(
+                    step['with']['name'],
+                )
+
+    assert published == {'sdist': 'dist-sdist', 'bdist': 'dist-any'}
+    assert len(downloaded) > 0
+
+    for id_name, names in downloaded.items():
+        [name] = names
+        [need] = [
+            need
+            for need in marshalled['jobs'][id_name]['needs']
+            if need in published
+        ]
+        assert name == published[need]
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+@pytest.mark.parametrize(argnames='fail_fast', argvalues=[False, True])
+def test_fail_fast(configuration, matrix, fail_fast):
+    configuration = attr.evolve(
+        configuration,
+        matrix=matrix,
+        fail_fast=fail_fast,
+    )
+    workflow = ciborg.github.create_workflow(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('github.yml'),
+    )
+
+    marshalled = ciborg.github.marshal_workflow(pipeline=workflow)
+    assert marshalled == ciborg.github.WorkflowSchema().dump(workflow)
+
+    cancel_step = ciborg.github.RunStepSchema().dump(
+        ciborg.github.create_cancel_run_step(),
+    )
+
+    for id_name, job in marshalled['jobs'].items():
+        test_job = id_name.startswith('tox')
+        cancels = job['steps'][-1] == cancel_step
+
+        if 'strategy' in job:
+            assert job['strategy']['fail-fast'] is fail_fast
+
+        assert cancels is (test_job and fail_fast)
+        if cancels:
+            assert job['permissions'] == {
+                'actions': 'write',
+                'contents': 'read',
+            }
+        else:
+            assert 'permissions' not in job
+
+    assert matrix is any(
+        'strategy' in job
+        for job in marshalled['jobs'].values()
+    )
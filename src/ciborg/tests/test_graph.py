@@ -0,0 +1,97 @@
+import pathlib
+
+import pytest
+
+import ciborg.graph
+import ciborg.intermediate
+import ciborg.timings
+
+
+def create_graph(**needs):
+    return ciborg.graph.Graph(needs=needs)
+
+
+def test_find_cycle():
+    assert create_graph(a=[], b=['a'], c=['a', 'b']).find_cycle() is None
+
+    graph = create_graph(a=['c'], b=['a'], c=['b'])
+    assert graph.find_cycle() == ['a', 'c', 'b', 'a']
+
+    with pytest.raises(Exception, match='a -> c -> b -> a'):
+        graph.topological_order()
+
+
+def test_transitive_reduction():
+    graph = create_graph(a=[], b=['a'], c=['b'], d=['a', 'b', 'c'])
+
+    assert graph.transitive_reduction().needs == {
+        'a': [],
+        'b': ['a'],
+        'c': ['b'],
+        'd': ['c'],
+    }
+    assert graph.redundant_needs() == [('d', 'a'), ('d', 'b')]
+
+
+def test_critical_path():
+    graph = create_graph(a=[], b=['a'], c=['a'], d=['b', 'c'])
+    seconds = {'a': 1, 'b': 5, 'c': 2, 'd': 1}
+
+    assert graph.critical_path(seconds) == (['a', 'b', 'd'], 7)
+
+
+def test_simulate_limits_runners_per_image():
+    graph = create_graph(a=[], b=['a'], c=['a'], d=['b', 'c'])
+
+    def task(id_name, seconds, vm_image='linux'):
+        return ciborg.graph.Task(
+            id_name=id_name,
+            vm_image=vm_image,
+            seconds=seconds,
+        )
+
+    tasks = {
+        'a': [task('a', 1)],
+        'b': [task('b', 5)],
+        'c': [task('c', 2), task('c', 2, vm_image='macos')],
+        'd': [task('d', 1)],
+    }
+
+    unlimited = ciborg.graph.simulate(graph=graph, tasks=tasks, runners={})
+    assert unlimited.makespan() == 7
+
+    # The longer chain through b starts first and c waits for the runner.
+    limited = ciborg.graph.simulate(
+        graph=graph,
+        tasks=tasks,
+        runners={'linux': 1},
+    )
+    assert limited.makespan() == 9
+    assert {job.id_name: job.finish for job in limited.jobs} == {
+        'a': 1,
+        'b': 6,
+        'c': 8,
+        'd': 9,
+    }
+
+
+def test_analyze_pipeline(configuration):
+    pipeline = ciborg.intermediate.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+    )
+
+    analysis = ciborg.graph.analyze(
+        pipeline=pipeline,
+        timings=ciborg.timings.Timings(),
+        default_seconds=10,
+    )
+
+    # The all job waits on the builds through the tests of their results.
+    assert set(analysis.graph.redundant_needs()) == {
+        ('all', 'sdist'),
+        ('all', 'bdist'),
+    }
+    assert analysis.critical_path[-1] == 'all'
+    assert analysis.critical_seconds == 20
+    assert analysis.schedule.makespan() == 20
@@ -0,0 +1,124 @@
+import io
+
+import attr
+
+import ciborg.configuration
+import ciborg.planning
+import ciborg.timings
+
+
+def create_environment(platform, tox_environment=None):
+    return ciborg.configuration.Environment(
+        platform=platform,
+        interpreter=ciborg.configuration.cpython_interpreter,
+        version=ciborg.configuration.python_versions[-1],
+        install_source=None,
+        tox_environment=tox_environment,
+    )
+
+
+test_environments = [
+    create_environment(ciborg.configuration.linux_platform),
+    create_environment(ciborg.configuration.linux_platform, 'lint'),
+    create_environment(ciborg.configuration.linux_platform, 'docs'),
+    create_environment(ciborg.configuration.macos_platform),
+]
+
+
+def key(environment):
+    return ciborg.timings.environment_key(environment)
+
+
+timings = ciborg.timings.Timings(
+    environments={
+        key(test_environments[0]): ciborg.timings.EnvironmentTiming(
+            seconds=300,
+        ),
+        key(test_environments[1]): ciborg.timings.EnvironmentTiming(
+            seconds=30,
+        ),
+        key(test_environments[2]): ciborg.timings.EnvironmentTiming(
+            seconds=45,
+        ),
+        key(test_environments[3]): ciborg.timings.EnvironmentTiming(
+            seconds=2400,
+            tests={
+                'tests/test_{}.py'.format(index): 100
+                for index in range(24)
+            },
+        ),
+    },
+)
+
+
+def test_makespan():
+    assert ciborg.planning.makespan([], runners=2) == 0
+    assert ciborg.planning.makespan([3, 3, 2, 2, 2], runners=2) == 7
+    assert ciborg.planning.makespan([5, 1, 1], runners=4) == 5
+
+
+def test_plan_splits_long_and_packs_short_environments():
+    plan = ciborg.planning.plan(
+        test_environments=test_environments,
+        timings=timings,
+        runners=6,
+        job_overhead=60,
+    )
+
+    assert plan.makespan() < plan.unplanned_makespan
+    assert plan.shards[3] > 1
+    assert plan.packs[3] is None
+    assert plan.packs[1] == plan.packs[2] is not None
+    assert plan.missing == []
+
+    marshalled = {
+        'test_environments': [
+            {
+                'platform': environment.platform.configuration_string,
+                'interpreter': environment.interpreter.configuration_string,
+                'version': environment.version.configuration_string,
+                'shards': 7,
+            }
+            for environment in test_environments
+        ],
+    }
+    applied = plan.apply(marshalled)['test_environments']
+    loaded = [
+        ciborg.configuration.EnvironmentSchema().load(environment)
+        for environment in applied
+    ]
+
+    assert [environment.shards for environment in loaded] == plan.shards
+    assert [environment.pack for environment in loaded] == plan.packs
+
+
+def test_load_junit_attributes_test_files():
+    report = io.StringIO(
+        '<testsuites>'
+        '<testsuite name="pytest" time="12.5">'
+        '<testcase classname="package.tests.test_a.TestA" name="t" time="4"/>'
+        '<testcase classname="package.tests.test_a" name="u" time="1"/>'
+        '<testcase classname="x" file="src/tests/test_b.py" name="t"'
+        ' time="6"/>'
+        '</testsuite>'
+        '</testsuites>',
+    )
+
+    loaded = ciborg.timings.load_junit(report, key='py38')
+
+    assert loaded == ciborg.timings.Timings(
+        environments={
+            'py38': ciborg.timings.EnvironmentTiming(
+                seconds=12.5,
+                tests={
+                    'package/tests/test_a.py': 5,
+                    'src/tests/test_b.py': 6,
+                },
+            ),
+        },
+    )
+    assert loaded.merge(loaded).get('py38') == attr.evolve(
+        loaded.get('py38'),
+        seconds=25,
+        tests={'package/tests/test_a.py': 10, 'src/tests/test_b.py': 12},
+    )
@@ -0,0 +1,201 @@
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import attr
+import pytest
+
+import ciborg.azure
+import ciborg.github
+import ciborg.pyz
+
+
+@pytest.fixture
+def package_directory(tmp_path):
+    # Installing would need an index so zip up this ciborg and leave the
+    # dependencies to the environment running the tests.
+    directory = tmp_path / 'package'
+    shutil.copytree(
+        pathlib.Path(ciborg.__file__).parent,
+        directory / 'ciborg',
+        ignore=shutil.ignore_patterns('tests', '__pycache__'),
+    )
+
+    return directory
+
+
+def test_strip_leaves_out_compiled_modules(package_directory):
+    compiled = package_directory / 'ciborg' / '_speedups.cpython-38.so'
+    compiled.touch()
+    (package_directory / 'bin').mkdir()
+    (package_directory / 'bin' / 'ciborg').touch()
+
+    removed = ciborg.pyz.strip(package_directory)
+
+    assert removed == [compiled.relative_to(package_directory)]
+    assert not compiled.exists()
+    assert not (package_directory / 'bin').exists()
+
+
+@pytest.mark.parametrize(argnames='backend', argvalues=['azure', 'github'])
+def test_zipapp_generates_same_output(package_directory, tmp_path, backend):
+    pyz = tmp_path / 'ciborg.pyz'
+    ciborg.pyz.create(directory=package_directory, output=pyz)
+
+    marshalled = json.loads(
+        (pathlib.Path(ciborg.__file__).parent / 'data' / 'ciborg.json')
+        .read_text(),
+    )
+    # The version of the copied package is unknown outside of git.
+    marshalled['ciborg_requirement'] = 'ciborg==v1+test'
+    (tmp_path / 'ciborg.json').write_text(json.dumps(marshalled))
+
+    outputs = {}
+    for name, command in [
+            ('zipapp', [sys.executable, str(pyz)]),
+            ('module', [sys.executable, '-m', 'ciborg']),
+    ]:
+        output = tmp_path / 'ci.yml'
+        environment = dict(os.environ)
+        if name == 'module':
+            environment['PYTHONPATH'] = str(
+                pathlib.Path(ciborg.__file__).parent.parent,
+            )
+        else:
+            environment.pop('PYTHONPATH', None)
+
+        subprocess.run(
+            [
+                *command,
+                backend,
+                '--configuration',
+                str(tmp_path / 'ciborg.json'),
+                '--output',
+                str(output),
+            ],
+            check=True,
+            cwd=tmp_path,
+            env=environment,
+        )
+        outputs[name] = output.read_text()
+
+    assert outputs['zipapp'] == outputs['module']
+
+
+@pytest.fixture
+def checkout(tmp_path):
+    # A copy keeps the build from writing into the working tree.
+    root = pathlib.Path(ciborg.__file__).parent.parent.parent
+    directory = tmp_path / 'checkout'
+    directory.mkdir()
+    for name in [
+            'MANIFEST.in',
+            'README.rst',
+            'pyproject.toml',
+            'setup.cfg',
+            'setup.py',
+    ]:
+        shutil.copy2(root / name, directory / name)
+    shutil.copytree(
+        root / 'src',
+        directory / 'src',
+        ignore=shutil.ignore_patterns('tests', '__pycache__', '*.egg-info'),
+    )
+
+    return directory
+
+
+@pytest.mark.skipif(
+    'CIBORG_NETWORK_TESTS' not in os.environ,
+    reason='installing needs an index, set CIBORG_NETWORK_TESTS to run',
+)
+def test_build_pins_installed_dependencies(checkout, tmp_path):
+    pyz = tmp_path / 'ciborg.pyz'
+    ciborg.pyz.build(requirements=[str(checkout)], output=pyz)
+
+    environment = dict(os.environ)
+    environment.pop('PYTHONPATH', None)
+    subprocess.run(
+        [sys.executable, str(pyz), '--help'],
+        check=True,
+        cwd=tmp_path,
+        env=environment,
+    )
+
+    pins = ciborg.pyz.installed_pins()
+    with zipfile.ZipFile(pyz) as archive:
+        names = archive.namelist()
+
+    [marshmallow] = [
+        pin for pin in pins if pin.lower().startswith('marshmallow==')
+    ]
+    version = marshmallow.partition('==')[2]
+    assert any(
+        name.startswith('marshmallow-{}.dist-info/'.format(version))
+        for name in names
+    )
+
+
+@pytest.mark.parametrize(
+    argnames='backend, create, marshal',
+    argvalues=[
+        (
+            'azure',
+            ciborg.azure.create_pipeline,
+            ciborg.azure.marshal_pipeline,
+        ),
+        (
+            'github',
+            ciborg.github.create_workflow,
+            ciborg.github.marshal_workflow,
+        ),
+    ],
+)
+@pytest.mark.parametrize(
+    argnames='location',
+    argvalues=['https://example.com/ciborg.pyz', 'tools/ciborg.pyz'],
+)
+def test_verify_job_runs_zipapp(
+        configuration,
+        backend,
+        create,
+        marshal,
+        location,
+):
+    configuration = attr.evolve(configuration, ciborg_zipapp=location)
+    pipeline = create(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+        output_path=pathlib.Path('ci.yml'),
+    )
+    marshalled = marshal(pipeline=pipeline)
+
+    if backend == 'azure':
+        [job] = [
+            job
+            for stage in marshalled['stages']
+            for job in stage['jobs']
+            if job['job'] == 'verify_up_to_date'
+        ]
+        names = [step.get('displayName') for step in job['steps']]
+        scripts = [step.get('bash', '') for step in job['steps']]
+    else:
+        job = marshalled['jobs']['verify_up_to_date']
+        names = [step.get('name') for step in job['steps']]
+        scripts = [step.get('run', '') for step in job['steps']]
+
+    assert 'Install ciborg' not in names
+    if '://' in location:
+        assert 'Cache ciborg zipapp' in names
+        assert 'Fetch ciborg zipapp' in names
+        assert any(location in script for script in scripts)
+    else:
+        assert 'Fetch ciborg zipapp' not in names
+        assert any(
+            script.startswith('python tools/ciborg.pyz ')
+            for script in scripts
+        )
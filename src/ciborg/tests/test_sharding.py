@@ -0,0 +1,186 @@
+import pathlib
+import subprocess
+import sys
+
+import attr
+import pytest
+
+import ciborg.intermediate
+import ciborg.sharding
+
+
+paths = [
+    'setup.py',
+    'src/package/__init__.py',
+    'src/package/tests/conftest.py',
+    *(
+        'src/package/tests/test_module_{}.py'.format(index)
+        for index in range(10)
+    ),
+    'tests/parser_test.py',
+]
+
+
+def test_shards_partition_the_test_files():
+    count = 3
+    shards = [
+        ciborg.sharding.select(paths=paths, index=index, count=count)
+        for index in range(count)
+    ]
+
+    selected = [path for shard in shards for path in shard]
+    assert sorted(selected) == sorted(
+        path for path in paths if ciborg.sharding.is_test_file(path)
+    )
+    assert len(selected) == len(set(selected))
+
+
+def test_selection_script_matches_select(tmp_path):
+    for path in paths:
+        full_path = tmp_path / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.touch()
+
+    try:
+        subprocess.run(['git', 'init', '--quiet'], cwd=tmp_path, check=True)
+        subprocess.run(['git', 'add', '.'], cwd=tmp_path, check=True)
+    except FileNotFoundError:
+        pytest.skip('git not available')
+
+    for index in range(3):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                '-c',
+                ciborg.sharding.selection_script,
+                str(index),
+                '3',
+            ],
+            cwd=tmp_path,
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+        assert completed.stdout.split() == ciborg.sharding.select(
+            paths=sorted(paths),
+            index=index,
+            count=3,
+        )
+
+
+def collect_shard(directory, index, count, pytest_arguments):
+    completed = subprocess.run(
+        [
+            'bash',
+            '-c',
+            '\n'.join([
+                *ciborg.sharding.commands(index=index, count=count),
+                '"$0" -m pytest --collect-only -q -p no:cacheprovider {}'
+                .format(pytest_arguments),
+            ]),
+            sys.executable,
+        ],
+        cwd=directory,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    return {
+        line.partition('::')[0]
+        for line in completed.stdout.splitlines()
+        if '::' in line
+    }
+
+
+@pytest.mark.parametrize(
+    argnames='pytest_arguments, runs_only_shard',
+    argvalues=[
+        # tox.ini forwarding {posargs} as the only paths.
+        ('${SHARD_FILES}', True),
+        # A fixed path before {posargs} collects everything in every shard.
+        ('tests ${SHARD_FILES}', False),
+    ],
+)
+def test_shard_collects_only_its_files(
+        tmp_path,
+        pytest_arguments,
+        runs_only_shard,
+):
+    count = 3
+    tests = tmp_path / 'tests'
+    tests.mkdir()
+    for index in range(6):
+        (tests / 'test_module_{}.py'.format(index)).write_text(
+            'def test_it():\n    pass\n',
+        )
+
+    try:
+        subprocess.run(['git', 'init', '--quiet'], cwd=tmp_path, check=True)
+        subprocess.run(['git', 'add', '.'], cwd=tmp_path, check=True)
+    except FileNotFoundError:
+        pytest.skip('git not available')
+
+    paths = sorted(
+        path.relative_to(tmp_path).as_posix()
+        for path in tests.iterdir()
+    )
+    for index in range(count):
+        selected = ciborg.sharding.select(
+            paths=paths,
+            index=index,
+            count=count,
+        )
+        if len(selected) == 0:
+            continue
+
+        collected = collect_shard(
+            directory=tmp_path,
+            index=index,
+            count=count,
+            pytest_arguments=pytest_arguments,
+        )
+
+        assert (collected == set(selected)) is runs_only_shard
+
+
+@pytest.mark.parametrize(argnames='matrix', argvalues=[False, True])
+def test_all_job_needs_every_shard(configuration, matrix):
+    [first, *rest] = configuration.test_environments
+    configuration = attr.evolve(
+        configuration,
+        matrix=matrix,
+        test_environments=[attr.evolve(first, shards=3), *rest],
+    )
+    pipeline = ciborg.intermediate.create_pipeline(
+        configuration=configuration,
+        configuration_path=pathlib.Path('ciborg.json'),
+    )
+
+    tox_steps = [
+        step
+        for job in pipeline.jobs
+        for step in job.steps
+        if isinstance(step, ciborg.intermediate.ToxStep)
+    ]
+    if matrix:
+        [sharded] = [
+            job
+            for job in pipeline.jobs
+            if job.id_name.endswith('_sharded')
+        ]
+        assert [leg.shard.index for leg in sharded.matrix] == [0, 1, 2]
+    else:
+        shards = [
+            (step.shard_index, step.shard_count)
+            for step in tox_steps
+            if step.shard_index is not None
+        ]
+        assert shards == [(0, 3), (1, 3), (2, 3)]
+
+    *other_jobs, all_job = pipeline.jobs
+    assert [reference.id_name for reference in all_job.needs] == [
+        job.id_name for job in other_jobs
+    ]
+    assert len({job.id_name for job in pipeline.jobs}) == len(pipeline.jobs)
@@ -0,0 +1,159 @@
+"""Recorded durations of the test environments and their test files.
+
+Environments are keyed by :func:`environment_key`, which is also the matrix
+leg id, so results can be collected from JUnit XML reports named after it or
+from a JSON history shaped like::
+
+    {
+        "environments": {
+            "typehints_linux_cpython_3_8": {
+                "seconds": 95.0,
+                "tests": {"src/package/tests/test_module.py": 12.5}
+            }
+        }
+    }
+
+The environment seconds cover the whole tox run while the tests are those
+recorded for each test file, relative to the repository root.
+"""
+import json
+import pathlib
+import xml.etree.ElementTree
+
+import attr
+import marshmallow
+from pyrsistent import pmap
+
+import ciborg.intermediate
+import ciborg.sharding
+
+
+def environment_key(environment):
+    return '_'.join(
+        ciborg.intermediate.environment_id_pieces(
+            ciborg.intermediate.Environment.from_configuration(environment),
+        ),
+    )
+
+
+def add_tests(first, second):
+    tests = dict(first)
+    for path, seconds in second.items():
+        tests[path] = tests.get(path, 0) + seconds
+
+    return pmap(tests)
+
+
+@attr.s(frozen=True)
+class EnvironmentTiming:
+    seconds = attr.ib()
+    tests = attr.ib(default=pmap(), converter=pmap)
+
+    def overhead(self):
+        return max(0, self.seconds - sum(self.tests.values()))
+
+    def merge(self, other):
+        return EnvironmentTiming(
+            seconds=self.seconds + other.seconds,
+            tests=add_tests(self.tests, other.tests),
+        )
+
+
+@attr.s(frozen=True)
+class Timings:
+    environments = attr.ib(default=pmap(), converter=pmap)
+
+    def get(self, key):
+        return self.environments.get(key)
+
+    def merge(self, other):
+        """Add the timings of ``other``.  An environment recorded in both,
+        such as one split across shards, is summed.
+        """
+        environments = dict(self.environments)
+        for key, timing in other.environments.items():
+            existing = environments.get(key)
+            environments[key] = (
+                timing if existing is None else existing.merge(timing)
+            )
+
+        return Timings(environments=environments)
+
+
+def merge_all(timings):
+    merged = Timings()
+    for timing in timings:
+        merged = merged.merge(timing)
+
+    return merged
+
+
+def load_json(file):
+    marshalled = json.load(file)
+
+    try:
+        return Timings(
+            environments={
+                key: EnvironmentTiming(
+                    seconds=float(environment['seconds']),
+                    tests={
+                        path: float(seconds)
+                        for path, seconds in environment.get(
+                            'tests',
+                            {},
+                        ).items()
+                    },
+                )
+                for key, environment in marshalled['environments'].items()
+            },
+        )
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise marshmallow.ValidationError(
+            'Invalid timings in {}: {!r}'.format(
+                getattr(file, 'name', file),
+                e,
+            ),
+        ) from e
+
+
+def test_path(test_case):
+    path = test_case.get('file')
+    if path is not None:
+        return pathlib.PurePath(path).as_posix()
+
+    # pytest only records the file for the xunit1 family, otherwise the
+    # class name starts with the dotted path of the module.
+    pieces = test_case.get('classname', '').split('.')
+    for index, piece in enumerate(pieces):
+        if ciborg.sharding.is_test_file(piece + '.py'):
+            return '/'.join(pieces[:index + 1]) + '.py'
+
+    return None
+
+
+def load_junit(file, key):
+    root = xml.etree.ElementTree.parse(file).getroot()
+    suites = [root] if root.tag == 'testsuite' else root.iter('testsuite')
+
+    seconds = 0
+    tests = {}
+    try:
+        for suite in suites:
+            cases = list(suite.iter('testcase'))
+            case_seconds = [float(case.get('time', 0)) for case in cases]
+            seconds += float(suite.get('time', sum(case_seconds)))
+
+            for case, case_time in zip(cases, case_seconds):
+                path = test_path(case)
+                if path is not None:
+                    tests[path] = tests.get(path, 0) + case_time
+    except ValueError as e:
+        raise marshmallow.ValidationError(
+            'Invalid timings in {}: {!r}'.format(file, e),
+        ) from e
+
+    return Timings(
+        environments={
+            key: EnvironmentTiming(seconds=seconds, tests=tests),
+        },
+    )